@@ -0,0 +1,271 @@
+#!/usr/local/bin/python
+
+""" Benchmarks for the compare pipeline, so I know where the scaling limits are before the collection outgrows the cron window.
+ Makes deterministic synthetic Deckbox exports (today + an older one) and a synthetic AtomicCards library, then times each stage
+ of a run on its own: buildCompareDFs (cold, then from the snapshot cache), buildMergeDF, queryForReports, buildHTMLReport,
+ the snapshot store (storing today's export as a delta on the older one, rebuilding it, and parsing its CSV to compare) and,
+ as a baseline, the old row by row loopDataFrame.
+
+ python bench_check.py                      # 10k, 100k and 1M rows, checked against bench_baseline.json
+ python bench_check.py 10000 100000         # just these sizes (they have to be in the baseline too)
+ python bench_check.py --save-baseline      # run, then write the numbers as the new baseline instead of checking them
+
+ Wall time, rows per second and peak traced memory for every stage go in bench_output.txt. Then every stage is checked against the
+ committed bench_baseline.json (made with the default sizes): more than BENCH_TOLERANCE times slower (or hungrier) than the baseline,
+ no baseline for a stage/size, or no baseline file at all is called out and the exit code is 1. The baseline is only as good as the
+ machine it came from, after moving to a different one run --save-baseline there and commit the result.
+ Peak memory comes from tracemalloc in a second pass, tracing makes pandas several times slower so it can't be on for the timings.
+"""
+
+import contextlib
+import io
+import json
+import numpy
+import os
+import pandas
+import shutil
+import sys
+import tempfile
+import tracemalloc
+import zipfile
+from timeit import default_timer as timer
+
+import check
+
+BENCH_SIZES = [10000, 100000, 1000000]
+BENCH_OUTPUT_FILE_NAME = "bench_output.txt"
+BENCH_BASELINE_FILE_NAME = "bench_baseline.json"
+BENCH_TOLERANCE = 1.5  # how much slower/bigger than the baseline a stage can get before it counts as a regression
+BENCH_SEED = 20200101
+LOOP_BASELINE_MAX_ROWS = 100000  # iterrows is minutes at a million rows, it's only here for comparison anyway
+BENCH_TODAY_FILE_NAME = "20200201-magic-cards.csv"
+BENCH_OLD_FILE_NAME = "20200101-magic-cards.csv"
+BENCH_STORE_KEY_FILE_NAME = "19990101-magic-cards.csv"  # copies of the two exports for the snapshot store stages, it deletes what it stores
+BENCH_STORE_DELTA_FILE_NAME = "19990102-magic-cards.csv"
+BENCH_CONDITIONS = ["Near Mint", "Near Mint", "Near Mint", "Good (Lightly Played)", "Played", "Mint"]
+BENCH_COLORS = [["W"], ["U"], ["B"], ["R"], ["G"], ["W", "U"], ["B", "R"], []]
+
+
+def makeCardNames(intNames, rng):
+    """return intNames made up card names, about 2% of them split cards ("A // B")"""
+    arrNames = numpy.array(["Card " + str(intName) for intName in range(intNames)], dtype=object)
+    arrSplit = rng.random(intNames) < 0.02
+    arrNames[arrSplit] = [strName + " // Other " + strName.split(" ")[1] for strName in arrNames[arrSplit]]
+    return arrNames
+
+
+def writeSyntheticLibrary(strZipFileName, arrNames, rng):
+    """write an AtomicCards-shaped zip for the names: a list of faces per name, split cards get both faces, some lands and colorless"""
+    dictData = {}
+    for strName in arrNames:
+        listFaces = []
+        for strFace in strName.split(" // "):
+            listColors = BENCH_COLORS[rng.integers(len(BENCH_COLORS))]
+            listTypes = ["Land"] if len(listColors) == 0 and rng.random() < 0.5 else ["Creature"]
+            listFaces.append({"name": strName, "faceName": strFace, "colors": listColors, "types": listTypes})
+        dictData[strName] = listFaces
+    with zipfile.ZipFile(strZipFileName, "w", zipfile.ZIP_DEFLATED) as zip:
+        zip.writestr("AtomicCards.json", json.dumps({"meta": {"version": "bench"}, "data": dictData}))
+
+
+def syntheticExport(intRows, arrNames, rng):
+    """return a Deckbox-export-shaped df of intRows distinct cards: names repeat across editions (a zipf-ish few are everywhere),
+    prices are lognormal so most of it is bulk with a long expensive tail"""
+    arrNameIndex = numpy.minimum(rng.zipf(1.3, intRows) - 1, len(arrNames) - 1)
+    arrNameIndex = numpy.where(rng.random(intRows) < 0.5, rng.integers(len(arrNames), size=intRows), arrNameIndex)
+    arrCents = numpy.round(rng.lognormal(mean=4.0, sigma=1.6, size=intRows)).astype("int64")
+    return pandas.DataFrame({
+        "Count": rng.integers(1, 5, size=intRows),
+        "Tradelist Count": rng.integers(0, 3, size=intRows),
+        "Name": arrNames[arrNameIndex],
+        "Edition": ["Set " + str(intSet) for intSet in rng.integers(300, size=intRows)],
+        "Card Number": numpy.arange(intRows).astype(str),  # keeps every row a distinct card
+        "Condition": numpy.array(BENCH_CONDITIONS, dtype=object)[rng.integers(len(BENCH_CONDITIONS), size=intRows)],
+        "Language": "English",
+        "Foil": numpy.where(rng.random(intRows) < 0.1, "foil", ""),
+        "Signed": "", "Artist Proof": "", "Altered Art": "", "Misprint": "", "Promo": "", "Textless": "", "My Price": "",
+        "Type": "Creature", "Rarity": "Rare",
+        "Price": ["$" + format(intCents / 100, ",.2f") for intCents in arrCents]})
+
+
+def olderExport(dfToday, rng):
+    """make the "last month" version of an export: a few percent of the cards weren't there yet, a few that are gone now got
+    sold, counts shift a little and prices drift (enough that cards cross box thresholds)"""
+    intRows = len(dfToday)
+    dfOld = dfToday[rng.random(intRows) >= 0.03].copy()
+    dfGone = dfToday.sample(n=max(1, intRows // 30), random_state=BENCH_SEED).copy()
+    dfGone["Card Number"] = [str(intRows + intRow) for intRow in range(len(dfGone))]
+    dfOld = pandas.concat([dfOld, dfGone])
+    arrCents = (dfOld["Price"].str.replace(r"[$,]", "", regex=True).astype(float) * 100).to_numpy()
+    arrCents = numpy.round(arrCents * rng.lognormal(mean=0.0, sigma=0.25, size=len(dfOld)))
+    dfOld["Price"] = ["$" + format(intCents / 100, ",.2f") for intCents in arrCents]
+    dfOld["Count"] = numpy.maximum(1, dfOld["Count"] + rng.integers(-1, 2, size=len(dfOld)))
+    return dfOld
+
+
+def makeBenchData(strDataDir, intRows, intSeed=BENCH_SEED):
+    """write today's and an older synthetic export plus the library zip into strDataDir, same seed means same files"""
+    rng = numpy.random.default_rng(intSeed + intRows)
+    arrNames = makeCardNames(max(100, intRows // 3), rng)
+    writeSyntheticLibrary(strDataDir + "AllCards.zip", arrNames, rng)
+    dfToday = syntheticExport(intRows, arrNames, rng)
+    dfToday.to_csv(strDataDir + BENCH_TODAY_FILE_NAME, index=False)
+    olderExport(dfToday, rng).to_csv(strDataDir + BENCH_OLD_FILE_NAME, index=False)
+
+
+def useDataDir(strDataDir):
+    """point check at a scratch data dir, returns what it was pointing at so it can be put back"""
+    dictSaved = {strName: getattr(check, strName) for strName in
+                 ["DATA_DIR_NAME", "RUN_LOG_FILE_NAME", "SNAPSHOT_CACHE_DIR_NAME", "HISTORY_DB_FILE_NAME", "STAGE_CACHE_DIR_NAME",
+                  "SNAPSHOT_STORE_DIR_NAME"]}
+    check.DATA_DIR_NAME = strDataDir
+    check.RUN_LOG_FILE_NAME = strDataDir + "run-log.json"
+    check.SNAPSHOT_CACHE_DIR_NAME = strDataDir + "cache/"
+    check.HISTORY_DB_FILE_NAME = strDataDir + "card-history.db"
+    check.STAGE_CACHE_DIR_NAME = strDataDir + "stages/"
+    check.SNAPSHOT_STORE_DIR_NAME = strDataDir + "snapshots/"
+    return dictSaved
+
+
+def runStage(listStages, strStage, intRows, fn, *args):
+    """run one stage quietly (it prints a lot), note its wall time and, if tracemalloc is on, its peak traced memory"""
+    bTracing = tracemalloc.is_tracing()
+    if bTracing:
+        tracemalloc.reset_peak()
+        intStartBytes = tracemalloc.get_traced_memory()[0]
+    with contextlib.redirect_stdout(io.StringIO()):
+        timeStart = timer()
+        result = fn(*args)
+        fSeconds = timer() - timeStart
+    intPeakBytes = tracemalloc.get_traced_memory()[1] - intStartBytes if bTracing else None
+    listStages.append((strStage, intRows, fSeconds, intPeakBytes))
+    return result
+
+
+def runPipeline(strDataDir, intRows, dictCardLibrary, bTraceMemory):
+    """run every stage once from a cold snapshot cache and return [(stage, rows, seconds, peak bytes or None)]"""
+    shutil.rmtree(strDataDir + "cache/", ignore_errors=True)
+    shutil.rmtree(strDataDir + "snapshots/", ignore_errors=True)
+    if os.path.exists(strDataDir + "card-history.db"):
+        os.remove(strDataDir + "card-history.db")
+    listStages = []
+    if bTraceMemory:
+        tracemalloc.start()
+    try:
+        runStage(listStages, "buildCompareDFs", intRows, check.buildCompareDFs, BENCH_TODAY_FILE_NAME)
+        dfNew, dfOld, strOldFileName = runStage(listStages, "buildCompareDFs-cached", intRows, check.buildCompareDFs, BENCH_TODAY_FILE_NAME)
+        dfMergeCards = runStage(listStages, "buildMergeDF", len(dfNew) + len(dfOld), check.buildMergeDF, dfNew, dfOld, dictCardLibrary, {})
+        dictResults, dictResultStats = runStage(listStages, "queryForReports", len(dfMergeCards), check.queryForReports, dfMergeCards)
+        runStage(listStages, "buildHTMLReport", len(dfMergeCards), check.buildHTMLReport,
+                 dfMergeCards, dictResults, dictResultStats, BENCH_TODAY_FILE_NAME, strOldFileName)
+        # the older export goes in the store as the keyframe, today's is the delta that gets timed, rebuilding it should beat parsing it
+        shutil.copy(strDataDir + BENCH_OLD_FILE_NAME, strDataDir + BENCH_STORE_KEY_FILE_NAME)
+        shutil.copy(strDataDir + BENCH_TODAY_FILE_NAME, strDataDir + BENCH_STORE_DELTA_FILE_NAME)
+        with contextlib.redirect_stdout(io.StringIO()):
+            check.storeSnapshot(BENCH_STORE_KEY_FILE_NAME)
+        runStage(listStages, "readDeckboxExport", intRows, check.readDeckboxExport, strDataDir + BENCH_STORE_DELTA_FILE_NAME)
+        runStage(listStages, "storeSnapshot", intRows, check.storeSnapshot, BENCH_STORE_DELTA_FILE_NAME)
+        runStage(listStages, "readStoredSnapshot", intRows, check.readStoredSnapshot, BENCH_STORE_DELTA_FILE_NAME)
+        # the loop is only a reference point for the timings, tracing it too would take forever
+        if intRows <= LOOP_BASELINE_MAX_ROWS and not bTraceMemory:
+            runStage(listStages, "loopDataFrame", len(dfMergeCards), check.loopDataFrame, dfMergeCards)
+    finally:
+        if bTraceMemory:
+            tracemalloc.stop()
+    return listStages
+
+
+def benchSize(intRows, listResults):
+    """generate data for intRows cards and time every stage of a compare on it
+    tracemalloc slows pandas down several times over, so the timings come from a plain pass and peak memory from a second, traced one"""
+    strDataDir = tempfile.mkdtemp(prefix="card-check-bench-") + "/"
+    dictSaved = useDataDir(strDataDir)
+    try:
+        print("generating " + str(intRows) + " rows")
+        makeBenchData(strDataDir, intRows)
+        dictCardLibrary = check.readLibraryZip(strDataDir + "AllCards.zip")
+
+        print("benchmarking " + str(intRows) + " rows")
+        listTimed = runPipeline(strDataDir, intRows, dictCardLibrary, False)
+        dictPeakBytes = {strStage: intPeakBytes for strStage, intRows, fSeconds, intPeakBytes
+                         in runPipeline(strDataDir, intRows, dictCardLibrary, True)}
+        for strStage, intStageRows, fSeconds, intPeakBytes in listTimed:
+            fPeakMB = round(dictPeakBytes[strStage] / 1048576, 2) if strStage in dictPeakBytes else None
+            listResults.append({"size": intRows, "stage": strStage, "rows": intStageRows, "seconds": round(fSeconds, 4),
+                                "rows-per-second": round(intStageRows / fSeconds) if fSeconds > 0 else None, "peak-mb": fPeakMB})
+            print("  " + strStage + ": " + format(fSeconds, ".3f") + "s" + (", " + format(fPeakMB, ".1f") + "MB" if fPeakMB is not None else ""))
+        if intRows > LOOP_BASELINE_MAX_ROWS:
+            print("  loopDataFrame: skipped, more than " + str(LOOP_BASELINE_MAX_ROWS) + " rows")
+    finally:
+        for strName, value in dictSaved.items():
+            setattr(check, strName, value)
+        shutil.rmtree(strDataDir, ignore_errors=True)
+
+
+def compareToBaseline(listResults, listBaseline, fTolerance=BENCH_TOLERANCE):
+    """return a line for every stage that's more than fTolerance times slower or bigger than the same stage/size in the baseline,
+    or isn't in the baseline at all. tiny stages (under 50ms / 1MB) are left alone, they're mostly noise"""
+    dictBaseline = {(dictResult["size"], dictResult["stage"]): dictResult for dictResult in listBaseline}
+    listRegressions = []
+    for dictResult in listResults:
+        dictBase = dictBaseline.get((dictResult["size"], dictResult["stage"]))
+        if dictBase is None:
+            listRegressions.append(dictResult["stage"] + " @ " + str(dictResult["size"]) + " rows: not in the baseline")
+            continue
+        for strField, fFloor in [("seconds", 0.05), ("peak-mb", 1.0)]:
+            if dictResult[strField] is None or dictBase[strField] is None:
+                continue
+            if dictResult[strField] > max(dictBase[strField], fFloor) * fTolerance:
+                listRegressions.append(dictResult["stage"] + " @ " + str(dictResult["size"]) + " rows: " + strField + " "
+                                       + str(dictResult[strField]) + " vs baseline " + str(dictBase[strField]))
+    return listRegressions
+
+
+def formatResults(listResults):
+    """the results as a fixed width table, that's what goes in the output file"""
+    listLines = [format("rows", ">9") + "  " + format("stage", "<24") + format("seconds", ">10")
+                 + format("rows/s", ">12") + format("peak MB", ">10")]
+    for dictResult in listResults:
+        listLines.append(format(dictResult["size"], ">9") + "  " + format(dictResult["stage"], "<24")
+                         + format(dictResult["seconds"], ">10.3f") + format(dictResult["rows-per-second"] or 0, ">12,")
+                         + (format(dictResult["peak-mb"], ">10.1f") if dictResult["peak-mb"] is not None else format("-", ">10")))
+    return "\n".join(listLines) + "\n"
+
+
+def main(listArgs):
+    bSaveBaseline = "--save-baseline" in listArgs
+    listSizes = [int(strArg) for strArg in listArgs if not strArg.startswith("--")] or BENCH_SIZES
+
+    listResults = []
+    for intRows in listSizes:
+        benchSize(intRows, listResults)
+
+    strTable = formatResults(listResults)
+    with open(BENCH_OUTPUT_FILE_NAME, "w") as file:
+        file.write(strTable)
+        file.write(json.dumps(listResults, indent=1) + "\n")
+    print(strTable)
+
+    if bSaveBaseline:
+        with open(BENCH_BASELINE_FILE_NAME, "w") as file:
+            json.dump(listResults, file, indent=1)
+        print("saved as the new baseline: " + BENCH_BASELINE_FILE_NAME)
+        return 0
+
+    if not os.path.exists(BENCH_BASELINE_FILE_NAME):
+        print("REGRESSIONS: no " + BENCH_BASELINE_FILE_NAME + " to check against, run with --save-baseline to make one")
+        return 1
+    with open(BENCH_BASELINE_FILE_NAME) as file:
+        listRegressions = compareToBaseline(listResults, json.load(file))
+    if len(listRegressions) > 0:
+        print("REGRESSIONS against " + BENCH_BASELINE_FILE_NAME + ":")
+        for strRegression in listRegressions:
+            print("  " + strRegression)
+        print("(--save-baseline if that's expected, a deliberate trade off or a new machine)")
+        return 1
+    print("no regressions against " + BENCH_BASELINE_FILE_NAME)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
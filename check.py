@@ -24,7 +24,16 @@
  Pass in "--debug" for additional log output
 """
 
+import collections
+import contextlib
+import concurrent.futures
+import cProfile
+import csv
 import datetime
+import gzip
+import hashlib
+import http.cookiejar
+import http.server
 import io
 import json
 import logging
@@ -32,28 +41,118 @@ import numpy
 import os
 import pandas
 import platform
-import re
 import requests
+import resource
 import shutil
 import smtplib
+import socket
+import socketserver
+import sqlite3
 import sys
+import threading
+import time
+import tracemalloc
+import uuid
 import zipfile
+from email.mime.application import MIMEApplication
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
-from operator import itemgetter
 from pathlib import Path
 from timeit import default_timer as timer
 
 MAGIC_CARD_JSON_URL = "https://mtgjson.com/api/v5/AtomicCards.json.zip"
 DATA_DIR_NAME = "data/"
-RUN_LOG_FILE_NAME = DATA_DIR_NAME + "run-log.json"
+RUN_LOG_FILE_NAME = DATA_DIR_NAME + "run-log.json"  # the old whole-file run log, only read once to move it into the history db
 CONFIG_FILE_NAME = "config.json"
 COOKIE_FILE_NAME = "cookies.json"
+DECKBOX_SET_ID = "1016639"  # the collection to export, batch mode points this (and data/, cookies) at each collection in turn
 TRADE_BOX_THRESHOLD = 10  # this might change, but it's this for now
 BULK_BOX_THRESHOLD = 3  # used to be a dollar, but some buyers said less than #4 is bulk
+# the boxes, cheapest first: (key used in result names, pretty name, lowest price that goes in the box). A price right on a threshold goes in the higher box
+PRICE_TIERS = [("bulk", "Bulk", 0), ("dollar", "Dollar", BULK_BOX_THRESHOLD), ("trades", "Trades", TRADE_BOX_THRESHOLD)]
+# what a collection gets for anything neither it nor the shared config sets. Taken once here, useCollection changes the globals above
+DEFAULT_COLLECTION_SETTINGS = {"cookie-file": COOKIE_FILE_NAME, "deckbox-set-id": DECKBOX_SET_ID, "trade-box-threshold": TRADE_BOX_THRESHOLD,
+                               "bulk-box-threshold": BULK_BOX_THRESHOLD}
+LIBRARY_ZIP_FILE_NAME = DATA_DIR_NAME + "AllCards.zip"
+DECKBOX_EXPORT_URL = "https://deckbox.org/sets/export/"
+DECKBOX_MIN_ROW_RATIO = 0.5  # an export with fewer rows than this much of the last snapshot's cards is taken to be cut off, override with "deckbox-min-row-ratio"
+HTTP_TIMEOUT_SECONDS = (10, 120)  # (connect, wait between bytes) for every request, without one a stuck server hangs the cron run forever
+# per endpoint: timeout and how many tries a request gets, waiting HTTP_RETRY_SECONDS, then twice that, ... in between. "http-endpoints" in
+# config overrides any of it, like {"deckbox": {"attempts": 5}}
+HTTP_ENDPOINTS = {"deckbox": {"timeout": HTTP_TIMEOUT_SECONDS, "attempts": 3},
+                  "mtgjson": {"timeout": HTTP_TIMEOUT_SECONDS, "attempts": 3},
+                  "mtgjson-checksum": {"timeout": (10, 30), "attempts": 2}}
+HTTP_RETRY_SECONDS = 2
+HTTP_RETRY_STATUSES = (429, 500, 502, 503, 504)  # worth another try, anything else goes back to the caller as is
+HTTP_CASSETTE_DIR_NAME = DATA_DIR_NAME + "http/"  # recorded responses for --record-http/--replay-http
+HTTP_CASSETTE_KEY_HEADERS = ["If-None-Match", "If-Modified-Since", "Range", "If-Range"]  # request headers that change what comes back
+STARTUP_TIMEOUT_SECONDS = 900  # how long the concurrent startup tasks get all together, override with "startup-timeout-seconds"
+LIBRARY_TTL_HOURS = 20  # don't even ask mtgjson if it's been checked this recently, override with "library-ttl-hours" in config
+SORT_INDEX_FILE_NAME = DATA_DIR_NAME + "AllCards.sortidx"
+SNAPSHOT_CACHE_DIR_NAME = DATA_DIR_NAME + "cache/"
+HISTORY_DB_FILE_NAME = DATA_DIR_NAME + "card-history.db"  # also where the stable card ids come from
+HISTORY_SCHEMA_VERSION = 1  # bump whenever openHistory's schema gets something new, so existing dbs pick it up
+CARD_IDENTITY_COLUMNS = ["Name", "Edition", "Foil", "Condition", "Card Number"]
+# the only Deckbox export columns anything here uses, and how to read them. everything else in the export is skipped at parse time
+# counts come in as text so a blank or junk cell can be reported and counted as 0 (see parseCounts) instead of failing the whole read
+DECKBOX_SCHEMA = {"Count": "object", "Tradelist Count": "object", "Name": "category", "Edition": "category",
+                  "Card Number": "object", "Condition": "category", "Foil": "object", "Price": "object"}
+MONEY_COLUMNS = ["OldPrice", "NewPrice", "PriceChange", "TotalChange"]  # integer cents in the merged frame, dollars on the way out
+MONEY_STATS = ["total-value", "net-value-change", "total-gain", "total-loss"]  # summed in cents, reported in dollars
+SNAPSHOT_STORE_DIR_NAME = DATA_DIR_NAME + "snapshots/"  # old snapshots, a keyframe now and then and deltas in between, see storeSnapshot
+SNAPSHOT_STORE_VERSION = 1
+SNAPSHOT_KEYFRAME_EVERY = 30  # a full copy every this many stored snapshots, so rebuilding one never goes through more deltas than that
+SNAPSHOT_DELTA_COLUMNS = ["Count", "Tradelist Count", "Price"]  # what changes between snapshots, stored as differences
+SNAPSHOT_IDENTITY_COLUMNS = ["Name", "Edition", "Card Number", "Condition", "Foil"]  # what doesn't, only stored for new rows
+STAGE_CACHE_DIR_NAME = DATA_DIR_NAME + "stages/"
+STAGE_CACHE_VERSION = 1  # bump whenever merging/querying changes what comes out for the same inputs
+STAGE_CACHE_KEEP = 20
+DAEMON_SOCKET_FILE_NAME = DATA_DIR_NAME + "check.sock"  # where --daemon listens, override with "daemon-socket"
+DAEMON_POLL_SECONDS = 10  # how often the daemon looks in data/ for new exports, override with "daemon-poll-seconds"
+DAEMON_RESIDENT_SNAPSHOTS = 8  # parsed snapshots the daemon keeps in memory, the least recently used go first
+DAEMON_RESIDENT_MERGES = 8  # same for merged and queried pairs of snapshots
+SNAPSHOT_CACHE_VERSION = 4  # bump whenever cleanCardDataFrame changes what a cleaned snapshot looks like
+SORT_INDEX_MAGIC = "card-check-sort-index-1"
+# the columns of the card tables in the report: merged column, header, how it's formatted (see formatCardCells)
+REPORT_COLUMNS = [("SortCategory", "Sort", "text"), ("Name", "Name", "link"), ("Edition", "Edition", "text"), ("Condition", "Cond", "text"),
+                  ("IsFoil", "Foil", "text"), ("CardNumber", "Card#", "text"), ("OldCount", "Old#", "text"), ("NewCount", "New#", "text"),
+                  ("TradeCount", "Trade#", "text"), ("OldPrice", "Old$", "money"), ("NewPrice", "New$", "money"),
+                  ("CountChange", "\u0394 Q", "change"), ("PriceChange", "\u0394$", "money-change"), ("TotalChange", "\u03a3\u0394$", "money-change")]
+REPORT_CHUNK_ROWS = 5000  # card table rows formatted and written at a time
+MAIL_MAX_HTML_BYTES = 1024 * 1024  # reports bigger than this get mailed as a summary plus a gzipped attachment, override with "email-max-bytes"
+MAIL_ATTEMPTS = 3  # tries per email before giving up, waiting MAIL_RETRY_SECONDS, then twice that, ... in between
+MAIL_RETRY_SECONDS = 5
+MAIL_TIMEOUT_SECONDS = 60  # for each smtp command
+REPORT_EMAIL_MAX_ROWS = 200  # the email body for a "data" mode or too big report is static, at most this many cards per table, override with "email-max-rows"
+REPORT_GOOD_COLOR = "#8FBC8F"
+REPORT_BAD_COLOR = "#E9967A"
+SORT_CATEGORIES = ["W", "B", "U", "G", "R", "Colorless", "Land", "Gold", "Unknown"]  # how my boxes are organized, in order
 CURRENT_VERSION = "0.0.23"
 HOST_NAME = platform.node()
 
+# per stage metrics for the current run, filled in by stageSpan. startStageSpans clears them at the start of a run
+# startup stages run in threads: each thread nests its own spans, memory peaks go to every open span in any thread
+dictStageSpans = {}
+listOpenSpans = []
+dictSpanSettings = {"profile-dir": None}
+spanLock = threading.RLock()
+
+# identityStoreId's answers, by (db path, device, inode)
+dictIdentityStores = {}
+spanThreadState = threading.local()
+
+# every request goes through one pooled session (per process) so connections get reused, see httpGet. startHttp resets these for a run
+httpState = {"session": None, "pid": None, "endpoints": HTTP_ENDPOINTS, "mode": "live", "cassette-dir": None, "replay-server": None}
+httpMetrics = {}
+httpLock = threading.Lock()
+
+# daemon mode keeps the card library, recent snapshots and merges parsed between requests, see runDaemon. Requests (and the data/ watcher)
+# take turns on daemonRequestLock, residentLock only guards the dicts since a compare reads snapshots on several threads at once
+daemonState = {"resident": False, "card-library": None, "library-key": None, "snapshots": collections.OrderedDict(),
+               "merges": collections.OrderedDict(), "started": None, "requests": 0}
+daemonRequestLock = threading.RLock()
+residentLock = threading.Lock()
+
 
 def makeCookies(cookies):
     """write a dictionary of http cookies to a local file"""
@@ -69,20 +168,404 @@ def eatCookies():
         return json.load(file)
 
 
-def getCardLibrary(libFile):
-    """go get a card json library, write it to disk, unzip it and return it as a Path"""
-    # keep the zip too so we cn compare byte size for updates
-    debug("in getCardLib:" + str(libFile))
-    response = requests.get(MAGIC_CARD_JSON_URL, stream=True)
-    bytes = io.BytesIO(response.content)
+def startHttp(dictConfig):
+    """set up the http layer for a run: endpoint overrides from "http-endpoints", metrics cleared, and the mode from "http-mode":
+    "live" (the default), "record" (every response is also saved in "http-cassette-dir") or "replay" (requests go to a local stand-in
+    serving what was recorded, so a whole run can happen, and be benchmarked, with no network)"""
+    dictEndpoints = {strEndpoint: dict(dictEndpoint, **dictConfig.get("http-endpoints", {}).get(strEndpoint, {}))
+                     for strEndpoint, dictEndpoint in HTTP_ENDPOINTS.items()}
+    for dictEndpoint in dictEndpoints.values():
+        # json only has lists, requests wants a (connect, read) tuple
+        if isinstance(dictEndpoint["timeout"], list):
+            dictEndpoint["timeout"] = tuple(dictEndpoint["timeout"])
+    strMode = dictConfig.get("http-mode", "live")
+    strCassetteDir = dictConfig.get("http-cassette-dir", HTTP_CASSETTE_DIR_NAME).rstrip("/") + "/"
+    if strMode not in ("live", "record", "replay"):
+        raise ValueError("http-mode has to be live, record or replay, not " + str(strMode))
+
+    server = httpState["replay-server"]
+    if server is not None and (strMode != "replay" or server.strCassetteDir != strCassetteDir):
+        server.shutdown()
+        server.server_close()
+        server = None
+    if strMode == "replay" and server is None:
+        if not os.path.isdir(strCassetteDir):
+            raise ValueError("nothing recorded to replay, " + strCassetteDir + " doesn't exist (run with --record-http first)")
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), ReplayHandler)
+        server.strCassetteDir = strCassetteDir
+        threading.Thread(target=server.serve_forever, name="http-replay", daemon=True).start()
+        print("replaying http from " + strCassetteDir + " on port " + str(server.server_address[1]))
+    if strMode == "record":
+        os.makedirs(strCassetteDir, exist_ok=True)
+
+    with httpLock:
+        httpState.update({"endpoints": dictEndpoints, "mode": strMode, "cassette-dir": strCassetteDir, "replay-server": server})
+        httpMetrics.clear()
+
+
+def httpSession():
+    """the shared requests session, connections to each host stay open between requests (keep-alive)
+    a batch worker process gets its own, a pool's sockets can't be shared with a forked child. The session never keeps cookies,
+    Deckbox's come from the cookie file on every request so one collection's can't leak into another's"""
+    with httpLock:
+        if httpState["session"] is None or httpState["pid"] != os.getpid():
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=8)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            session.cookies.set_policy(http.cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+            httpState["session"] = session
+            httpState["pid"] = os.getpid()
+        return httpState["session"]
+
+
+@contextlib.contextmanager
+def httpGet(strEndpoint, strURL, **kwargs):
+    """GET strURL through the shared session with strEndpoint's timeout, trying again on connection errors, timeouts and
+    HTTP_RETRY_STATUSES with exponential backoff. Yields the response (stream=True is fine) and closes it after, counting requests,
+    retries, bytes and time in the endpoint's metrics. Record mode saves the response too, replay mode asks the local stand-in instead"""
+    dictEndpoint = httpState["endpoints"][strEndpoint]
+    strRequestURL = replayURL(strURL) if httpState["mode"] == "replay" else strURL
+    fStart = timer()
+    for intAttempt in range(1, dictEndpoint["attempts"] + 1):
+        fAttemptStart = timer()
+        errLast = None
+        try:
+            response = httpSession().get(strRequestURL, timeout=dictEndpoint["timeout"], **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as err:
+            response = None
+            errLast = err
+        noteHttp(strEndpoint, requests=1, retries=1 if intAttempt > 1 else 0, **{"wait-seconds": timer() - fAttemptStart})
+        if response is not None and response.status_code not in HTTP_RETRY_STATUSES:
+            break
+        if intAttempt == dictEndpoint["attempts"]:
+            noteHttp(strEndpoint, failures=1)
+            if response is None:
+                raise errLast
+            break  # out of tries, the caller gets the error status to deal with
+        fWait = HTTP_RETRY_SECONDS * 2 ** (intAttempt - 1)
+        print(strEndpoint + " request failed (" + (repr(errLast) if response is None else str(response.status_code)) + "), try "
+              + str(intAttempt) + " of " + str(dictEndpoint["attempts"]) + ", trying again in " + str(fWait) + "s")
+        if response is not None:
+            response.close()
+        time.sleep(fWait)
 
-    with open(str(libFile.with_suffix(".zip")), "wb") as file:
-        file.write(bytes.read(-1))
+    try:
+        if httpState["mode"] == "record":
+            recordResponse(response)
+        yield response
+    finally:
+        response.close()
+        noteHttp(strEndpoint, bytes=response.raw.tell() if hasattr(response.raw, "tell") else 0, seconds=timer() - fStart)
+
+
+def noteHttp(strEndpoint, **dictCounts):
+    """add to an endpoint's http metrics"""
+    with httpLock:
+        dictTotals = httpMetrics.setdefault(strEndpoint, {"requests": 0, "retries": 0, "failures": 0, "bytes": 0,
+                                                          "wait-seconds": 0.0, "seconds": 0.0})
+        for strKey, value in dictCounts.items():
+            dictTotals[strKey] += value
+
+
+def httpReport():
+    """the http metrics so far per endpoint: requests, retries, bytes off the wire (still compressed), time waiting for responses to
+    start (latency) and overall, and what that comes to per request and per second"""
+    with httpLock:
+        return {strEndpoint: dict(dictTotals, **{"wait-seconds": round(dictTotals["wait-seconds"], 4), "seconds": round(dictTotals["seconds"], 4),
+                                                 "latency-ms": round(1000 * dictTotals["wait-seconds"] / max(dictTotals["requests"], 1), 1),
+                                                 "mb-per-second": round(dictTotals["bytes"] / 1048576 / dictTotals["seconds"], 3)
+                                                 if dictTotals["seconds"] > 0 else 0.0})
+                for strEndpoint, dictTotals in httpMetrics.items()}
+
+
+def printHttpMetrics():
+    """print a line per endpoint, next to the stage lines it says whether a slow fetch was the network or the server"""
+    for strEndpoint, dictTotals in httpReport().items():
+        print("http " + strEndpoint + ": " + str(dictTotals["requests"]) + " requests, " + str(dictTotals["retries"]) + " retries, "
+              + format(dictTotals["bytes"] / 1048576, ".2f") + "MB in " + format(dictTotals["seconds"], ".3f") + "s ("
+              + str(dictTotals["mb-per-second"]) + "MB/s), " + str(dictTotals["latency-ms"]) + "ms latency")
+
+
+def cassetteKey(strURL, headers):
+    """which recorded response answers a request: the full url (with the query) and the headers that change the answer, not the cookies"""
+    strKey = strURL + "".join("\n" + strHeader + ": " + headers[strHeader] for strHeader in HTTP_CASSETTE_KEY_HEADERS if strHeader in headers)
+    return hashlib.sha1(strKey.encode("utf-8")).hexdigest()
+
+
+def recordResponse(response):
+    """save a response in the cassette dir for replay mode: the body (already un-gzipped) and a json file with the status and headers
+    reads the whole body, the caller can still stream it afterwards. A redirected request is saved under the url that was asked for"""
+    request = response.history[0].request if response.history else response.request
+    strBase = httpState["cassette-dir"] + cassetteKey(request.url, request.headers)
+    dictHeaders = {strName: strValue for strName, strValue in response.headers.items()
+                   if strName.lower() not in ("content-encoding", "content-length", "transfer-encoding", "connection", "set-cookie")}
+    with open(strBase + ".body.tmp", "wb") as file:
+        file.write(response.content)
+    os.replace(strBase + ".body.tmp", strBase + ".body")
+    with open(strBase + ".json.tmp", "w") as file:
+        json.dump({"url": request.url, "status": response.status_code, "headers": dictHeaders,
+                   "gzip": response.headers.get("Content-Encoding", "") == "gzip"}, file, indent=1)
+    os.replace(strBase + ".json.tmp", strBase + ".json")
+    debug("recorded " + request.url + " as " + strBase)
+
+
+def replayURL(strURL):
+    """where a url goes in replay mode: https://deckbox.org/sets/export/1 -> http://127.0.0.1:<port>/https/deckbox.org/sets/export/1"""
+    strScheme, strRest = strURL.split("://", 1)
+    return "http://127.0.0.1:" + str(httpState["replay-server"].server_address[1]) + "/" + strScheme + "/" + strRest
+
+
+class ReplayHandler(http.server.BaseHTTPRequestHandler):
+    """the local stand-in for Deckbox and mtgjson in replay mode, answers with what record mode saved (see recordResponse)
+    gzips the body again if the real server did and the request allows it, so the client side does the same work it would live"""
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        strScheme, strRest = self.path.lstrip("/").split("/", 1)
+        strURL = strScheme + "://" + strRest
+        strCassetteDir = self.server.strCassetteDir
+        # an exact match first, then the same url asked for without conditions (a fresh data dir asks for the library unconditionally)
+        for strKey in (cassetteKey(strURL, self.headers), cassetteKey(strURL, {})):
+            if os.path.exists(strCassetteDir + strKey + ".json"):
+                break
+        else:
+            return self.reply(404, {}, ("nothing recorded for " + strURL + "\n").encode("utf-8"))
+        with open(strCassetteDir + strKey + ".json", "r") as file:
+            dictRecorded = json.load(file)
+        with open(strCassetteDir + strKey + ".body", "rb") as file:
+            bytesBody = file.read()
+        dictHeaders = dict(dictRecorded["headers"])
+        if dictRecorded["gzip"] and "gzip" in self.headers.get("Accept-Encoding", ""):
+            bytesBody = gzip.compress(bytesBody)
+            dictHeaders["Content-Encoding"] = "gzip"
+        self.reply(dictRecorded["status"], dictHeaders, bytesBody)
+
+    def reply(self, intStatus, dictHeaders, bytesBody):
+        self.send_response(intStatus)
+        for strName, strValue in dictHeaders.items():
+            self.send_header(strName, strValue)
+        self.send_header("Content-Length", str(len(bytesBody)))
+        self.end_headers()
+        self.wfile.write(bytesBody)
+
+    def log_message(self, strFormat, *args):
+        debug("replay: " + (strFormat % args))
+
+
+def readLibraryMeta(libZip):
+    """read the validators/checksum kept next to the library zip, empty dict if there aren't any yet"""
+    metaFile = Path(str(libZip) + ".meta.json")
+    if not metaFile.exists():
+        return {}
+    with metaFile.open("r") as file:
+        return json.load(file)
 
-    zip = zipfile.ZipFile(bytes)
 
-    zip.extractall(str(libFile.parent))
-    return libFile
+def writeLibraryMeta(libZip, dictMeta):
+    """write the validators/checksum next to the library zip, via a temp file so it's never half written"""
+    strMetaFileName = str(libZip) + ".meta.json"
+    with open(strMetaFileName + ".tmp", "w") as file:
+        json.dump(dictMeta, file, indent=1)
+    os.replace(strMetaFileName + ".tmp", strMetaFileName)
+
+
+def freshenCardLibrary(libZip, fTTLHours=LIBRARY_TTL_HOURS, strURL=MAGIC_CARD_JSON_URL):
+    """make sure libZip is there and reasonably current, return it as a Path
+    within the TTL nothing touches the network, after that it's a conditional GET with the stored ETag/Last-Modified, so an unchanged library is a 304"""
+    dictMeta = readLibraryMeta(libZip)
+
+    if libZip.exists() and (datetime.datetime.now().timestamp() - dictMeta.get("checked-at", 0)) < fTTLHours * 3600:
+        debug("card lib checked less than " + str(fTTLHours) + " hours ago, not asking again")
+        return libZip
+
+    dictHeaders = {}
+    if libZip.exists():
+        if "etag" in dictMeta:
+            dictHeaders["If-None-Match"] = dictMeta["etag"]
+        if "last-modified" in dictMeta:
+            dictHeaders["If-Modified-Since"] = dictMeta["last-modified"]
+
+    try:
+        getCardLibrary(libZip, dictMeta, dictHeaders, strURL)
+    except (requests.exceptions.RequestException, ValueError) as err:
+        # an old library is only a little wrong about colors, so carry on with it if there is one
+        if not libZip.exists():
+            raise
+        print("couldn't refresh the card lib, using the one I have: " + str(err))
+    return libZip
+
+
+def getCardLibrary(libZip, dictMeta, dictHeaders, strURL=MAGIC_CARD_JSON_URL):
+    """go get the zipped card json library (conditionally, given dictHeaders) and write it to libZip, no need to extract it
+    streams to a .part file, resumes a .part left by an interrupted run with a Range request, checks the published sha256 and renames into place"""
+    debug("in getCardLib:" + str(libZip))
+    partFile = Path(str(libZip) + ".part")
+    intPartSize = partFile.stat().st_size if partFile.exists() else 0
+
+    # only resume if we know which version of the file the partial download belongs to
+    strPartValidator = dictMeta.get("part-etag") or dictMeta.get("part-last-modified")
+    if intPartSize > 0 and strPartValidator:
+        dictHeaders = dict(dictHeaders, **{"Range": "bytes=" + str(intPartSize) + "-", "If-Range": strPartValidator})
+
+    with httpGet("mtgjson", strURL, headers=dictHeaders, stream=True) as response:
+        if response.status_code == 304:
+            debug("card lib not modified since last fetch")
+            dictMeta["checked-at"] = datetime.datetime.now().timestamp()
+            writeLibraryMeta(libZip, dictMeta)
+            return libZip
+        # a 416 to a resume means there's nothing after the part, the last run died between finishing it and renaming it
+        # so it just gets checked and renamed like any other finished download (a bad one fails the checksum and gets deleted)
+        bPartWhole = response.status_code == 416 and "Range" in dictHeaders
+        if not bPartWhole:
+            response.raise_for_status()
+
+        sha = hashlib.sha256()
+        if response.status_code == 206 or bPartWhole:
+            if not bPartWhole and not response.headers.get("Content-Range", "").startswith("bytes " + str(intPartSize) + "-"):
+                partFile.unlink()
+                raise ValueError("card lib server resumed at the wrong place: " + response.headers.get("Content-Range", ""))
+            print("card lib download was already complete, checking it" if bPartWhole else "resuming card lib download at byte " + str(intPartSize))
+            with partFile.open("rb") as file:
+                for chunk in iter(lambda: file.read(1048576), b""):
+                    sha.update(chunk)
+            strMode = "ab"
+        else:
+            print("downloading card lib")
+            strMode = "wb"
+
+        if not bPartWhole:
+            # remember what the partial file is a piece of, before writing any of it, so a later run can resume
+            dictMeta["part-etag"] = response.headers.get("ETag")
+            dictMeta["part-last-modified"] = response.headers.get("Last-Modified")
+            writeLibraryMeta(libZip, dictMeta)
+
+            with partFile.open(strMode) as file:
+                for chunk in response.iter_content(chunk_size=1048576):
+                    sha.update(chunk)
+                    file.write(chunk)
+
+    strExpectedSHA = fetchLibraryChecksum(strURL)
+    if strExpectedSHA is not None and strExpectedSHA != sha.hexdigest():
+        partFile.unlink()
+        raise ValueError("card lib checksum mismatch, expected " + strExpectedSHA + " got " + sha.hexdigest())
+
+    # backup the current file, just in case
+    if libZip.exists():
+        strModDate = datetime.datetime.fromtimestamp(os.path.getmtime(str(libZip))).strftime("%Y%m%d")
+        strBackupName = str(libZip.with_suffix(".json")) + "-" + strModDate + ".zip.bak"
+        print("got a fresh card lib. Backing up current " + str(libZip) + " to: " + strBackupName)
+        shutil.copy2(str(libZip), strBackupName)
+    os.replace(str(partFile), str(libZip))
+
+    writeLibraryMeta(libZip, {"etag": dictMeta.get("part-etag"), "last-modified": dictMeta.get("part-last-modified"),
+                              "sha256": sha.hexdigest(), "size": libZip.stat().st_size,
+                              "checked-at": datetime.datetime.now().timestamp()})
+    return libZip
+
+
+def fetchLibraryChecksum(strURL=MAGIC_CARD_JSON_URL):
+    """mtgjson publishes a .sha256 next to each file, return the hex digest or None if it can't be had"""
+    try:
+        with httpGet("mtgjson-checksum", strURL + ".sha256") as response:
+            strText = response.text if response.status_code == 200 else ""
+    except requests.exceptions.RequestException:
+        return None
+    if not strText.strip():
+        print("no checksum published for the card lib, can't verify it")
+        return None
+    return strText.split()[0].lower()
+
+
+def iterLibraryEntries(stream, intChunkSize=1048576):
+    """yield (card name, card entry) pairs from a card library json text stream, one entry at a time
+    works for AtomicCards ({"meta":..., "data": {name: [faces]}}) and the older flat AllCards ({name: card})
+    only one entry and one chunk of text are ever held, never the whole document"""
+    decoder = json.JSONDecoder()
+    strBuffer = ""
+    intPos = 0
+    bEOF = False
+
+    def more():
+        """pull the next chunk into the buffer, dropping what's been consumed; False at the end of the stream"""
+        nonlocal strBuffer, intPos, bEOF
+        strChunk = "" if bEOF else stream.read(intChunkSize)
+        if not strChunk:
+            bEOF = True
+            return False
+        strBuffer = strBuffer[intPos:] + strChunk
+        intPos = 0
+        return True
+
+    def peek():
+        """skip whitespace and return the next character without consuming it, empty string at the end"""
+        nonlocal intPos
+        while True:
+            while intPos < len(strBuffer) and strBuffer[intPos] in " \t\r\n":
+                intPos += 1
+            if intPos < len(strBuffer):
+                return strBuffer[intPos]
+            if not more():
+                return ""
+
+    def expect(strChar):
+        nonlocal intPos
+        strFound = peek()
+        if strFound != strChar:
+            raise ValueError("card library json: expected '" + strChar + "' but found '" + strFound + "'")
+        intPos += 1
+
+    def value():
+        """decode the next complete json value, reading more of the stream until it fits in the buffer"""
+        nonlocal intPos
+        peek()
+        while True:
+            try:
+                obj, intEnd = decoder.raw_decode(strBuffer, intPos)
+                # a number sitting right at the end of the buffer might have been cut off, so only trust it at eof
+                if intEnd < len(strBuffer) or bEOF:
+                    intPos = intEnd
+                    return obj
+            except json.JSONDecodeError:
+                if bEOF:
+                    raise
+            more()
+
+    def members():
+        """yield each key of the object at the current position, the caller has to consume the value before moving on"""
+        nonlocal intPos
+        expect("{")
+        if peek() == "}":
+            intPos += 1
+            return
+        while True:
+            strKey = value()
+            expect(":")
+            yield strKey
+            strNext = peek()
+            intPos += 1
+            if strNext == "}":
+                return
+            if strNext != ",":
+                raise ValueError("card library json: expected ',' or '}' but found '" + strNext + "'")
+
+    for strKey in members():
+        if strKey == "data":
+            for strName in members():
+                yield strName, value()
+        elif strKey == "meta":
+            value()
+        else:  # old flat AllCards, top level keys are the card names
+            yield strKey, value()
+
+
+def readLibraryZip(libZip):
+    """stream the card library json out of the zip and return the sort index for it, nothing gets extracted to disk"""
+    with zipfile.ZipFile(str(libZip)) as zip:
+        strMember = [name for name in zip.namelist() if name.endswith(".json")][0]
+        debug("streaming " + strMember + " out of " + str(libZip))
+        with zip.open(strMember) as member:
+            return indexLibraryEntries(iterLibraryEntries(io.TextIOWrapper(member, encoding="utf-8")))
 
 
 def cleanCardDataFrame(df):
@@ -96,34 +579,797 @@ def cleanCardDataFrame(df):
         if colName in df.columns:
             del df[colName]
 
-    # convert price to a number (don't care about dollar sign)
-    df["Price"] = df["Price"].str.replace("$", "").str.replace(",", "").astype(float)
+    # convert price to whole cents (don't care about dollar sign), ints add up exactly where float dollars drift
+    df["Price"] = parsePriceCents(df["Price"])
+
+    return compactCardFrame(df)
+
+
+def readDeckboxExport(source, strSource=None):
+    """parse a Deckbox export (a path or a binary stream, read once front to back) straight into a cleaned frame: only the DECKBOX_SCHEMA
+    columns get parsed, already typed, so there's nothing to drop afterwards. Raises ValueError if the export is missing one of them"""
+    strSource = str(source) if strSource is None else strSource
+    df = pandas.read_csv(source, usecols=lambda strCol: strCol in DECKBOX_SCHEMA, dtype=DECKBOX_SCHEMA)
+    listMissing = [strCol for strCol in DECKBOX_SCHEMA if strCol not in df.columns]
+    if len(listMissing) > 0:
+        raise ValueError(strSource + " doesn't look like a Deckbox export, missing columns: " + str(listMissing))
+
+    df = df[list(DECKBOX_SCHEMA)]
+    for strCol in ["Count", "Tradelist Count"]:
+        df[strCol] = parseCounts(df[strCol], strCol, strSource)
+    df["Price"] = parsePriceCents(df["Price"], strSource)
+    return compactCardFrame(df)
 
-    # should be fewer columns now, and price should be a float
-    # df.info()
+
+def parseCounts(seriesCounts, strColumn="counts", strSource="counts"):
+    """vectorized count column -> int32. Anything blank or not a whole number is reported and treated as 0 rather than blowing up the whole run"""
+    arrCounts = pandas.to_numeric(seriesCounts, errors="coerce")
+    seriesBad = seriesCounts[arrCounts.isna() | (arrCounts % 1 != 0)]
+    if len(seriesBad) > 0:
+        print(str(len(seriesBad)) + " blank or malformed " + strColumn + "(s) in " + strSource + ", counting them as 0. First few (row: value): "
+              + ", ".join(str(intRow) + ": " + repr(value) for intRow, value in seriesBad.head(5).items()))
+        arrCounts = arrCounts.where(~seriesCounts.index.isin(seriesBad.index), 0)
+    return arrCounts.astype("int32")
+
+
+def parsePriceCents(seriesPrices, strSource="prices"):
+    """vectorized "$1,234.56" -> 123456 (int32 cents). Blank prices are 0; anything that doesn't parse is reported and treated as 0
+    rather than blowing up the whole run"""
+    if seriesPrices.dtype.kind in "iuf":
+        arrDollars = seriesPrices.astype(float)
+    else:
+        seriesStripped = seriesPrices.astype(object).str.replace(r"[$,\s]", "", regex=True)
+        arrDollars = pandas.to_numeric(seriesStripped, errors="coerce")
+        seriesBad = seriesPrices[arrDollars.isna() & seriesStripped.fillna("").ne("")]
+        if len(seriesBad) > 0:
+            print(str(len(seriesBad)) + " malformed price(s) in " + strSource + ", counting them as $0.00. First few (row: value): "
+                  + ", ".join(str(intRow) + ": " + repr(strValue) for intRow, strValue in seriesBad.head(5).items()))
+    return (arrDollars * 100).round().fillna(0).astype("int32")
+
+
+def compactCardFrame(df):
+    """shrink a card frame in place: repeated strings become categoricals, counts the narrowest int that holds them
+    a big inventory is mostly the same names/editions/conditions over and over, so this is several times smaller"""
+    for strCol in ["Name", "Edition", "Condition", "SortCategory"]:
+        if strCol in df.columns and not isinstance(df[strCol].dtype, pandas.CategoricalDtype):
+            df[strCol] = df[strCol].astype("category")
+    for strCol in ["Count", "Tradelist Count", "OldCount", "NewCount", "TradeCount", "CountChange"]:
+        if strCol in df.columns and df[strCol].dtype.kind in "iu":
+            df[strCol] = pandas.to_numeric(df[strCol], downcast="integer")
     return df
 
 
+def dollars(arrCents):
+    """integer cents -> float dollars, for anything that leaves the script (report, csv, log)"""
+    return numpy.asarray(arrCents) / 100
+
+
+def dollarFrame(df):
+    """copy of a merged frame with the money columns back in dollars, for writing out"""
+    return df.assign(**{strCol: dollars(df[strCol]) for strCol in MONEY_COLUMNS if strCol in df.columns})
+
+
+def readCleanSnapshot(strFileName):
+    """return the cleaned dataframe for a snapshot CSV in data/, from the binary cache if it's still good, otherwise parse the CSV and cache it
+    snapshots that were moved into the snapshot store get rebuilt from it instead. In daemon mode recent ones come from memory"""
+    if daemonState["resident"]:
+        return residentSnapshot(strFileName)
+    return loadCleanSnapshot(strFileName)
+
+
+def loadCleanSnapshot(strFileName):
+    """readCleanSnapshot without the daemon's memory: the binary cache, the snapshot store or the CSV"""
+    if not Path(DATA_DIR_NAME + strFileName).exists() and isStoredSnapshot(strFileName):
+        return readStoredSnapshot(strFileName)
+    df = readSnapshotCache(strFileName)
+    if df is None:
+        debug("no usable cache for " + strFileName + ", parsing the CSV")
+        df = readDeckboxExport(DATA_DIR_NAME + strFileName)
+        df = addCardIds(df)
+        writeSnapshotCache(strFileName, df)
+    return df
+
+
+def snapshotCacheDir(strFileName):
+    return Path(SNAPSHOT_CACHE_DIR_NAME + strFileName)
+
+
+def fileSHA1(strPath):
+    sha = hashlib.sha1()
+    with open(strPath, "rb") as file:
+        for chunk in iter(lambda: file.read(1048576), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def writeSnapshotCache(strFileName, df):
+    """store a cleaned snapshot as one .npy per column, strings as integer codes with the string table in meta.json
+    meta.json is written last, so a half written cache just looks missing"""
+    cacheDir = snapshotCacheDir(strFileName)
+    cacheDir.mkdir(parents=True, exist_ok=True)
+    metaFile = cacheDir / "meta.json"
+    if metaFile.exists():
+        metaFile.unlink()
+
+    strCSV = DATA_DIR_NAME + strFileName
+    statCSV = os.stat(strCSV)
+    dictMeta = {"version": SNAPSHOT_CACHE_VERSION, "identity-store": identityStoreId(),
+                "csv-size": statCSV.st_size, "csv-mtime-ns": statCSV.st_mtime_ns,
+                "csv-sha1": fileSHA1(strCSV), "rows": len(df), "columns": writeFrameColumns(cacheDir, df)}
+
+    with open(str(metaFile) + ".tmp", "w") as file:
+        json.dump(dictMeta, file)
+    os.replace(str(metaFile) + ".tmp", str(metaFile))
+    debug("cached " + strFileName + " in " + str(cacheDir))
+
+
+def writeFrameColumns(cacheDir, df):
+    """save every column of df as a .npy in cacheDir, strings as integer codes, and return the column list that goes in meta.json"""
+    listColumns = []
+    for intCol, strCol in enumerate(df.columns):
+        series = df[strCol]
+        dictCol = {"name": strCol, "file": str(intCol) + ".npy"}
+        if isinstance(series.dtype, pandas.CategoricalDtype):
+            dictCol.update(kind="category", categories=series.cat.categories.tolist(), ordered=bool(series.cat.ordered))
+            arrValues = series.cat.codes.to_numpy()
+        elif series.dtype == object:
+            # factorize gives -1 for missing, which is what from_codes wants on the way back
+            arrCodes, indexUniques = pandas.factorize(series)
+            dictCol.update(kind="object", categories=indexUniques.tolist())
+            arrValues = arrCodes.astype("int32")
+        else:
+            dictCol.update(kind="values")
+            arrValues = series.to_numpy()
+        numpy.save(str(cacheDir / dictCol["file"]), arrValues, allow_pickle=False)
+        listColumns.append(dictCol)
+    return listColumns
+
+
+def readFrameColumns(cacheDir, listColumns):
+    """memory map the columns writeFrameColumns saved back into a dataframe"""
+    dictColumns = {}
+    for dictCol in listColumns:
+        arrValues = numpy.load(str(cacheDir / dictCol["file"]), mmap_mode="r", allow_pickle=False)
+        if dictCol["kind"] == "category":
+            dictColumns[dictCol["name"]] = pandas.Categorical.from_codes(
+                arrValues, categories=dictCol["categories"], ordered=dictCol["ordered"])
+        elif dictCol["kind"] == "object":
+            # one extra slot on the end of the string table so the -1 codes come back as missing
+            arrTable = numpy.array(dictCol["categories"] + [numpy.nan], dtype=object)
+            dictColumns[dictCol["name"]] = arrTable[arrValues]
+        else:
+            dictColumns[dictCol["name"]] = arrValues
+    return pandas.DataFrame(dictColumns, columns=[dictCol["name"] for dictCol in listColumns])
+
+
+def readSnapshotCache(strFileName):
+    """memory map a cached snapshot back into a dataframe, None if there's no cache or the CSV changed since it was made
+    a different mtime alone doesn't invalidate it (copies, touch), only if the CSV's content hash changed too"""
+    cacheDir = snapshotCacheDir(strFileName)
+    metaFile = cacheDir / "meta.json"
+    strCSV = DATA_DIR_NAME + strFileName
+    if not metaFile.exists() or not Path(strCSV).exists():
+        return None
+    with metaFile.open("r") as file:
+        dictMeta = json.load(file)
+
+    statCSV = os.stat(strCSV)
+    if dictMeta.get("version") != SNAPSHOT_CACHE_VERSION or dictMeta["csv-size"] != statCSV.st_size:
+        return None
+    # the cached CardIds only mean something to the history db they came from
+    if dictMeta.get("identity-store") != identityStoreId():
+        return None
+    if dictMeta["csv-mtime-ns"] != statCSV.st_mtime_ns:
+        if dictMeta["csv-sha1"] != fileSHA1(strCSV):
+            return None
+        dictMeta["csv-mtime-ns"] = statCSV.st_mtime_ns
+        with open(str(metaFile) + ".tmp", "w") as file:
+            json.dump(dictMeta, file)
+        os.replace(str(metaFile) + ".tmp", str(metaFile))
+
+    debug("loaded " + strFileName + " from cache")
+    return readFrameColumns(cacheDir, dictMeta["columns"])
+
+
+def snapshotSHA1(strFileName):
+    """content hash of a snapshot CSV in data/, from its cache meta.json when that still matches the file, so it's usually free
+    a stored snapshot still has the hash of the CSV it came from"""
+    strCSV = DATA_DIR_NAME + strFileName
+    if not Path(strCSV).exists() and isStoredSnapshot(strFileName):
+        return readStoreMeta(strFileName)["csv-sha1"]
+    metaFile = snapshotCacheDir(strFileName) / "meta.json"
+    if metaFile.exists():
+        with metaFile.open("r") as file:
+            dictMeta = json.load(file)
+        statCSV = os.stat(strCSV)
+        if dictMeta.get("csv-size") == statCSV.st_size and dictMeta.get("csv-mtime-ns") == statCSV.st_mtime_ns:
+            return dictMeta["csv-sha1"]
+    return fileSHA1(strCSV)
+
+
+def storedKeyframeDir(strFileName):
+    return Path(SNAPSHOT_STORE_DIR_NAME + strFileName + ".key")
+
+
+def storedDeltaFile(strFileName):
+    return Path(SNAPSHOT_STORE_DIR_NAME + strFileName + ".delta.npz")
+
+
+def isStoredSnapshot(strFileName):
+    return (storedKeyframeDir(strFileName) / "meta.json").exists() or storedDeltaFile(strFileName).exists()
+
+
+def snapshotExists(strFileName):
+    """is there a snapshot by this name, as a CSV in data/ or in the snapshot store"""
+    return Path(DATA_DIR_NAME + strFileName).exists() or isStoredSnapshot(strFileName)
+
+
+def snapshotFilePath(strFileName):
+    """the file that holds a snapshot: its CSV, or in the store its delta or keyframe meta.json"""
+    if Path(DATA_DIR_NAME + strFileName).exists() or not isStoredSnapshot(strFileName):
+        return DATA_DIR_NAME + strFileName
+    if storedDeltaFile(strFileName).exists():
+        return str(storedDeltaFile(strFileName))
+    return str(storedKeyframeDir(strFileName) / "meta.json")
+
+
+def storedSnapshots():
+    """names of the snapshots in the store, oldest first"""
+    if not Path(SNAPSHOT_STORE_DIR_NAME).exists():
+        return []
+    setNames = set()
+    for strEntry in os.listdir(SNAPSHOT_STORE_DIR_NAME):
+        if strEntry.endswith(".delta.npz"):
+            setNames.add(strEntry[:-len(".delta.npz")])
+        elif strEntry.endswith(".key") and (Path(SNAPSHOT_STORE_DIR_NAME + strEntry) / "meta.json").exists():
+            setNames.add(strEntry[:-len(".key")])
+    return sorted(setNames)
+
+
+def readStoreMeta(strFileName):
+    """the meta for a stored snapshot: kind (keyframe or delta), base (the snapshot a delta applies to), depth (deltas since the
+    keyframe), rows, csv-sha1 and identity-store"""
+    if storedDeltaFile(strFileName).exists():
+        with numpy.load(str(storedDeltaFile(strFileName)), allow_pickle=False) as npz:
+            return json.loads(str(npz["meta"]))
+    with (storedKeyframeDir(strFileName) / "meta.json").open("r") as file:
+        return json.load(file)
+
+
+def storeSnapshot(strFileName, df=None):
+    """move one snapshot CSV from data/ into the store: a delta against the latest stored snapshot before it, or a keyframe (full
+    columns like the snapshot cache) every SNAPSHOT_KEYFRAME_EVERY snapshots or when there's nothing to be a delta of
+    the CSV is only deleted once what got stored reads back the same as the CSV does. Returns True if it was moved"""
+    if df is None:
+        df = readCleanSnapshot(strFileName)
+    dictMeta = {"version": SNAPSHOT_STORE_VERSION, "csv-sha1": snapshotSHA1(strFileName), "rows": len(df), "identity-store": identityStoreId()}
+    Path(SNAPSHOT_STORE_DIR_NAME).mkdir(parents=True, exist_ok=True)
+
+    listOlder = [strStored for strStored in storedSnapshots() if strStored < strFileName]
+    dictBaseMeta = readStoreMeta(listOlder[-1]) if len(listOlder) > 0 else None
+    if dictBaseMeta is not None and dictBaseMeta["depth"] + 1 < SNAPSHOT_KEYFRAME_EVERY:
+        writeSnapshotDelta(strFileName, df, listOlder[-1], dict(dictMeta, kind="delta", base=listOlder[-1], depth=dictBaseMeta["depth"] + 1))
+        if not readStoredSnapshot(strFileName).equals(df):
+            debug("delta for " + strFileName + " doesn't read back right, storing a keyframe instead")
+            storedDeltaFile(strFileName).unlink()
+    if not storedDeltaFile(strFileName).exists():
+        writeSnapshotKeyframe(strFileName, df, dict(dictMeta, kind="keyframe", depth=0))
+        if not readStoredSnapshot(strFileName).equals(df):
+            print("couldn't store " + strFileName + " so it reads back the same, keeping the CSV")
+            shutil.rmtree(str(storedKeyframeDir(strFileName)), ignore_errors=True)
+            return False
+
+    os.remove(DATA_DIR_NAME + strFileName)
+    shutil.rmtree(str(snapshotCacheDir(strFileName)), ignore_errors=True)
+    registerSnapshot(strFileName)
+    return True
+
+
+def writeSnapshotKeyframe(strFileName, df, dictMeta):
+    """a full copy of a cleaned snapshot, one .npy per column like the snapshot cache, meta.json last"""
+    keyDir = storedKeyframeDir(strFileName)
+    keyDir.mkdir(parents=True, exist_ok=True)
+    dictMeta["columns"] = writeFrameColumns(keyDir, df)
+    with open(str(keyDir / "meta.json") + ".tmp", "w") as file:
+        json.dump(dictMeta, file)
+    os.replace(str(keyDir / "meta.json") + ".tmp", str(keyDir / "meta.json"))
+
+
+def snapshotRowKeys(df):
+    """one int per row that's the same for the same row in any snapshot: the CardId, plus which copy of it this is when deckbox lists
+    a printing more than once"""
+    arrCardIds = df["CardId"].to_numpy(dtype="int64")
+    return (arrCardIds << 16) | df.groupby("CardId", sort=False).cumcount().to_numpy(dtype="int64")
+
+
+def writeSnapshotDelta(strFileName, df, strBaseFileName, dictMeta):
+    """store a snapshot as differences from an already stored one, in one compressed .npz:
+    src-steps, where each row was in the base (-1 for new rows), as steps from the row before, so an unchanged run of rows is all 1s
+    Count, Tradelist Count, Price minus the base row's (the whole value for new rows), mostly 0s
+    added-*, every other column of the new rows (strings with a -missing mask for NaN)"""
+    dfBase = readStoredSnapshot(strBaseFileName)
+    arrSrc = pandas.Index(snapshotRowKeys(dfBase)).get_indexer(snapshotRowKeys(df))
+    arrMatched = arrSrc >= 0
+    dictArrays = {"meta": numpy.array(json.dumps(dictMeta)),
+                  "src-steps": numpy.diff(arrSrc, prepend=0).astype("int32"),
+                  "added-CardId": df["CardId"].to_numpy(dtype="int64")[~arrMatched]}
+    for strCol in SNAPSHOT_DELTA_COLUMNS:
+        arrBase = numpy.zeros(len(df), dtype="int64")
+        arrBase[arrMatched] = dfBase[strCol].to_numpy(dtype="int64")[arrSrc[arrMatched]]
+        dictArrays[strCol] = (df[strCol].to_numpy(dtype="int64") - arrBase).astype("int32")
+    for strCol in SNAPSHOT_IDENTITY_COLUMNS:
+        seriesAdded = df[strCol].astype(object)[~arrMatched]
+        dictArrays["added-" + strCol] = seriesAdded.fillna("").astype(str).to_numpy(dtype=str)
+        dictArrays["added-" + strCol + "-missing"] = seriesAdded.isna().to_numpy()
+    numpy.savez_compressed(str(storedDeltaFile(strFileName)), **dictArrays)
+
+
+def readStoredSnapshot(strFileName):
+    """rebuild a stored snapshot into the same cleaned dataframe readCleanSnapshot gives for its CSV
+    the deltas back to the keyframe get composed first, so it's a handful of array lookups per delta instead of a dataframe each"""
+    listDeltas = []
+    strName = strFileName
+    while storedDeltaFile(strName).exists():
+        with numpy.load(str(storedDeltaFile(strName)), allow_pickle=False) as npz:
+            listDeltas.append({strKey: npz[strKey] for strKey in npz.files})
+        strName = json.loads(str(listDeltas[-1]["meta"]))["base"]
+    with (storedKeyframeDir(strName) / "meta.json").open("r") as file:
+        dictMeta = json.load(file)
+    df = readFrameColumns(storedKeyframeDir(strName), dictMeta["columns"])
+
+    if len(listDeltas) > 0:
+        dfKey = df
+        dictMeta = json.loads(str(listDeltas[0]["meta"]))
+        intRows = len(listDeltas[0]["src-steps"])
+        # where each row of the snapshot is at the level being looked at, newest delta first, down to the keyframe.
+        # a row stops being followed at the delta that added it
+        arrPos = numpy.arange(intRows)
+        arrLive = numpy.ones(intRows, dtype=bool)
+        dictSums = {strCol: numpy.zeros(intRows, dtype="int64") for strCol in SNAPSHOT_DELTA_COLUMNS}
+        dictIdentity = {strCol: numpy.empty(intRows, dtype=object) for strCol in SNAPSHOT_IDENTITY_COLUMNS}
+        arrCardIds = numpy.zeros(intRows, dtype="int64")
+        for dictDelta in listDeltas:
+            for strCol in SNAPSHOT_DELTA_COLUMNS:
+                dictSums[strCol][arrLive] += dictDelta[strCol][arrPos[arrLive]]
+            arrSrc = numpy.cumsum(dictDelta["src-steps"], dtype="int64")
+            arrSrcHere = numpy.full(intRows, -1, dtype="int64")
+            arrSrcHere[arrLive] = arrSrc[arrPos[arrLive]]
+            arrAdded = arrLive & (arrSrcHere < 0)
+            arrAddedAt = (numpy.cumsum(arrSrc < 0) - 1)[arrPos[arrAdded]]
+            arrCardIds[arrAdded] = dictDelta["added-CardId"][arrAddedAt]
+            for strCol in SNAPSHOT_IDENTITY_COLUMNS:
+                arrValues = dictDelta["added-" + strCol].astype(object)
+                arrValues[dictDelta["added-" + strCol + "-missing"]] = numpy.nan
+                dictIdentity[strCol][arrAdded] = arrValues[arrAddedAt]
+            arrLive = arrLive & ~arrAdded
+            arrPos = arrSrcHere
+        for strCol in SNAPSHOT_DELTA_COLUMNS:
+            dictSums[strCol][arrLive] += dfKey[strCol].to_numpy(dtype="int64")[arrPos[arrLive]]
+        for strCol in SNAPSHOT_IDENTITY_COLUMNS:
+            if isinstance(dfKey[strCol].dtype, pandas.CategoricalDtype):
+                dictIdentity[strCol] = combineCategorical(dfKey[strCol].array, arrPos[arrLive], arrLive, dictIdentity[strCol][~arrLive])
+            else:
+                dictIdentity[strCol][arrLive] = dfKey[strCol].to_numpy(dtype=object)[arrPos[arrLive]]
+        arrCardIds[arrLive] = dfKey["CardId"].to_numpy(dtype="int64")[arrPos[arrLive]]
+
+        dictColumns = dict({strCol: dictSums[strCol].astype("int32") for strCol in SNAPSHOT_DELTA_COLUMNS}, **dictIdentity)
+        df = compactCardFrame(pandas.DataFrame(dictColumns, columns=list(DECKBOX_SCHEMA)).assign(CardId=arrCardIds))
+
+    # the CardIds only mean something to the history db they came from
+    if dictMeta["identity-store"] != identityStoreId():
+        df = addCardIds(df.drop(columns="CardId"))
+    debug("rebuilt " + strFileName + " from the snapshot store (" + str(len(listDeltas)) + " deltas)")
+    return df
+
+
+def combineCategorical(catKey, arrKeyRows, arrFromKey, arrOther):
+    """a Categorical with catKey's values at arrKeyRows where arrFromKey is set and arrOther's strings everywhere else, its categories
+    sorted like read_csv makes them. Done on the codes, turning every row back into a string and categorizing again is most of a rebuild"""
+    arrKeyCodes = numpy.asarray(catKey.codes)[arrKeyRows]
+    arrUsed = numpy.unique(arrKeyCodes[arrKeyCodes >= 0])
+    indexCategories = catKey.categories[arrUsed]
+    indexNew = pandas.Index(pandas.unique(arrOther[pandas.notna(arrOther)])).difference(indexCategories)
+    if len(indexNew) > 0:
+        indexCategories = indexCategories.append(indexNew).sort_values()
+    arrRemap = numpy.append(indexCategories.get_indexer(catKey.categories), -1)  # so -1 (missing) stays -1
+    arrCodes = numpy.full(len(arrFromKey), -1, dtype="int64")
+    arrCodes[arrFromKey] = arrRemap[arrKeyCodes]
+    arrCodes[~arrFromKey] = indexCategories.get_indexer(arrOther)
+    return pandas.Categorical.from_codes(arrCodes, categories=indexCategories)
+
+
+def storeOldSnapshots(strTodayFileName):
+    """move every snapshot CSV older than today's into the snapshot store, oldest first (today's stays a CSV so reruns don't refetch it)"""
+    listMoved = [strFileName for strFileName in catalogSnapshots()
+                 if strFileName < strTodayFileName and Path(DATA_DIR_NAME + strFileName).exists() and storeSnapshot(strFileName)]
+    if len(listMoved) > 0:
+        print("moved " + str(len(listMoved)) + " snapshot(s) into the snapshot store")
+    return listMoved
+
+
+def migrateSnapshots():
+    """one time move of every snapshot CSV in data/ except the newest into the snapshot store, run with --migrate-snapshots"""
+    listCardsCSVs = [strFileName for strFileName in rescanSnapshots() if Path(DATA_DIR_NAME + strFileName).exists()]
+    if len(listCardsCSVs) < 2:
+        print("nothing to migrate")
+        return []
+    intBytesBefore = sum(os.path.getsize(DATA_DIR_NAME + strFileName) for strFileName in listCardsCSVs[:-1])
+    listMoved = storeOldSnapshots(listCardsCSVs[-1])
+    intBytesAfter = sum(os.path.getsize(os.path.join(strDir, strFile))
+                        for strDir, listDirs, listFiles in os.walk(SNAPSHOT_STORE_DIR_NAME) for strFile in listFiles)
+    print("snapshot CSVs took " + "{:,.1f}".format(intBytesBefore / 1024 / 1024) + " MB, the whole store takes "
+          + "{:,.1f}".format(intBytesAfter / 1024 / 1024) + " MB")
+    return listMoved
+
+
+def stageCacheKey(strStage, listInputs):
+    """hash of a stage name and everything that goes into it, that's the stage cache's directory name"""
+    strInputs = json.dumps([strStage, STAGE_CACHE_VERSION] + list(listInputs), default=default_numpy)
+    return strStage + "-" + hashlib.sha1(strInputs.encode("utf-8")).hexdigest()
+
+
+def writeStageCache(strKey, df, dictExtra):
+    """keep a stage's output, a dataframe (index and all) plus some json, under its key. meta.json goes last like the snapshot cache"""
+    cacheDir = Path(STAGE_CACHE_DIR_NAME + strKey)
+    cacheDir.mkdir(parents=True, exist_ok=True)
+    metaFile = cacheDir / "meta.json"
+    if metaFile.exists():
+        metaFile.unlink()
+    dfStore = df.copy(deep=False)
+    dfStore.insert(0, "__index__", df.index.to_numpy())
+    dictMeta = {"rows": len(df), "columns": writeFrameColumns(cacheDir, dfStore), "extra": dictExtra}
+    with open(str(metaFile) + ".tmp", "w") as file:
+        json.dump(dictMeta, file, default=default_numpy)
+    os.replace(str(metaFile) + ".tmp", str(metaFile))
+    pruneStageCache()
+
+
+def readStageCache(strKey):
+    """return (dataframe, extra json) a stage saved under strKey, None if it hasn't been done for those inputs"""
+    cacheDir = Path(STAGE_CACHE_DIR_NAME + strKey)
+    metaFile = cacheDir / "meta.json"
+    if not metaFile.exists():
+        return None
+    with metaFile.open("r") as file:
+        dictMeta = json.load(file)
+    os.utime(str(metaFile))  # so pruning keeps what's in use
+    df = readFrameColumns(cacheDir, dictMeta["columns"]).set_index("__index__")
+    df.index.name = None
+    return df, dictMeta["extra"]
+
+
+def pruneStageCache(intKeep=STAGE_CACHE_KEEP):
+    """every new day is new keys, so only keep the most recently used intKeep stage outputs"""
+    listDirs = [cacheDir for cacheDir in Path(STAGE_CACHE_DIR_NAME).iterdir() if (cacheDir / "meta.json").exists()]
+    listDirs.sort(key=lambda cacheDir: (cacheDir / "meta.json").stat().st_mtime_ns, reverse=True)
+    for cacheDir in listDirs[intKeep:]:
+        shutil.rmtree(str(cacheDir), ignore_errors=True)
+
+
+def openHistory():
+    """open (creating if needed) the price history db. Cards are interned once in "cards"; "observations" only gets a row when a card's
+    count/price changes (or it disappears, count 0), and "latest" holds each card's current state so appends never rescan history"""
+    # startup reads today's and the old snapshot at the same time and both intern card ids, so wait on the other's write instead of failing
+    con = sqlite3.connect(HISTORY_DB_FILE_NAME, timeout=60)
+    # the schema and settings only get set up once per db, after that opening is just a pragma read
+    if con.execute("PRAGMA user_version").fetchone()[0] >= HISTORY_SCHEMA_VERSION:
+        return con
+    con.executescript("""
+        CREATE TABLE IF NOT EXISTS cards (card_id INTEGER PRIMARY KEY, name TEXT NOT NULL, edition TEXT NOT NULL,
+            condition TEXT NOT NULL, foil INTEGER NOT NULL, card_number TEXT NOT NULL,
+            UNIQUE (name, edition, condition, foil, card_number));
+        CREATE TABLE IF NOT EXISTS snapshots (snapshot_date TEXT PRIMARY KEY, file_name TEXT NOT NULL, cards INTEGER, imported_at TEXT);
+        CREATE TABLE IF NOT EXISTS observations (card_id INTEGER NOT NULL, snapshot_date TEXT NOT NULL, count INTEGER NOT NULL,
+            trade_count INTEGER NOT NULL, price_cents INTEGER NOT NULL, PRIMARY KEY (card_id, snapshot_date)) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS observations_by_date ON observations (snapshot_date);
+        CREATE TABLE IF NOT EXISTS latest (card_id INTEGER PRIMARY KEY, snapshot_date TEXT NOT NULL, count INTEGER NOT NULL,
+            trade_count INTEGER NOT NULL, price_cents INTEGER NOT NULL);
+        CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT);
+        CREATE TABLE IF NOT EXISTS runs (when_run TEXT PRIMARY KEY, old_file TEXT, new_file TEXT, entry TEXT NOT NULL);
+        CREATE INDEX IF NOT EXISTS runs_by_new_file ON runs (new_file);
+        CREATE INDEX IF NOT EXISTS runs_by_old_file ON runs (old_file);
+        CREATE TABLE IF NOT EXISTS snapshot_files (file_name TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER) WITHOUT ROWID;
+        """)
+    with con:
+        con.execute("INSERT OR IGNORE INTO settings (key, value) VALUES ('identity-store', ?)", (uuid.uuid4().hex,))
+        con.execute("PRAGMA user_version = " + str(HISTORY_SCHEMA_VERSION))
+    return con
+
+
+def identityStoreId():
+    """return the random id the history db got when it was created, anything holding card ids (like the snapshot cache)
+    remembers it, so if the db gets deleted and rebuilt those ids are known to be meaningless
+    it's asked for on every cache read and write, so it's kept per db file (a rebuilt db is a new file, a new inode)"""
+    if not Path(HISTORY_DB_FILE_NAME).exists():
+        openHistory().close()
+    statDB = os.stat(HISTORY_DB_FILE_NAME)
+    tupleKey = (HISTORY_DB_FILE_NAME, statDB.st_dev, statDB.st_ino)
+    if tupleKey not in dictIdentityStores:
+        con = openHistory()
+        try:
+            dictIdentityStores[tupleKey] = con.execute("SELECT value FROM settings WHERE key = 'identity-store'").fetchone()[0]
+        finally:
+            con.close()
+    return dictIdentityStores[tupleKey]
+
+
+def addCardIds(df):
+    """add a CardId column to a cleaned snapshot if it doesn't have one: a stable integer per printing+condition+foil, interned in the
+    history db so the same card gets the same id in every snapshot and merges can join on one int instead of five strings"""
+    if "CardId" not in df.columns:
+        con = openHistory()
+        try:
+            with con:
+                df["CardId"] = internCardIds(con, cardIdentities(df))
+        finally:
+            con.close()
+    return df
+
+
+def cardIdentities(df):
+    """return the identity columns (Name, Edition, Condition, Foil, Card Number) of a cleaned snapshot as plain lists, blanks instead of NaN
+    so they can go in a UNIQUE index (sqlite treats every NULL as different)"""
+    listNames = df["Name"].astype(object).fillna("").tolist()
+    listEditions = df["Edition"].astype(object).fillna("").tolist()
+    listConditions = df["Condition"].astype(object).fillna("").tolist()
+    listFoils = (df["Foil"].astype(object) == "foil").astype(int).tolist()
+    listNumbers = df["Card Number"].astype(object).fillna("").astype(str).tolist()
+    return list(zip(listNames, listEditions, listConditions, listFoils, listNumbers))
+
+
+def internCardIds(con, listIdentities):
+    """return a numpy array of stable integer card ids for identity tuples, adding any cards the db hasn't seen before"""
+    con.executemany("INSERT OR IGNORE INTO cards (name, edition, condition, foil, card_number) VALUES (?, ?, ?, ?, ?)",
+                    set(listIdentities))
+    dictIds = {tuple(row[1:]): row[0] for row in
+               con.execute("SELECT card_id, name, edition, condition, foil, card_number FROM cards")}
+    return numpy.array([dictIds[identity] for identity in listIdentities], dtype="int64")
+
+
+def snapshotDate(strFileName):
+    """YYYYMMDD-magic-cards.csv -> YYYY-MM-DD"""
+    strDate = strFileName.split("-")[0]
+    return strDate[0:4] + "-" + strDate[4:6] + "-" + strDate[6:8]
+
+
+def appendHistory(strFileName, df=None, con=None):
+    """add one snapshot to the history, only the cards whose count or price changed since their last observation get written
+    snapshots have to go in date order, anything at or before the latest imported date is skipped. returns True if it was added"""
+    bClose = con is None
+    if con is None:
+        con = openHistory()
+    try:
+        strDate = snapshotDate(strFileName)
+        strLatestDate = con.execute("SELECT MAX(snapshot_date) FROM snapshots").fetchone()[0]
+        if strLatestDate is not None and strDate <= strLatestDate:
+            debug("history already has " + strLatestDate + ", skipping " + strFileName)
+            return False
+        if df is None:
+            df = readCleanSnapshot(strFileName)
+
+        # deckbox can list the same printing twice, the history keeps one row per card so add those up
+        arrCardIds = df["CardId"].to_numpy() if "CardId" in df.columns else internCardIds(con, cardIdentities(df))
+        dfSnapshot = pandas.DataFrame({"card_id": arrCardIds,
+                                       "count": df["Count"].fillna(0).astype("int64").to_numpy(),
+                                       "trade_count": df["Tradelist Count"].fillna(0).astype("int64").to_numpy(),
+                                       "price_cents": df["Price"].fillna(0).astype("int64").to_numpy()})
+        dfSnapshot = dfSnapshot.groupby("card_id", sort=False).agg(
+            {"count": "sum", "trade_count": "sum", "price_cents": "max"})
+
+        dfLatest = pandas.read_sql_query("SELECT card_id, count, trade_count, price_cents FROM latest WHERE count > 0",
+                                         con, index_col="card_id")
+        # cards that disappeared get a zero count observation so "collection at a date" knows they're gone
+        dfGone = dfLatest.loc[dfLatest.index.difference(dfSnapshot.index)].assign(count=0, trade_count=0)
+        dfCompare = dfSnapshot.join(dfLatest, rsuffix="_last", how="left")
+        arrChanged = ((dfCompare["count"] != dfCompare["count_last"]) | (dfCompare["trade_count"] != dfCompare["trade_count_last"])
+                      | (dfCompare["price_cents"] != dfCompare["price_cents_last"])).to_numpy()
+        dfChanges = pandas.concat([dfSnapshot[arrChanged], dfGone])
+
+        listRows = [(int(intId), strDate, int(intCount), int(intTrade), int(intCents)) for intId, intCount, intTrade, intCents in
+                    zip(dfChanges.index, dfChanges["count"], dfChanges["trade_count"], dfChanges["price_cents"])]
+        with con:
+            con.executemany("INSERT INTO observations (card_id, snapshot_date, count, trade_count, price_cents) VALUES (?, ?, ?, ?, ?)",
+                            listRows)
+            con.executemany("INSERT OR REPLACE INTO latest (card_id, snapshot_date, count, trade_count, price_cents) VALUES (?, ?, ?, ?, ?)",
+                            listRows)
+            con.execute("INSERT INTO snapshots (snapshot_date, file_name, cards, imported_at) VALUES (?, ?, ?, ?)",
+                        (strDate, strFileName, len(dfSnapshot), datetime.datetime.now().isoformat()))
+        debug("history: " + strFileName + " added " + str(len(listRows)) + " changes for " + str(len(dfSnapshot)) + " cards")
+        return True
+    finally:
+        if bClose:
+            con.close()
+
+
+def importHistory():
+    """one time bulk import of every snapshot CSV already sitting in data/, oldest first, returns how many got added"""
+    con = openHistory()
+    try:
+        listCardsCSVs = rescanSnapshots()
+        intAdded = sum(1 for strFileName in listCardsCSVs if appendHistory(strFileName, con=con))
+        print("imported " + str(intAdded) + " snapshots into the history")
+        return intAdded
+    finally:
+        con.close()
+
+
+def updateHistory(strFileName, df):
+    """end of run history update, the first time there's no history yet it back fills from the CSVs already in data/
+    (the db itself is usually there already by now, the card ids for the merge come from it)"""
+    con = openHistory()
+    try:
+        bEmpty = con.execute("SELECT 1 FROM snapshots LIMIT 1").fetchone() is None
+    finally:
+        con.close()
+    if bEmpty:
+        importHistory()
+    else:
+        appendHistory(strFileName, df)
+
+
+def cardHistory(strName, strEdition=None, strCondition=None, bFoil=None, strCardNumber=None):
+    """return a dataframe with one row per snapshot per matching card (Date, identity, Count, TradeCount, Price), from the card's first
+    appearance on. Anything left as None matches everything, so just a name gets every printing of it"""
+    listWhere = ["c.name = ?"]
+    listParams = [strName]
+    for strColumn, value in (("c.edition", strEdition), ("c.condition", strCondition), ("c.foil", bFoil), ("c.card_number", strCardNumber)):
+        if value is not None:
+            listWhere.append(strColumn + " = ?")
+            listParams.append(int(value) if strColumn == "c.foil" else value)
+
+    con = openHistory()
+    try:
+        dfChanges = pandas.read_sql_query(
+            "SELECT o.card_id, o.snapshot_date, o.count, o.trade_count, o.price_cents, c.name, c.edition, c.condition, c.foil, c.card_number"
+            " FROM cards c JOIN observations o ON o.card_id = c.card_id WHERE " + " AND ".join(listWhere)
+            + " ORDER BY o.card_id, o.snapshot_date", con, params=listParams)
+        listDates = [row[0] for row in con.execute("SELECT snapshot_date FROM snapshots ORDER BY snapshot_date")]
+    finally:
+        con.close()
+
+    # only changes are stored, so carry each one forward through the snapshots in between
+    listSeries = []
+    for intId, dfCard in dfChanges.groupby("card_id"):
+        dfCard = dfCard.set_index("snapshot_date")
+        listSeries.append(dfCard.reindex([strDate for strDate in listDates if strDate >= dfCard.index[0]]).ffill())
+    if len(listSeries) == 0:
+        return pandas.DataFrame(columns=["Date", "Name", "Edition", "Condition", "Foil", "CardNumber", "Count", "TradeCount", "Price"])
+    return formatHistoryFrame(pandas.concat(listSeries).rename_axis("snapshot_date").reset_index())
+
+
+def collectionAt(strDate):
+    """return the whole collection as of a date (YYYY-MM-DD, the latest snapshot on or before it), one row per card that was in it"""
+    con = openHistory()
+    try:
+        # CROSS JOIN makes sqlite walk the cards and seek each one's last observation, instead of scanning every observation
+        dfCards = pandas.read_sql_query(
+            "SELECT o.card_id, o.snapshot_date, o.count, o.trade_count, o.price_cents, c.name, c.edition, c.condition, c.foil, c.card_number"
+            " FROM cards c CROSS JOIN observations o ON o.card_id = c.card_id"
+            " AND o.snapshot_date = (SELECT MAX(snapshot_date) FROM observations WHERE card_id = c.card_id AND snapshot_date <= ?)"
+            " WHERE o.count > 0 ORDER BY c.name, c.edition", con, params=[strDate])
+    finally:
+        con.close()
+    return formatHistoryFrame(dfCards)
+
+
+def formatHistoryFrame(df):
+    """rename history db columns to the names the rest of the script uses, prices back to dollars"""
+    df = df.rename(columns={"snapshot_date": "Date", "name": "Name", "edition": "Edition", "condition": "Condition", "foil": "Foil",
+                            "card_number": "CardNumber", "count": "Count", "trade_count": "TradeCount"})
+    df["Price"] = df["price_cents"] / 100
+    df["Foil"] = df["Foil"].astype(bool)
+    df = df.astype({"Count": "int64", "TradeCount": "int64"})
+    return df[["Date", "Name", "Edition", "Condition", "Foil", "CardNumber", "Count", "TradeCount", "Price"]].reset_index(drop=True)
+
+
+def openRunLog():
+    """open the history db for run log work, the first time moving the old run-log.json into it"""
+    con = openHistory()
+    if Path(RUN_LOG_FILE_NAME).exists():
+        migrateRunLog(con)
+    return con
+
+
+def migrateRunLog(con):
+    """one time copy of every entry in run-log.json into the runs table, then the json gets renamed out of the way (kept as a backup)"""
+    with open(RUN_LOG_FILE_NAME, "r") as file:
+        dictRunLog = json.load(file)
+    with con:
+        for strTimestampKey, dictLogEntry in dictRunLog.items():
+            insertRun(con, strTimestampKey, dictLogEntry)
+    os.replace(RUN_LOG_FILE_NAME, RUN_LOG_FILE_NAME + ".migrated")
+    print("moved " + str(len(dictRunLog)) + " runs from " + RUN_LOG_FILE_NAME + " into the history db")
+
+
+def insertRun(con, strTimestampKey, dictLogEntry):
+    con.execute("INSERT OR REPLACE INTO runs (when_run, old_file, new_file, entry) VALUES (?, ?, ?, ?)",
+                (strTimestampKey, dictLogEntry.get("old-file"), dictLogEntry.get("new-file"), json.dumps(dictLogEntry, default=default_numpy)))
+
+
 def readRunLog():
-    """read the runLog, runlog has when-run (YYYYMMDDHHMMSS), old-file, new-file
-    why json? because I want to be able to sort and add elements and hierarchies and stuff if I want, and trying to work more with json"""
+    """read the whole runLog as a dict of when-run (YYYYMMDD-HH:MM:SS:ffffff) -> entry with old-file, new-file, stats etc, oldest first
+    only for poking around, a run only needs lastRun()"""
     debug("reading the log")
-    dictRunLog = {}
-    if Path(RUN_LOG_FILE_NAME).exists():
-        with open(RUN_LOG_FILE_NAME, "r") as file:
-            dictRunLog = json.load(file)
-    debug("current run log: " + str(dictRunLog))
-    return dictRunLog
+    con = openRunLog()
+    try:
+        return {strTimestampKey: json.loads(strEntry) for strTimestampKey, strEntry in
+                con.execute("SELECT when_run, entry FROM runs ORDER BY when_run")}
+    finally:
+        con.close()
 
 
 def writeRunLog(strTimestampKey, dictLogEntry):
-    """write out the runLog, runlog has when-run (YYYYMMDDHHMMSS), old-file, new-file
-    overwriting this file every time kind of worries me, so I'm going to read the current file, merge over it with what is passed and write combined back out"""
+    """add one entry to the runLog. it's a single insert in a transaction, so a crash can lose this run's entry but never the rest of the log"""
     debug("writing the log")
-    dictRunLog = readRunLog()
-    dictRunLog[strTimestampKey] = dictLogEntry
-    with open(RUN_LOG_FILE_NAME, "w") as file:
-        json.dump(dictRunLog, file, default=default_numpy)
+    con = openRunLog()
+    try:
+        with con:
+            insertRun(con, strTimestampKey, dictLogEntry)
+    finally:
+        con.close()
+
+
+def lastRun():
+    """return the most recent run log entry, None if nothing's been logged yet. The timestamp keys sort in time order, so this is one index seek"""
+    con = openRunLog()
+    try:
+        row = con.execute("SELECT entry FROM runs ORDER BY when_run DESC LIMIT 1").fetchone()
+        return None if row is None else json.loads(row[0])
+    finally:
+        con.close()
+
+
+def runsForFile(strFileName):
+    """return the run log entries (when-run -> entry) that used strFileName, as today's file or the one compared against"""
+    con = openRunLog()
+    try:
+        return {strTimestampKey: json.loads(strEntry) for strTimestampKey, strEntry in
+                con.execute("SELECT when_run, entry FROM runs WHERE new_file = ? UNION SELECT when_run, entry FROM runs WHERE old_file = ? "
+                            "ORDER BY when_run", (strFileName, strFileName))}
+    finally:
+        con.close()
+
+
+def registerSnapshot(strFileName, con=None):
+    """add (or refresh) a snapshot CSV in data/ (or the snapshot store) to the catalog, so picking files to compare doesn't have to list the directory"""
+    conOpened = openHistory() if con is None else con
+    try:
+        statFile = os.stat(snapshotFilePath(strFileName))
+        with conOpened:
+            conOpened.execute("INSERT OR REPLACE INTO snapshot_files (file_name, size, mtime_ns) VALUES (?, ?, ?)",
+                              (strFileName, statFile.st_size, statFile.st_mtime_ns))
+    finally:
+        if con is None:
+            conOpened.close()
+
+
+def rescanSnapshots():
+    """sync the catalog with what's actually in data/ and the snapshot store, the one place that still lists the directories
+    Returns the snapshots, oldest first"""
+    listCardsCSVs = sorted(set(filter(lambda x: str(x).endswith("magic-cards.csv"), os.listdir(DATA_DIR_NAME))) | set(storedSnapshots()))
+    con = openHistory()
+    try:
+        with con:
+            con.execute("DELETE FROM snapshot_files")
+        for strFileName in listCardsCSVs:
+            registerSnapshot(strFileName, con)
+    finally:
+        con.close()
+    debug("rescanned " + DATA_DIR_NAME + ", " + str(len(listCardsCSVs)) + " snapshots")
+    return listCardsCSVs
+
+
+def catalogSnapshots():
+    """return the snapshot CSV names in data/, oldest first (the names start with the date), straight from the catalog
+    the first time there's no catalog yet, so the directory gets scanned once"""
+    con = openHistory()
+    try:
+        listCardsCSVs = [row[0] for row in con.execute("SELECT file_name FROM snapshot_files ORDER BY file_name")]
+    finally:
+        con.close()
+    if len(listCardsCSVs) == 0:
+        listCardsCSVs = rescanSnapshots()
+    return listCardsCSVs
 
 
 def default_numpy(o):
@@ -132,63 +1378,34 @@ def default_numpy(o):
     raise TypeError("Can't understand the object type <" + str(type(o)) + "> for object " + str(o))
 
 
-def determineCompareFile(dictRunLog):
-    """figure out what the right file is to compare current file to, pass in fun file dict, return a file that exists in data
-    the compare file should be the oldest, or the "new-file" from the last run log"""
-
-    # sort run log by old-file
-    dictRunLog = sorted(dictRunLog.items(), key=itemgetter(0))
-    runLogSize = len(dictRunLog)
-    # print("size run log: " + str(runLogSize)+ str(dictRunLog) + "::::" + str(dictRunLog[runLogSize-1][1]["old-file"]))
+def determineCompareFile(dictLastRun):
+    """figure out what the right file is to compare current file to, pass in the last run log entry (None if there isn't one), return a
+    file that exists in data. the compare file should be the oldest, or the "new-file" from the last run log"""
 
     lastCompared = None
     lastNew = None
-
-    # get the last item in the run log to find the last old-file
-    if runLogSize > 0:
-        lastCompared = dictRunLog[runLogSize - 1][1]["old-file"]
-        lastNew = dictRunLog[runLogSize - 1][1]["new-file"]
+    if dictLastRun is not None:
+        lastCompared = dictLastRun["old-file"]
+        lastNew = dictLastRun["new-file"]
 
     debug("LastCompared: " + str(lastCompared))
     debug("LastNewFile: " + str(lastNew))
 
-    # find all the csvs in data/
-    listCardsCSVs = list(filter(lambda x: str(x).endswith(
-        "magic-cards.csv"), os.listdir(DATA_DIR_NAME)))
-    # sort them all, oldest to newest by file name
-    listCardsCSVs = sorted(listCardsCSVs)
-
-    debug("listCardsCSVs:" + str(len(listCardsCSVs)) + str(listCardsCSVs))
+    # all the csvs in data/, oldest to newest, from the catalog
+    listCardsCSVs = catalogSnapshots()
+    debug("listCardsCSVs:" + str(len(listCardsCSVs)))
 
-    # find the lastCompared in list, default to -1 if no match
-    indexLastCompared = None
-    indexLastNew = None
-    try:
-        indexLastCompared = listCardsCSVs.index(lastCompared)
-        indexLastNew = listCardsCSVs.index(lastNew)
-    except ValueError:
-        indexLastCompared = -1
-        indexLastNew = -1
-
-    debug("indexLastCompared: (-1 means I've never compared this file) " + str(indexLastCompared))
-    debug("indexLastNew: (-1 means I've never compared this file) " + str(indexLastNew))
-
-    # if there's no last new match in the directory, use the oldest
-    if (indexLastNew == -1):
-        toCompareFileName = listCardsCSVs[0]
-    else:
+    # if the last run's files aren't around anymore (or it never ran), use the oldest
+    if lastNew in listCardsCSVs and lastCompared in listCardsCSVs:
         toCompareFileName = lastNew
+    else:
+        toCompareFileName = listCardsCSVs[0]
 
-    # Check the next card csv file up chronologically
-    # indexToCompare = indexLastCompared+1
-    # there should not be a situation where there's not a file after the last compared, but if so, just run against the latest file
-    # if (indexToCompare >= len(listCardsCSVs)):
-    #    indexToCompare = len(listCardsCSVs)-1
-
-    # debug("indexToCompare" + str(indexToCompare))
-
-    # toCompareFileName = listCardsCSVs[indexToCompare]
-    # print("toCompareFileName: " + str(toCompareFileName))
+    # somebody cleaned up data/ behind the catalog's back, look at what's really there and try again
+    if not snapshotExists(toCompareFileName):
+        print("snapshot catalog is out of date (" + toCompareFileName + " is gone), rescanning " + DATA_DIR_NAME)
+        rescanSnapshots()
+        return determineCompareFile(dictLastRun)
     return toCompareFileName
 
 
@@ -219,27 +1436,133 @@ def debug(msg):
     logger.debug(msg)
 
 
-def makeMushedKey(row):
-    """"Return a unique key based on a row, sortcat+name+edition+condition+foil+cardNumber"""
-    return row["SortCategory"] + "-" + row["Name"] + "-" + row["Edition"] + "-" + row["Condition"] + "-" + str(row["CardNumber"]) + "-" + str(row["IsFoil"])
+def startStageSpans(bTraceMemory=False, strProfileDir=None):
+    """start collecting stage metrics for a run. tracemalloc makes pandas several times slower so peak memory per stage is opt-in,
+    strProfileDir also gets a cProfile dump per stage"""
+    with spanLock:
+        dictStageSpans.clear()
+        del listOpenSpans[:]
+        del threadSpans()[:]
+        dictSpanSettings["profile-dir"] = strProfileDir
+    if strProfileDir is not None:
+        os.makedirs(strProfileDir, exist_ok=True)
+    if bTraceMemory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def threadSpans():
+    """the spans open in this thread, innermost last"""
+    if not hasattr(spanThreadState, "listSpans"):
+        spanThreadState.listSpans = []
+    return spanThreadState.listSpans
+
+
+def notePeakMemory():
+    """fold the traced peak since the last check into every open span, then start a new peak. spans nest, so this is what keeps an inner
+    span's reset from hiding the outer span's peak. tracemalloc is process wide, so spans running at the same time share their peaks"""
+    with spanLock:
+        intPeakBytes = tracemalloc.get_traced_memory()[1]
+        for dictSpan in listOpenSpans:
+            dictSpan["peak-bytes"] = max(dictSpan["peak-bytes"], intPeakBytes)
+        tracemalloc.reset_peak()
+
+
+def maxRSSMB():
+    """high water mark of the whole process so far in MB, cheap enough to take for every span. Linux reports KB, macs bytes"""
+    intMaxRSS = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return intMaxRSS / (1048576 if platform.system() == "Darwin" else 1024)
+
+
+@contextlib.contextmanager
+def stageSpan(strStage, intRows=None):
+    """time one stage of a run: wall time, cpu time (of this thread), process memory high water mark, and peak traced memory if tracing is on
+    yields a dict, set ["rows"] in it for how many rows the stage handled. spans nest (categorize runs inside merge) and the same
+    stage more than once in a run (horizons) adds up"""
+    dictSpan = {"rows": intRows}
+    listThreadSpans = threadSpans()
+    bTracing = tracemalloc.is_tracing()
+    if bTracing:
+        notePeakMemory()
+        dictSpan["start-bytes"] = tracemalloc.get_traced_memory()[0]
+        dictSpan["peak-bytes"] = dictSpan["start-bytes"]
+    if dictSpanSettings["profile-dir"] is not None:
+        # only one profiler can run at a time (per thread), so the enclosing stage's pauses while this one runs
+        if len(listThreadSpans) > 0 and "profiler" in listThreadSpans[-1]:
+            listThreadSpans[-1]["profiler"].disable()
+        dictSpan["profiler"] = cProfile.Profile()
+        dictSpan["profiler"].enable()
+    with spanLock:
+        listOpenSpans.append(dictSpan)
+    listThreadSpans.append(dictSpan)
+    fWallStart = timer()
+    fCPUStart = time.thread_time()
+    try:
+        yield dictSpan
+    finally:
+        fWallSeconds = timer() - fWallStart
+        fCPUSeconds = time.thread_time() - fCPUStart
+        if "profiler" in dictSpan:
+            dictSpan["profiler"].disable()
+        if bTracing:
+            notePeakMemory()
+        listThreadSpans.pop()
+        with spanLock:
+            listOpenSpans[:] = [dictOpen for dictOpen in listOpenSpans if dictOpen is not dictSpan]
+            if "profiler" in dictSpan:
+                intCall = dictStageSpans.get(strStage, {}).get("calls", 0) + 1
+                dictSpan["profiler"].dump_stats(dictSpanSettings["profile-dir"] + strStage + ("-" + str(intCall) if intCall > 1 else "") + ".prof")
+
+            dictTotals = dictStageSpans.setdefault(strStage, {"calls": 0, "wall-seconds": 0.0, "cpu-seconds": 0.0})
+            dictTotals["calls"] += 1
+            dictTotals["wall-seconds"] += fWallSeconds
+            dictTotals["cpu-seconds"] += fCPUSeconds
+            dictTotals["max-rss-mb"] = round(maxRSSMB(), 1)
+            if bTracing:
+                dictTotals["peak-mb"] = max(dictTotals.get("peak-mb", 0), round((dictSpan["peak-bytes"] - dictSpan["start-bytes"]) / 1048576, 2))
+            if dictSpan["rows"] is not None:
+                dictTotals["rows"] = dictTotals.get("rows", 0) + int(dictSpan["rows"])
+        if "profiler" in dictSpan and len(listThreadSpans) > 0 and "profiler" in listThreadSpans[-1]:
+            listThreadSpans[-1]["profiler"].enable()
+
+
+def stageSpanReport():
+    """the stage metrics so far, rounded, in the order they first finished (so an inner stage comes before the one it ran inside)"""
+    with spanLock:
+        return {strStage: dict(dictTotals, **{"wall-seconds": round(dictTotals["wall-seconds"], 4), "cpu-seconds": round(dictTotals["cpu-seconds"], 4)})
+                for strStage, dictTotals in dictStageSpans.items()}
+
+
+def printStageSpans():
+    """print a line per stage, wall vs cpu is the quick way to tell waiting on the network from grinding in pandas"""
+    for strStage, dictTotals in stageSpanReport().items():
+        print(strStage + ": " + format(dictTotals["wall-seconds"], ".3f") + "s wall, " + format(dictTotals["cpu-seconds"], ".3f")
+              + "s cpu" + (", " + str(dictTotals["rows"]) + " rows" if "rows" in dictTotals else "")
+              + (", " + str(dictTotals["peak-mb"]) + "MB peak" if "peak-mb" in dictTotals else "")
+              + ", " + str(dictTotals["max-rss-mb"]) + "MB max rss")
+
+
+def writeMetricsFile(strMetricsFileName, dictLogEntry):
+    """append the run's log entry (stages and all) as one json line, for graphing run times without parsing the run log"""
+    with open(strMetricsFileName, "a") as file:
+        file.write(json.dumps(dictLogEntry, default=default_numpy) + "\n")
 
 
 def updateRowStats(row, dictStats):
-    """Update count/price stats for a row; deltas are calculated from the stats dictionary with mushedKeys as key"""
-    key = makeMushedKey(row)
+    """Update count/price stats for a row; deltas are calculated from the stats dictionary with the CardId as key"""
+    key = row["CardId"]
 
-    oldCount = 0.0
+    oldCount = 0
     if pandas.notnull(row["OldCount"]):
-        oldCount = row["OldCount"]
-    newCount = 0.0
+        oldCount = int(row["OldCount"])
+    newCount = 0
     if pandas.notnull(row["NewCount"]):
-        newCount = row["NewCount"]
-    oldPrice = 0.0
+        newCount = int(row["NewCount"])
+    oldPrice = 0
     if pandas.notnull(row["OldPrice"]):
-        oldPrice = row["OldPrice"]
-    newPrice = 0.0
+        oldPrice = int(row["OldPrice"])
+    newPrice = 0
     if pandas.notnull(row["NewPrice"]):
-        newPrice = row["NewPrice"]
+        newPrice = int(row["NewPrice"])
     countChange = newCount - oldCount
     priceChange = newPrice - oldPrice
 
@@ -252,7 +1575,7 @@ def updateRowStats(row, dictStats):
                       "new-price": row["NewPrice"]}
 
     # for debugging purposes, I like to look at certain cards
-    if key.startswith("XXXAether Hub"):
+    if row["Name"] == "XXXAether Hub":
         print(str(row))
         print(str(dictStats[key]))
         print("newPrice: " + str(newPrice) + ":" + str(row["NewPrice"]))
@@ -283,13 +1606,13 @@ def printStats(dict, label="Unknown"):
     print("total items: " + str(len(list)))
     print("netInventoryQuantityChange:" + str(int(netInventoryQuantityChange)) + "; cardsIncreasedValue: "
           + str(quantityChangePositive) + "; cardsDecreasedValue: " + str(quantityChangeNegative))
-    print("netValueChange: " + "${:,.2f}".format(netValueChange) + "; grossPositive: "
-          + "${:,.2f}".format(totalGain) + "; grossNegative: " + "${:,.2f}".format(totalLoss))
+    print("netValueChange: " + "${:,.2f}".format(netValueChange / 100) + "; grossPositive: "
+          + "${:,.2f}".format(totalGain / 100) + "; grossNegative: " + "${:,.2f}".format(totalLoss / 100))
 
 
-def stringStats(df):
-    """returns a string of stats for a card query derived data frame; totalquantity change, total price change, number cards, number up, number down"""
-    df = calcStatsDict(df)
+def stringStats(stats):
+    """returns a string of stats for a card query derived data frame (or an already calculated stats dict); totalquantity change, total price change, number cards, number up, number down"""
+    df = calcStatsDict(stats) if isinstance(stats, pandas.DataFrame) else stats
 
     strStats = "Total cards: {total-cards} ({total-inventory} inv, net: {net-inventory-change-quantity}).".format(**df)
     strStats += " Changed quantity: {number-change-quantity}; Net: {net-change-quantity} ({net-inventory-change-quantity} inv). Gross increased: {count-positive-quantity}; Gross decreased: {count-negative-quantity}.".format(
@@ -301,9 +1624,9 @@ def stringStats(df):
     return strStats
 
 
-def htmlStats(df):
-    """sometimes I want a dataframe's stats formatted up for html"""
-    df = calcStatsDict(df)
+def htmlStats(stats):
+    """sometimes I want a dataframe's stats (or an already calculated stats dict) formatted up for html"""
+    df = calcStatsDict(stats) if isinstance(stats, pandas.DataFrame) else stats
 
     html = "<table border=1 class=\"stats\" style=\"font-size : 16px\">"
     html += "<tr><td>"
@@ -327,112 +1650,168 @@ def htmlStats(df):
 
 def calcStatsDict(df):
     """returns a dictionary of a data frame's general stats; totalquantity change, total price change, number cards, number up, number down"""
-    netInventoryQuantityChange = df["CountChange"].sum()
-    quantityChangeNegative = df[df["CountChange"] < 0]["CountChange"].count()
-    quantityChangePositive = df[df["CountChange"] > 0]["CountChange"].count()
-    totalChangeQuantity = quantityChangeNegative + quantityChangePositive
-    netChangeQuantity = quantityChangePositive - quantityChangeNegative
-
-    priceChangeNegative = df[df["OldPrice"]
-                             > df["NewPrice"]]["NewCount"].count()
-    priceChangePositive = df[df["OldPrice"]
-                             < df["NewPrice"]]["NewCount"].count()
-    totalPriceChange = priceChangeNegative + priceChangePositive
-    netPriceChange = priceChangePositive - priceChangeNegative
-    totalInventoryPriceChangeNegative = df[df["OldPrice"]
-                                           > df["NewPrice"]]["NewCount"].sum()
-    totalInventoryPriceChangePositive = df[df["OldPrice"]
-                                           < df["NewPrice"]]["NewCount"].sum()
-    totalInventoryPriceChange = totalInventoryPriceChangeNegative + \
-        totalInventoryPriceChangePositive
-    netInventoryPriceChange = totalInventoryPriceChangePositive - \
-        totalInventoryPriceChangeNegative
-
-    totalInventory = df["NewCount"].sum()
-
-    totalValue = df.eval("NewCount*NewPrice").sum()
-    netValueChange = df["TotalChange"].sum()
-    totalGain = df[df["TotalChange"] > 0]["TotalChange"].sum()
-    totalLoss = df[df["TotalChange"] < 0]["TotalChange"].sum()
-
-    return {"total-cards": len(df), "total-inventory": totalInventory,
-            "number-change-quantity": totalChangeQuantity, "net-change-quantity": netChangeQuantity,
-            "net-inventory-change-quantity": netInventoryQuantityChange,
-            "count-negative-quantity": quantityChangeNegative, "count-positive-quantity": quantityChangePositive,
-            "count-negative-price": priceChangeNegative, "count-positive-price": priceChangePositive,
-            "number-change-price": totalPriceChange, "net-change-price": netPriceChange,
-            "total-inventory-price-negative": totalInventoryPriceChangeNegative, "total-inventory-price-positive": totalInventoryPriceChangePositive,
-            "number-inventory-change-price": totalInventoryPriceChange, "net-inventory-change-price": netInventoryPriceChange,
-            "net-value-change": netValueChange, "total-gain": totalGain, "total-loss": totalLoss, "total-value": totalValue}
-
-
-def buildCardLibrary():
-    """URLFetch or build from disk (if same as remote) the AllCards library and return dict representation of the AllCards.json file"""
-
-    # now let's make sure that there's the most recent card library in json format
-    cardLibraryFile = Path(DATA_DIR_NAME + "AllCards.json")
-    debug("magic card lib file:" + str(cardLibraryFile)
-          + ":" + str(cardLibraryFile.exists()))
-    cardLibraryDict = None
-
-    # if we don't have the file yet, go get it
-    if not cardLibraryFile.exists():
-        print("no card db")
-        cardLibraryFile = getCardLibrary(cardLibraryFile)
-        print("lib file after :" + str(cardLibraryFile))
-
-        # print(cardLibraryDict)
+    return statsDictFromTable(calcStatsTable(df), "all")
+
+
+def calcStatsTable(df, buckets=None):
+    """returns a dataframe of general stats (same keys as calcStatsDict) with one row per bucket plus an "all" row
+    every stat is a sum of something per row, so it's one pass to build the per row terms and one grouped sum over them"""
+    # everything in int64 so narrow counts can't overflow when summed, money stays in cents until statsDictFromTable
+    arrCountChange = df["CountChange"].to_numpy(dtype="int64")
+    arrTotalChange = df["TotalChange"].to_numpy(dtype="int64")
+    arrNewCount = df["NewCount"].to_numpy(dtype="int64")
+    arrPriceDown = (df["OldPrice"] > df["NewPrice"]).to_numpy()
+    arrPriceUp = (df["OldPrice"] < df["NewPrice"]).to_numpy()
+
+    dfTerms = pandas.DataFrame({
+        "total-cards": numpy.ones(len(df), dtype="int64"),
+        "total-inventory": arrNewCount,
+        "net-inventory-change-quantity": arrCountChange,
+        "count-negative-quantity": (arrCountChange < 0).astype("int64"),
+        "count-positive-quantity": (arrCountChange > 0).astype("int64"),
+        "count-negative-price": arrPriceDown.astype("int64"),
+        "count-positive-price": arrPriceUp.astype("int64"),
+        "total-inventory-price-negative": numpy.where(arrPriceDown, arrNewCount, 0),
+        "total-inventory-price-positive": numpy.where(arrPriceUp, arrNewCount, 0),
+        "total-value": arrNewCount * df["NewPrice"].to_numpy(dtype="int64"),
+        "net-value-change": arrTotalChange,
+        "total-gain": numpy.where(arrTotalChange > 0, arrTotalChange, 0),
+        "total-loss": numpy.where(arrTotalChange < 0, arrTotalChange, 0)}, index=df.index)
+
+    if buckets is None:
+        dfStats = dfTerms.sum().to_frame("all").T
     else:
-        debug("card db exists")
-
-        # check to make sure is most recent
-        localZip = cardLibraryFile.with_suffix(".zip")
-        localZipSize = localZip.stat().st_size
-        debug("localZipSize " + str(localZipSize))
-
-        # check the header from json url
-        head = requests.head(MAGIC_CARD_JSON_URL)
-        remoteZipSize = int(head.headers["Content-Length"])
-        debug("remoteZipSize content-length " + str(remoteZipSize))
-
-        # only fetch if local (from a previous fetch) is a different size
-        if (localZipSize != remoteZipSize):
-            # backup the current file, just in case
-            timestampMod = os.path.getmtime(str(cardLibraryFile))
-            dtMod = datetime.datetime.fromtimestamp(timestampMod)
-            strModDate = dtMod.strftime("%Y%m%d")
-            strBackupName = DATA_DIR_NAME + \
-                os.path.basename(str(cardLibraryFile)) + "-" + \
-                strModDate + ".zip.bak"
-            print(
-                "not equal size, let's get a fresh card lib. Backing up current " + str(localZip) + " to: " + strBackupName)
-            shutil.move(str(localZip), strBackupName)
-            cardLibraryFile = getCardLibrary(cardLibraryFile)
-
-    with cardLibraryFile.open() as file:
-        cardLibraryDict = json.load(file)
-
-    return cardLibraryDict
+        dfStats = dfTerms.groupby(buckets, observed=False).sum()
+        dfStats.loc["all"] = dfStats.sum()
+    dfStats = dfStats.astype({strCol: dfTerms[strCol].dtype for strCol in dfTerms.columns})
+
+    # the rest are just combinations of the sums
+    dfStats["number-change-quantity"] = dfStats["count-negative-quantity"] + dfStats["count-positive-quantity"]
+    dfStats["net-change-quantity"] = dfStats["count-positive-quantity"] - dfStats["count-negative-quantity"]
+    dfStats["number-change-price"] = dfStats["count-negative-price"] + dfStats["count-positive-price"]
+    dfStats["net-change-price"] = dfStats["count-positive-price"] - dfStats["count-negative-price"]
+    dfStats["number-inventory-change-price"] = dfStats["total-inventory-price-negative"] + dfStats["total-inventory-price-positive"]
+    dfStats["net-inventory-change-price"] = dfStats["total-inventory-price-positive"] - dfStats["total-inventory-price-negative"]
+    return dfStats
+
+
+def statsDictFromTable(dfStats, strBucket):
+    """pull one bucket's row out of a calcStatsTable as a plain dictionary, counts stay ints and money goes from cents to dollars"""
+    return {strCol: int(dfStats.at[strBucket, strCol]) / 100 if strCol in MONEY_STATS else int(dfStats.at[strBucket, strCol])
+            for strCol in dfStats.columns}
+
+
+def buildCardLibrary(fTTLHours=LIBRARY_TTL_HOURS):
+    """URLFetch or reuse from disk (if same as remote) the AllCards library zip and return dict of card name to sort category
+    parsing the full json is slow and huge, so the categories are kept in a compact index that only gets rebuilt when the zip changes"""
+
+    # now let's make sure that there's a recent enough card library zip
+    with stageSpan("library-check"):
+        libraryZip = freshenCardLibrary(Path(LIBRARY_ZIP_FILE_NAME), fTTLHours)
+    debug("magic card lib zip:" + str(libraryZip))
+
+    # the index is keyed on the zip we downloaded, so a new library version means a rebuild
+    with stageSpan("library-load") as span:
+        strLibraryKey = libraryVersionKey(libraryZip)
+        dictSortIndex = readSortIndex(strLibraryKey)
+        if dictSortIndex is None:
+            print("building sort index for library version " + strLibraryKey)
+            dictSortIndex = readLibraryZip(libraryZip)
+            writeSortIndex(dictSortIndex, strLibraryKey)
+        span["rows"] = len(dictSortIndex)
+
+    return dictSortIndex
+
+
+def libraryVersionKey(libZip):
+    """return a string that changes whenever the downloaded library zip changes, size+mtime is plenty and doesn't need a read"""
+    if not libZip.exists():
+        return "missing"
+    statZip = libZip.stat()
+    return str(statZip.st_size) + "-" + str(statZip.st_mtime_ns)
+
+
+def buildSortIndex(dictLib):
+    """project an already loaded card library (AllCards or AtomicCards shaped) down to a dict of card name to sort category"""
+    # AtomicCards nests everything under "data", the older AllCards didn't
+    return indexLibraryEntries(dictLib.get("data", dictLib).items())
+
+
+def indexLibraryEntries(iterEntries):
+    """build the dict of card name to sort category from (name, entry) pairs, only colors/types/face names are looked at
+    face names (like the halves of split cards) get indexed too, but a real card with the same name always wins"""
+    dictSortIndex = {}
+    dictFaces = {}
+    for strName, card in iterEntries:
+        dictSortIndex[strName] = categorizeCard(card)
+        for dictFace in (card if isinstance(card, list) else []):
+            strFaceName = dictFace.get("faceName")
+            if strFaceName is not None and strFaceName != strName:
+                dictFaces.setdefault(strFaceName, categorizeCard(dictFace))
+    for strFaceName, strCategory in dictFaces.items():
+        dictSortIndex.setdefault(strFaceName, strCategory)
+    return dictSortIndex
+
+
+def writeSortIndex(dictSortIndex, strLibraryKey, strIndexFileName=SORT_INDEX_FILE_NAME):
+    """write the sort index as a compact file: magic line, library key line, category table line, then one "code<tab>name" line per card
+    written to a temp file and renamed so a crash can't leave half an index behind"""
+    listCategories = sorted(set(dictSortIndex.values()))
+    dictCodes = {strCategory: intCode for intCode, strCategory in enumerate(listCategories)}
+    strTempFileName = strIndexFileName + ".tmp"
+    with open(strTempFileName, "w", encoding="utf-8", newline="\n") as file:
+        file.write(SORT_INDEX_MAGIC + "\n" + strLibraryKey + "\n" + "\t".join(listCategories) + "\n")
+        file.writelines(str(dictCodes[strCategory]) + "\t" + strName + "\n" for strName, strCategory in dictSortIndex.items())
+    os.replace(strTempFileName, strIndexFileName)
+    debug("wrote sort index of " + str(len(dictSortIndex)) + " cards to " + strIndexFileName)
+
+
+def readSortIndex(strLibraryKey, strIndexFileName=SORT_INDEX_FILE_NAME):
+    """read the sort index back into a dict of card name to sort category, a line at a time
+    returns None if there's no index or it was built from a different library version (then only the header gets read)"""
+    if not Path(strIndexFileName).exists() or os.path.getsize(strIndexFileName) == 0:
+        return None
+    with open(strIndexFileName, "r", encoding="utf-8", newline="\n") as file:
+        listHeader = [file.readline().rstrip("\n") for intLine in range(3)]
+        if listHeader[0] != SORT_INDEX_MAGIC or listHeader[1] != strLibraryKey:
+            debug("sort index is stale or unreadable, need to rebuild")
+            return None
+        listCategories = listHeader[2].split("\t")
+        dictSortIndex = {}
+        for strLine in file:
+            strCode, strName = strLine.rstrip("\n").split("\t", 1)
+            dictSortIndex[strName] = listCategories[int(strCode)]
+    return dictSortIndex
+
+
+def categorizeCard(card):
+    """figure out the sort category for one library entry, in: card dict (or AtomicCards list of faces, or an already indexed category)
+    out: string category. I organize as White/Black/Blue/Green/Red/Colorless/Land/Gold/Unknown"""
+    if isinstance(card, str):  # already categorized by the sort index
+        return card
+    if isinstance(card, list):  # AtomicCards keeps a list of faces, the first face decides
+        if len(card) == 0:
+            return "Unknown"
+        card = card[0]
+    listColors = card.get("colors", [])
+    if len(listColors) > 1:
+        return "Gold"
+    elif len(listColors) == 1:
+        return listColors[0]
+    # colorless could be Land or other colorless (Art, Eldrazi, whatever)
+    if "Land" in card.get("types", []):
+        return "Land"
+    return "Colorless"
 
 
 def lookupSortCategory(strCardName, dictLib):
-    """"Figure out the card sort category based on the card name, look up in AllCards lib
+    """"Figure out the card sort category based on the card name, look up in AllCards lib or the sort index
     # in:card name
     # out: string category. I organize as White/Black/Blue/Green/Red/Colorless/Land/Gold/Unknown"""
     strSortCategory = "Unknown"
     dictCard = dictLib.get(strCardName)
     if dictCard is not None:
-        listColors = dictCard.get("colors", {})
-        if len(listColors) > 1:
-            strSortCategory = "Gold"
-        elif len(listColors) == 1:
-            strSortCategory = listColors[0]
-        elif len(listColors) == 0:  # colorless could be Land or other colorless (Art, Eldrazi, whatever)
-            listTypes = dictCard.get("types", {})
-            if "Land" in listTypes:
-                strSortCategory = "Land"
-            else:
-                strSortCategory = "Colorless"
+        strSortCategory = categorizeCard(dictCard)
     else:  # maybe if we can't find it there's something special
         # cards with split names are stored weird in AllCards
         if strCardName.find("//") > -1:
@@ -441,29 +1820,61 @@ def lookupSortCategory(strCardName, dictLib):
     return strSortCategory
 
 
-def buildMergeDF(dfNew, dfOld):
+def categorizeNames(seriesNames, dictLib, dictNameCache=None):
+    """assign sort categories to a column of card names, returns an ordered categorical series in SORT_CATEGORIES order
+    collections have the same name over and over (editions, conditions, foils), so each distinct name is only looked up once
+    pass the same dictNameCache to several calls (like comparing against several old files) and names are only looked up once across all of them"""
+    arrNameCodes, indexUniqueNames = pandas.factorize(seriesNames)
+    dictCategoryCodes = {strCategory: intCode for intCode, strCategory in enumerate(SORT_CATEGORIES)}
+    intUnknown = dictCategoryCodes["Unknown"]
+    if dictNameCache is None:
+        dictNameCache = {}
+
+    listUniqueCategoryCodes = []
+    for strName in indexUniqueNames:
+        if strName not in dictNameCache:
+            dictNameCache[strName] = dictCategoryCodes.get(lookupSortCategory(strName, dictLib), intUnknown)
+        listUniqueCategoryCodes.append(dictNameCache[strName])
+    arrUniqueCategoryCodes = numpy.array(listUniqueCategoryCodes, dtype="int8")
+    # factorize gives -1 for missing names, those are just Unknown
+    arrCategoryCodes = numpy.full(len(arrNameCodes), intUnknown, dtype="int8")
+    arrFound = arrNameCodes >= 0
+    arrCategoryCodes[arrFound] = arrUniqueCategoryCodes[arrNameCodes[arrFound]]
+
+    debug("categorized " + str(len(seriesNames)) + " names with " + str(len(indexUniqueNames)) + " lookups")
+    return pandas.Series(pandas.Categorical.from_codes(arrCategoryCodes, categories=SORT_CATEGORIES, ordered=True),
+                         index=seriesNames.index, name="SortCategory")
+
+
+def buildMergeDF(dfNew, dfOld, dictCardLibrary=None, dictNameCache=None, bWriteMerged=True):
     """perform the merge and post merge clean and prep to ready for processing
-    in:dataframe with today's cards, dataframe with comparison cards
+    in:dataframe with today's cards, dataframe with comparison cards, sort index (goes and gets it if not passed in),
+    name->category cache to share between merges, whether to write last-merged.csv
     out:dataframe ready for processing"""
 
-    # merge with a double outer join of old and new
-    dfMergeCards = pandas.merge(dfNew, dfOld, how="outer", on=[
-                                "Name", "Edition", "Foil", "Condition", "Card Number"], suffixes=("_New", "_Old"))
-    dfMergeCards = dfMergeCards[["Name", "Edition", "Condition",
-                                 "Foil", "Card Number", "Count", "OldCount", "Price", "OldPrice", "Tradelist Count_New"]]
+    dfNew = addCardIds(dfNew)
+    dfOld = addCardIds(dfOld)
+
+    # merge with a double outer join of old and new on the integer card id, then hang the name/edition/etc back on once per card
+    dfMergeCards = pandas.merge(dfNew[["CardId", "Count", "Price", "Tradelist Count"]], dfOld[["CardId", "OldCount", "OldPrice"]],
+                                how="outer", on="CardId")
+    dfIdentities = pandas.concat([dfNew[["CardId"] + CARD_IDENTITY_COLUMNS], dfOld[["CardId"] + CARD_IDENTITY_COLUMNS]])
+    dfIdentities = dfIdentities.drop_duplicates("CardId").set_index("CardId")
+    dfMergeCards = dfMergeCards.join(dfIdentities, on="CardId")
+    dfMergeCards = dfMergeCards[["CardId", "Name", "Edition", "Condition",
+                                 "Foil", "Card Number", "Count", "OldCount", "Price", "OldPrice", "Tradelist Count"]]
     dfMergeCards = dfMergeCards.rename(index=str, columns={
-                                       "Foil": "IsFoil", "Card Number": "CardNumber", "Count": "NewCount", "Price": "NewPrice", "Tradelist Count_New": "TradeCount"})
+                                       "Foil": "IsFoil", "Card Number": "CardNumber", "Count": "NewCount", "Price": "NewPrice", "Tradelist Count": "TradeCount"})
 
     # clean up foil flag
-    dfMergeCards["IsFoil"].fillna(False, inplace=True)
-    dfMergeCards["IsFoil"] = dfMergeCards["IsFoil"].replace("foil", True)
+    dfMergeCards["IsFoil"] = dfMergeCards["IsFoil"].astype(object).eq("foil")
 
     # clean up null values in old set for new cards, set up a new field for new cards
     dfMergeCards["OldCount"].fillna(-1, inplace=True)
     dfMergeCards["OldCount"] = dfMergeCards["OldCount"].astype("int")
     dfMergeCards.eval("IsNew = (OldCount == -1)", inplace=True)
     dfMergeCards.loc[dfMergeCards["OldCount"] == -1, "OldCount"] = 0
-    dfMergeCards["OldPrice"].fillna(0.0, inplace=True)
+    dfMergeCards["OldPrice"] = dfMergeCards["OldPrice"].fillna(0).astype("int32")
 
     # clean up trade counts
     dfMergeCards["TradeCount"].fillna(0, inplace=True)
@@ -474,28 +1885,33 @@ def buildMergeDF(dfNew, dfOld):
     dfMergeCards["NewCount"] = dfMergeCards["NewCount"].astype("int")
     dfMergeCards.eval("IsGone = (NewCount == -1)", inplace=True)
     dfMergeCards.loc[dfMergeCards["NewCount"] == -1, "NewCount"] = 0
-    dfMergeCards["NewPrice"].fillna(0.0, inplace=True)
+    dfMergeCards["NewPrice"] = dfMergeCards["NewPrice"].fillna(0).astype("int32")
 
     # add some explicit columns for convenience in the log csv. Don't think I need these ultimately because of querying
-    dfMergeCards.eval("CountChange = (NewCount - OldCount)", inplace=True)
-    dfMergeCards.eval("PriceChange = (NewPrice - OldPrice)", inplace=True)
-    dfMergeCards.eval(
-        "TotalChange = ((NewPrice*NewCount) - (OldPrice*OldCount))", inplace=True)
+    # prices are cents; the total goes through int64 so a pile of expensive cards can't overflow
+    dfMergeCards["CountChange"] = dfMergeCards["NewCount"] - dfMergeCards["OldCount"]
+    dfMergeCards["PriceChange"] = dfMergeCards["NewPrice"] - dfMergeCards["OldPrice"]
+    dfMergeCards["TotalChange"] = (dfMergeCards["NewPrice"].astype("int64") * dfMergeCards["NewCount"]
+                                   - dfMergeCards["OldPrice"].astype("int64") * dfMergeCards["OldCount"])
+    dfMergeCards = compactCardFrame(dfMergeCards)
 
-    dictCardLibrary = buildCardLibrary()
-    debug("dictCardLibrary length: " + str(len(dictCardLibrary)))
+    if dictCardLibrary is None:
+        dictCardLibrary = buildCardLibrary()
+    debug("dictCardLibrary (sort index) length: " + str(len(dictCardLibrary)))
 
-    # set a new column called SortCategory with categories how I organize my cards
-    dfMergeCards["SortCategory"] = dfMergeCards["Name"].apply(
-        lookupSortCategory, args=(dictCardLibrary,))
+    # set a new column called SortCategory with categories how I organize my cards, ordered so the sort below follows my boxes
+    with stageSpan("categorize", len(dfMergeCards)):
+        dfMergeCards["SortCategory"] = categorizeNames(dfMergeCards["Name"], dictCardLibrary, dictNameCache)
 
     # reorder the columns how I like them
     dfMergeCards = dfMergeCards[["SortCategory", "Name", "Edition", "Condition", "IsFoil", "CardNumber", "OldCount",
-                                 "NewCount", "TradeCount", "OldPrice", "NewPrice", "IsNew", "IsGone", "CountChange", "PriceChange", "TotalChange"]]
+                                 "NewCount", "TradeCount", "OldPrice", "NewPrice", "IsNew", "IsGone", "CountChange", "PriceChange", "TotalChange",
+                                 "CardId"]]
 
     dfMergeCards = dfMergeCards.sort_values(by=["SortCategory", "Name"])
 
-    dfMergeCards.to_csv(DATA_DIR_NAME + "last-merged.csv")
+    if bWriteMerged:
+        dollarFrame(dfMergeCards).to_csv(DATA_DIR_NAME + "last-merged.csv")
     print("Comparing #TodayRecords to #CompareRecords in #MergedRecords"
           + str(len(dfNew)) + ":" + str(len(dfOld)) + ":" + str(len(dfMergeCards)))
     return dfMergeCards
@@ -504,39 +1920,147 @@ def buildMergeDF(dfNew, dfOld):
 def updateRunLog(
         strOldFileName, strNewFileName, dtScriptStart, dtScriptEnd, dictResultStats):
     """write a new log entry to the run log"""
+    dictLogEntry = runLogEntry(strOldFileName, strNewFileName, dtScriptStart, dtScriptEnd, dictResultStats)
+    # dictRunLog[dtScriptStart.strftime("%Y%m%d-%H:%M:%S:%f")] = dictLogEntry
+    # print(str(dictRunLog[dtScriptStart.strftime("%Y%m%d-%H:%M:%S:%f")]))
+    writeRunLog(dtScriptStart.strftime("%Y%m%d-%H:%M:%S:%f"), dictLogEntry)
+
 
+def runLogEntry(strOldFileName, strNewFileName, dtScriptStart, dtScriptEnd, dictResultStats):
+    """build the log entry for a run: files, timing (overall and per stage so far), version, host and the result stats"""
     dictLogEntry = {"old-file": strOldFileName, "new-file": strNewFileName,
                     "elapsed-time": (dtScriptEnd.timestamp() - dtScriptStart.timestamp()),
                     "card-check-version": CURRENT_VERSION,
-                    "host-name": HOST_NAME}
+                    "host-name": HOST_NAME,
+                    "stages": stageSpanReport(),
+                    "http": httpReport()}
     dictLogEntry.update(dictResultStats)
-    # dictRunLog[dtScriptStart.strftime("%Y%m%d-%H:%M:%S:%f")] = dictLogEntry
-    # print(str(dictRunLog[dtScriptStart.strftime("%Y%m%d-%H:%M:%S:%f")]))
-    writeRunLog(dtScriptStart.strftime("%Y%m%d-%H:%M:%S:%f"), dictLogEntry)
+    return dictLogEntry
+
+
+# smtp connections stay open between emails (several reports, several recipients), keyed by server and account
+dictMailConnections = {}
+mailState = {"executor": None, "futures": []}
+
+
+def mailConnection(dictConfig):
+    """return a logged in smtp connection for this config, the pooled one if the server still answers, otherwise a new one"""
+    tupleKey = (dictConfig["outgoing-smtp"], dictConfig["smtp-port"], dictConfig.get("smtp-account-user"))
+    server = dictMailConnections.get(tupleKey)
+    if server is not None:
+        try:
+            if server.noop()[0] == 250:
+                return server
+        except (smtplib.SMTPException, OSError):
+            pass
+        dropMailConnection(tupleKey)
+
+    server = smtplib.SMTP(host=dictConfig["outgoing-smtp"], port=dictConfig["smtp-port"], timeout=MAIL_TIMEOUT_SECONDS)
+    # "smtp-starttls": false and no account are only for a local test server
+    if dictConfig.get("smtp-starttls", True):
+        server.starttls()
+    if dictConfig.get("smtp-account-user"):
+        server.login(dictConfig["smtp-account-user"], dictConfig["smtp-account-pass"])
+    dictMailConnections[tupleKey] = server
+    return server
+
+
+def dropMailConnection(tupleKey):
+    """forget a pooled connection, closing it as politely as it'll let us"""
+    server = dictMailConnections.pop(tupleKey, None)
+    if server is None:
+        return
+    try:
+        server.quit()
+    except (smtplib.SMTPException, OSError):
+        server.close()
+
 
+def closeMailConnections():
+    """done mailing, close every pooled connection"""
+    for tupleKey in list(dictMailConnections):
+        dropMailConnection(tupleKey)
 
-def sendMail(strHTML, dictConfig):
-    """send an email message using configuration parameters"""
 
-    # start = datetime.datetime.now().timestamp()
-    server = smtplib.SMTP(
-        host=dictConfig["outgoing-smtp"], port=dictConfig["smtp-port"])
-    # print(str(datetime.datetime.now().timestamp()-start))
-    server.starttls()
-    # print(str(datetime.datetime.now().timestamp()-start))
-    server.login(dictConfig["smtp-account-user"],
-                 dictConfig["smtp-account-pass"])
-    # print(str(datetime.datetime.now().timestamp()-start))
+def buildMailMessage(strHTML, dictConfig, strSummaryHTML=None, strAttachmentName="report.htm.gz"):
+    """the email for a report. small static reports go inline like always. Given a summary, or when the report is bigger than
+    "email-max-bytes", the body is the summary (or a note) and the full report is attached gzipped, html compresses ~10x"""
     message = MIMEMultipart()
     message["from"] = dictConfig["from-email"]
     message["to"] = dictConfig["to-email"]
     message["subject"] = "Card comparison, go sort some cards"
-    # print(str(datetime.datetime.now().timestamp()-start))
-    message.attach(MIMEText(strHTML, "html"))
-    server.send_message(message)
-    # print(str(datetime.datetime.now().timestamp()-start))
-    server.quit()
-    # print(str(datetime.datetime.now().timestamp()-start))
+    bytesHTML = strHTML.encode("utf-8")
+    intMaxBytes = dictConfig.get("email-max-bytes", MAIL_MAX_HTML_BYTES)
+    if strSummaryHTML is None and len(bytesHTML) <= intMaxBytes:
+        message.attach(MIMEText(strHTML, "html"))
+        return message
+
+    if strSummaryHTML is None:
+        strSummaryHTML = ("<p>The report is " + "{:,.1f}".format(len(bytesHTML) / 1024 / 1024)
+                          + " MB, too big to send inline, it's attached (" + strAttachmentName + ")</p>")
+    message.attach(MIMEText(strSummaryHTML, "html"))
+    attachment = MIMEApplication(gzip.compress(bytesHTML), "gzip")
+    attachment.add_header("Content-Disposition", "attachment", filename=strAttachmentName)
+    message.attach(attachment)
+    return message
+
+
+def sendMail(strHTML, dictConfig, strSummaryHTML=None, strAttachmentName="report.htm.gz"):
+    """send an email message using configuration parameters, over the pooled connection
+    tries MAIL_ATTEMPTS times with a growing wait for things like a dropped connection or a 4xx, a 5xx or refused recipient is final"""
+    message = buildMailMessage(strHTML, dictConfig, strSummaryHTML, strAttachmentName)
+    tupleKey = (dictConfig["outgoing-smtp"], dictConfig["smtp-port"], dictConfig.get("smtp-account-user"))
+    for intAttempt in range(MAIL_ATTEMPTS):
+        try:
+            mailConnection(dictConfig).send_message(message)
+            return
+        except smtplib.SMTPRecipientsRefused:
+            raise
+        except (smtplib.SMTPException, OSError) as err:
+            if isinstance(err, smtplib.SMTPResponseException) and err.smtp_code >= 500:
+                raise
+            dropMailConnection(tupleKey)
+            if intAttempt == MAIL_ATTEMPTS - 1:
+                raise
+            fWait = MAIL_RETRY_SECONDS * 2 ** intAttempt
+            print("mail didn't go (" + repr(err) + "), trying again in " + str(fWait) + " seconds")
+            time.sleep(fWait)
+
+
+def queueMail(strHTML, dictConfig, strSummaryHTML=None, strAttachmentName="report.htm.gz"):
+    """send the email on a background thread so the rest of the run carries on, finishMail waits for it. one thread, so emails go in order
+    over the one pooled connection"""
+    if mailState["executor"] is None:
+        mailState["executor"] = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="card-check-mail")
+
+    def sendInSpan():
+        with stageSpan("mail"):
+            sendMail(strHTML, dictConfig, strSummaryHTML, strAttachmentName)
+
+    future = mailState["executor"].submit(sendInSpan)
+    mailState["futures"].append(future)
+    return future
+
+
+def finishMail(fTimeout=None):
+    """wait for queued email (by default long enough for every retry to time out), close the connections, raise RuntimeError if any didn't go"""
+    if mailState["executor"] is None:
+        return
+    if fTimeout is None:
+        fTimeout = MAIL_TIMEOUT_SECONDS + MAIL_ATTEMPTS * (MAIL_TIMEOUT_SECONDS + MAIL_RETRY_SECONDS * 2 ** MAIL_ATTEMPTS)
+    listFutures = mailState["futures"]
+    concurrent.futures.wait(listFutures, timeout=fTimeout)
+    mailState["executor"].shutdown(wait=False, cancel_futures=True)
+    mailState["executor"] = None
+    mailState["futures"] = []
+    closeMailConnections()
+
+    listFailures = [future.exception() if future.done() else None for future in listFutures
+                    if not future.done() or future.exception() is not None]
+    for err in listFailures:
+        print("email didn't go out: " + ("still sending after " + str(fTimeout) + " seconds" if err is None else repr(err)))
+    if len(listFailures) > 0:
+        raise RuntimeError(str(len(listFailures)) + " of " + str(len(listFutures)) + " emails didn't go out") from listFailures[0]
 
 
 def loopDataFrame(df):
@@ -569,13 +2093,13 @@ def loopDataFrame(df):
     rowsProcessed = 0
 
     timeLoopStart = timer()
-    for row in df.iterrows():
+    for index, row in df.iterrows():
         # print(str(index) + ":" + str(row))
         # is this a new card? This should not require any updates. Since new cards are already categorized
         updateRowStats(row, dictGeneralStats)
         if row["IsNew"]:
             debug("New (not in the old file):" + str(row))
-            # dictNewCards[makeMushedKey(row)] = [{"Count":row["NewCount"],"Price":row["NewPrice"]}]
+            # dictNewCards[row["CardId"]] = [{"Count":row["NewCount"],"Price":row["NewPrice"]}]
             updateRowStats(row, dictNewCards)
             rowsProcessed += 1
         elif row["IsGone"]:
@@ -584,11 +2108,11 @@ def loopDataFrame(df):
             rowsProcessed += 1
         else:
             # check for changes to trade
-            if row["NewPrice"] >= TRADE_BOX_THRESHOLD:
+            if row["NewPrice"] >= TRADE_BOX_THRESHOLD * 100:
                 # print(f"NewPrice is over {TRADE_BOX_THRESHOLD}: " + str(row))
                 # if new>TRADE_BOX_THRESHOLD &old<TRADE_BOX_THRESHOLD,this means new item for trade box
-                if row["OldPrice"] < TRADE_BOX_THRESHOLD:
-                    if row["OldPrice"] < BULK_BOX_THRESHOLD:  # if new>TRADE_BOX_THRESHOLD&old<BULK_BOX_THRESHOLD,upgrade from bulk
+                if row["OldPrice"] < TRADE_BOX_THRESHOLD * 100:
+                    if row["OldPrice"] < BULK_BOX_THRESHOLD * 100:  # if new>TRADE_BOX_THRESHOLD&old<BULK_BOX_THRESHOLD,upgrade from bulk
                         updateRowStats(row, dictBulkToTrade)
                     else:  # if it's not going to trade then it's going to dollar
                         updateRowStats(row, dictDollarToTrade)
@@ -597,24 +2121,24 @@ def loopDataFrame(df):
                     updateRowStats(row, dictUnchangedCards)
                     rowsProcessed += 1
             # change for changes to dollar
-            elif row["NewPrice"] >= BULK_BOX_THRESHOLD:
+            elif row["NewPrice"] >= BULK_BOX_THRESHOLD * 100:
                 # if new>BULK_BOX_THRESHOLD&old>TRADE_BOX_THRESHOLD, downgrade from trades to dollar
-                if row["OldPrice"] >= TRADE_BOX_THRESHOLD:
+                if row["OldPrice"] >= TRADE_BOX_THRESHOLD * 100:
                     updateRowStats(row, dictTradesToDollar)
                     rowsProcessed += 1
-                elif row["OldPrice"] < BULK_BOX_THRESHOLD:  # if new>BULK_BOX_THRESHOLD&old<BULK_BOX_THRESHOLD, upgrade from bulk to dollar
+                elif row["OldPrice"] < BULK_BOX_THRESHOLD * 100:  # if new>BULK_BOX_THRESHOLD&old<BULK_BOX_THRESHOLD, upgrade from bulk to dollar
                     updateRowStats(row, dictBulkToDollar)
                     rowsProcessed += 1
                 else:  # if new>BULK_BOX_THRESHOLD&old>BULK_BOX_THRESHOLD, do nothing (ie, no change)
                     updateRowStats(row, dictUnchangedCards)
                     rowsProcessed += 1
             # check for downgrades to bulk
-            elif row["NewPrice"] < BULK_BOX_THRESHOLD:
+            elif row["NewPrice"] < BULK_BOX_THRESHOLD * 100:
                 # if new<BULK_BOX_THRESHOLD&old>TRADE_BOX_THRESHOLD, downgrade from trades to bulk
-                if row["OldPrice"] >= TRADE_BOX_THRESHOLD:
+                if row["OldPrice"] >= TRADE_BOX_THRESHOLD * 100:
                     updateRowStats(row, dictTradesToBulk)
                     rowsProcessed += 1
-                elif row["OldPrice"] >= BULK_BOX_THRESHOLD:  # if new<BULK_BOX_THRESHOLD&old>BULK_BOX_THRESHOLD, downgrade from dollar to bulk
+                elif row["OldPrice"] >= BULK_BOX_THRESHOLD * 100:  # if new<BULK_BOX_THRESHOLD&old>BULK_BOX_THRESHOLD, downgrade from dollar to bulk
                     updateRowStats(row, dictDollarToBulk)
                     rowsProcessed += 1
                 else:  # if new<BULK_BOX_THRESHOLD&old<BULK_BOX_THRESHOLD, do nothing (ie, no change)
@@ -642,98 +2166,95 @@ def loopDataFrame(df):
     print("Total time elapsed for loop: " + str(timeLoopEnd - timeLoopStart))
 
 
-def queryForReports(df):
-    """run the queries needed for reporting and return a dictionary of all the query result dataframes, dictionary of stats"""
+def priceTiers(dictConfig):
+    """the boxes for a config as (code, label, lowest price in dollars), the thresholds come from the config or the defaults up top"""
+    return [("bulk", "Bulk", 0), ("dollar", "Dollar", dictConfig.get("bulk-box-threshold", DEFAULT_COLLECTION_SETTINGS["bulk-box-threshold"])),
+            ("trades", "Trades", dictConfig.get("trade-box-threshold", DEFAULT_COLLECTION_SETTINGS["trade-box-threshold"]))]
+
+
+def transitionBuckets(listTiers=PRICE_TIERS):
+    """return the names of every bucket a merged card can land in: unch/new/gone plus "<old box>-to-<new box>" for every pair of boxes"""
+    listBuckets = ["unch-cards", "new-cards", "gone-cards"]
+    for tierOld in listTiers:
+        for tierNew in reversed(listTiers):
+            if tierOld != tierNew:
+                listBuckets.append(tierOld[0] + "-to-" + tierNew[0])
+    return listBuckets
+
+
+def priceTierCodes(arrCents, listTiers=PRICE_TIERS):
+    """bin prices (in cents) into box codes (index into listTiers) in one vectorized pass, a price on a threshold belongs to the higher box"""
+    arrThresholds = numpy.array([round(tier[2] * 100) for tier in listTiers[1:]], dtype="int64")
+    return numpy.searchsorted(arrThresholds, numpy.asarray(arrCents, dtype="int64"), side="right")
 
-    timeQueryStart = timer()
 
+def classifyBoxTransitions(df, listTiers=PRICE_TIERS):
+    """figure out the bucket (see transitionBuckets) for every row of a merged dataframe at once
+    old and new prices get binned to box codes, the (old, new) pair picks the bucket, new and gone cards get their own buckets
+    returns a categorical series lined up with df"""
+    listBuckets = transitionBuckets(listTiers)
+    dictBucketCodes = {strBucket: intCode for intCode, strBucket in enumerate(listBuckets)}
+    intTiers = len(listTiers)
+
+    # lookup from pair code (old*tiers + new) to bucket code, with two extra slots at the end for new and gone
+    arrPairToBucket = numpy.empty(intTiers * intTiers + 2, dtype="int8")
+    for intOld, tierOld in enumerate(listTiers):
+        for intNew, tierNew in enumerate(listTiers):
+            strBucket = "unch-cards" if intOld == intNew else tierOld[0] + "-to-" + tierNew[0]
+            arrPairToBucket[intOld * intTiers + intNew] = dictBucketCodes[strBucket]
+    arrPairToBucket[-2] = dictBucketCodes["new-cards"]
+    arrPairToBucket[-1] = dictBucketCodes["gone-cards"]
+
+    arrPairCodes = priceTierCodes(df["OldPrice"], listTiers) * intTiers + priceTierCodes(df["NewPrice"], listTiers)
+    arrPairCodes[df["IsGone"].to_numpy(dtype=bool)] = intTiers * intTiers + 1
+    arrPairCodes[df["IsNew"].to_numpy(dtype=bool)] = intTiers * intTiers
+
+    return pandas.Series(pandas.Categorical.from_codes(arrPairToBucket[arrPairCodes], categories=listBuckets),
+                         index=df.index, name="Bucket")
+
+
+def splitBuckets(df, listTiers=PRICE_TIERS):
+    """split a merged df that already has its Bucket column into a dataframe per bucket, returns those and the count stats"""
     results = {}
     stats = {}
+    dictPositions = df.groupby("Bucket").indices
+    for strBucket in transitionBuckets(listTiers):
+        results[strBucket] = df.take(dictPositions.get(strBucket, numpy.array([], dtype="int64")))
+        stats["count-" + strBucket] = len(results[strBucket])
+
+    stats["count-all-results"] = sum(stats["count-" + strBucket] for strBucket in transitionBuckets(listTiers))
+    return results, stats
+
+
+def queryForReports(df, listTiers=PRICE_TIERS):
+    """split the merged cards into their buckets for reporting and return a dictionary of all the bucket dataframes, dictionary of stats
+    every row lands in exactly one bucket, see classifyBoxTransitions
+    this adds a "Bucket" column to df itself (cachedQuery caches it, the daemon's moves report it), pass a copy to keep df as it was"""
 
-    # query for bulk to trades (good)
-    dfBulkToTrades = df.query(
-        "(IsNew != True) & (OldPrice < " + str(BULK_BOX_THRESHOLD) + ") & (NewPrice >= " + str(TRADE_BOX_THRESHOLD) + ")")
-    results["bulk-to-trades"] = dfBulkToTrades
-    stats["count-bulk-to-trades"] = len(dfBulkToTrades)
-
-    # query for bulk to dollar (good)
-    dfBulkToDollar = df.query(
-        "(IsNew != True) & (OldPrice < " + str(BULK_BOX_THRESHOLD) + ") & ( (NewPrice >= " + str(BULK_BOX_THRESHOLD) + ") & (NewPrice < " + str(TRADE_BOX_THRESHOLD) + ") )")
-    results["bulk-to-dollar"] = dfBulkToDollar
-    stats["count-bulk-to-dollar"] = len(dfBulkToDollar)
-
-    # query for dollar to trades (good)
-    dfDollarToTrades = df.query("(IsNew != True) & ( (OldPrice < " + str(
-        TRADE_BOX_THRESHOLD) + ") & (OldPrice >= " + str(BULK_BOX_THRESHOLD) + ") ) & (NewPrice >= " + str(TRADE_BOX_THRESHOLD) + ")")
-    results["dollar-to-trades"] = dfDollarToTrades
-    stats["count-dollar-to-trades"] = len(dfDollarToTrades)
-
-    # query for dollar to bulk (bad)
-    dfDollarToBulk = df.query(
-        "(IsNew != True) & ( (OldPrice < " + str(TRADE_BOX_THRESHOLD) + ") & (OldPrice >= " + str(BULK_BOX_THRESHOLD) + ") ) & (NewPrice < " + str(BULK_BOX_THRESHOLD) + ")")
-    results["dollar-to-bulk"] = dfDollarToBulk
-    stats["count-dollar-to-bulk"] = len(dfDollarToBulk)
-
-    # query for trades to dollar (bad)
-    dfTradesToDollar = df.query("(IsNew != True) & (OldPrice > " + str(
-        TRADE_BOX_THRESHOLD) + ") & (NewPrice >= " + str(BULK_BOX_THRESHOLD) + ") & (NewPrice < " + str(TRADE_BOX_THRESHOLD) + ")")
-    results["trades-to-dollar"] = dfTradesToDollar
-    stats["count-trades-to-dollar"] = len(dfTradesToDollar)
-
-    # query for trade to bulk (bad)
-    dfTradesToBulk = df.query(
-        "(IsNew != True) & (OldPrice > " + str(TRADE_BOX_THRESHOLD) + ") & (NewPrice <" + str(BULK_BOX_THRESHOLD) + ")")
-    results["trades-to-bulk"] = dfTradesToBulk
-    stats["count-trades-to-bulk"] = len(dfTradesToBulk)
-
-    # query for new cards
-    dfNewCards = df.query("(IsNew == True)")
-    results["new-cards"] = dfNewCards
-    stats["count-new-cards"] = len(dfNewCards)
-
-    # query for removed cards
-    dfGoneCards = df.query("(IsGone == True)")
-    results["gone-cards"] = dfGoneCards
-    stats["count-gone-cards"] = len(dfGoneCards)
-
-    # query for unch- these are cards with no need to be moved from their location
-    dfUnchCards = df.query("(IsNew != True) & (IsGone != True) & ("
-                           + " ( (OldPrice >= " + str(TRADE_BOX_THRESHOLD)
-                           + ") & (NewPrice >= "
-                           + str(TRADE_BOX_THRESHOLD) + ") )"
-                           + "| ( ( (OldPrice >= " + str(BULK_BOX_THRESHOLD) + ") & (OldPrice < " + str(TRADE_BOX_THRESHOLD)
-                           + ") ) & ( (NewPrice >= " + str(BULK_BOX_THRESHOLD) + ") & (NewPrice < "
-                           + str(TRADE_BOX_THRESHOLD) + ") ) )"
-                           + "| ( (OldPrice < " + str(BULK_BOX_THRESHOLD) + ") & (NewPrice < " + str(BULK_BOX_THRESHOLD) + ") )"
-                           ")")
-    results["unch-cards"] = dfUnchCards
-    stats["count-unch-cards"] = len(dfUnchCards)
-
-    stats["count-all-results"] = stats["count-unch-cards"] + stats["count-gone-cards"] + stats["count-new-cards"] \
-        + stats["count-trades-to-bulk"] + stats["count-trades-to-dollar"] + stats["count-dollar-to-bulk"] + stats["count-dollar-to-trades"] \
-        + stats["count-bulk-to-dollar"] + stats["count-bulk-to-trades"]
-    stats["stats"] = calcStatsDict(df)
-    timeQueryEnd = timer()
-    print("Total time elapsed for query: "
-          + str(timeQueryEnd - timeQueryStart))
+    df["Bucket"] = classifyBoxTransitions(df, listTiers)
+    results, stats = splitBuckets(df, listTiers)
+
+    # stats for every bucket and the whole frame in one grouped pass, the report formats straight from this table
+    with stageSpan("stats", len(df)):
+        results["bucket-stats"] = calcStatsTable(df, df["Bucket"])
+        stats["stats"] = statsDictFromTable(results["bucket-stats"], "all")
 
     return results, stats
 
 
-def fetchAndWriteDeckboxLibrary(strTodayFileName):
+def fetchAndWriteDeckboxLibrary(strTodayFileName, fMinRowRatio=DECKBOX_MIN_ROW_RATIO):
     """if a file for today doesn't exist, go fetch it from Deckbox and write it to strTodayFileName
-    after this function, strTodayFileName should always exist"""
+    after this function, strTodayFileName should always exist. Returns the parsed export if it had to go get it (see streamDeckboxExport),
+    None if the file was already there"""
 
     # found this code from handy site https://curl.trillworks.com/
-    # cookies are private to my account, so I want to read and write them from my local file that doesn't get committed
-    cookies = eatCookies()
-
     headers = {
         'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+        'Accept-Encoding': 'gzip, deflate',
         'Accept-Language': 'en-US,en;q=0.5',
         'Connection': 'keep-alive',
         'Host': 'deckbox.org',
-        'Referer': 'https://deckbox.org/sets/1016639',
+        'Referer': 'https://deckbox.org/sets/' + DECKBOX_SET_ID,
         'Upgrade-Insecure-Requests': '1',
         'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10.13; rv:59.0) Gecko/20100101 Firefox/59.0',
     }
@@ -747,77 +2268,225 @@ def fetchAndWriteDeckboxLibrary(strTodayFileName):
     )
 
     # if there's no file for today, then go get it
+    df = None
     if Path(DATA_DIR_NAME + strTodayFileName).exists():
         debug("j'exist, donc il ne faut que je getter le file")
     else:
         # now call out to deckbox.org to get inventory as csv, this command is dumped from firefox and seems to work
         debug("je n'exist pas, donc il faut que je getter le file")
-        response = requests.get('https://deckbox.org/sets/export/1016639',
-                                headers=headers, params=params, cookies=cookies)
-        response.encoding = "UTF-8"
-        # print(response.text)
-        todayFile = open(DATA_DIR_NAME + strTodayFileName, "w")
-        todayFile.write(response.text)
-        todayFile.close()
+        # cookies are private to my account, so I want to read and write them from my local file that doesn't get committed
+        cookies = eatCookies()
+        with httpGet("deckbox", DECKBOX_EXPORT_URL + DECKBOX_SET_ID, headers=headers, params=params, cookies=cookies,
+                     stream=True) as response:
+            response.raise_for_status()
+            df = streamDeckboxExport(response, DATA_DIR_NAME + strTodayFileName, fMinRowRatio)
+
+    registerSnapshot(strTodayFileName)
+    return df
 
 
-def renameColsForHTML(df):
-    """returns a temp dataframe with all columns renamed to have spaces before capital letters, this lets html line break the headers"""
+def streamDeckboxExport(response, strPath, fMinRowRatio=DECKBOX_MIN_ROW_RATIO):
+    """write a Deckbox export to strPath as it comes in, a chunk at a time, and parse it on another thread while it downloads
+    it's written to a .part file and only renamed into place once it checks out (see checkDeckboxExport), so a run that dies halfway
+    never leaves a short CSV that looks like today's snapshot. requests undoes the gzip, the chunks are the CSV itself
+    returns the parsed export (no card ids yet)"""
+    strPartPath = strPath + ".part"
+    intPipeRead, intPipeWrite = os.pipe()
+    pipeOut = os.fdopen(intPipeWrite, "wb")
+    dictParsed = {}
+
+    def parse():
+        with os.fdopen(intPipeRead, "rb") as pipeIn:
+            try:
+                dictParsed["df"] = readDeckboxExport(pipeIn, strPath)
+            except Exception as err:
+                dictParsed["error"] = err
+            # if the parser gave up early, keep emptying the pipe so the download doesn't get stuck on it
+            for chunk in iter(lambda: pipeIn.read(1048576), b""):
+                pass
+
+    threadParse = threading.Thread(target=parse, name="deckbox-parse")
+    threadParse.start()
+    intBytes = 0
+    bytesFirst = b""
+    bytesLast = b""
+    try:
+        with pipeOut, open(strPartPath, "wb") as file:
+            for chunk in response.iter_content(chunk_size=1048576):
+                file.write(chunk)
+                pipeOut.write(chunk)
+                intBytes += len(chunk)
+                if len(bytesFirst) < 65536:
+                    bytesFirst += chunk[:65536]
+                bytesLast = (bytesLast + chunk)[-65536:]
+        threadParse.join()
+        if "error" in dictParsed:
+            raise dictParsed["error"]
+        df = dictParsed["df"]
+        checkDeckboxExport(bytesFirst, bytesLast, len(df), fMinRowRatio, strPath)
+    except BaseException:
+        threadParse.join()
+        if os.path.exists(strPartPath):
+            os.remove(strPartPath)
+        raise
+    os.replace(strPartPath, strPath)
+    print("got " + str(len(df)) + " cards (" + str(intBytes) + " bytes) from Deckbox, encoding: " + response.headers.get("Content-Encoding", "none"))
+    return df
+
 
-    # for every capital letter except the first, replace it with " " plus itself
-    return df.rename(columns=lambda x: re.sub("(?<!^)(?=[A-Z])", lambda y: " " + y.group(0), x))
+def checkDeckboxExport(bytesFirst, bytesLast, intRows, fMinRowRatio=DECKBOX_MIN_ROW_RATIO, strSource="the export"):
+    """raise ValueError unless a downloaded export looks whole: its last line has as many fields as its header (a cut off download
+    usually ends partway through a row) and it has at least fMinRowRatio as many rows as the last snapshot in the history had cards
+    the header's columns were already checked by the parser"""
+    listHeader = next(csv.reader([bytesFirst.decode("utf-8", "replace").splitlines()[0]])) if bytesFirst.strip() else []
+    listLines = [strLine for strLine in bytesLast.decode("utf-8", "replace").splitlines() if strLine.strip()]
+    if intRows > 0:
+        listLast = next(csv.reader([listLines[-1]]))
+        if len(listLast) != len(listHeader):
+            raise ValueError(strSource + " looks cut off, its last line has " + str(len(listLast)) + " fields and the header has "
+                             + str(len(listHeader)))
+
+    con = openHistory()
+    try:
+        rowLast = con.execute("SELECT file_name, cards FROM snapshots ORDER BY snapshot_date DESC LIMIT 1").fetchone()
+    finally:
+        con.close()
+    if rowLast is not None and intRows < rowLast[1] * fMinRowRatio:
+        raise ValueError(strSource + " only has " + str(intRows) + " rows, " + rowLast[0] + " had " + str(rowLast[1])
+                         + " cards. Not trusting it, set deckbox-min-row-ratio in config if the collection really shrank")
 
 
 def toHTMLDefaulter(df):
-    """returns formatted html string from dataframe using the conventions of my reports
-    basically I want left-aligned, wrapping column headers, links for card names, currency formatted, green background for positive"""
-
-    goodColor = "#8FBC8F"
-    badColor = "#E9967A"
-    html = "<b>N/A - No match"
-    if (len(df) > 0):  # don't bother if there's nothing there...
-        df[["CountChange"]] = df[["CountChange"]].applymap(
-            lambda x: "<div style=\"background-color: " + (badColor if x < 0 else goodColor if x > 0 else "") + "\">" + str(x) + "</div>")
-        df[["PriceChange", "TotalChange"]] = df[["PriceChange", "TotalChange"]].applymap(
-            lambda x: "<div style=\"background-color: " + (badColor if x < 0 else goodColor if x > 0 else "") + "\">" + "${:,.2f}".format(float(x)) + "</div>")
-        df[["OldPrice", "NewPrice"]] = df[[
-            "OldPrice", "NewPrice"]].applymap(lambda x: "${:,.2f}".format(float(x)))
-        df = df.rename(index=str, columns={"SortCategory": "Sort", "Condition": "Cond", "IsFoil": "Foil", "CardNumber": "Card#", "OldCount": "Old#", "NewCount": "New#", "TradeCount": "Trade#",
-                                           "OldPrice": "Old$", "NewPrice": "New$", "IsNew": "New", "IsGone": "Del", "CountChange": "\u0394" + "Q", "PriceChange": "\u0394" + "$", "TotalChange": "\u03a3\u0394$"})
-
-        formattedDF = renameColsForHTML(df)
-        formattedDF = formattedDF.drop(columns=["New", "Del"])
-        # print(str(formattedDF))
-        html = formattedDF.to_html(index=False, justify="left", index_names=False, escape=False, float_format=lambda x: "${:,.2f}".format(
-            float(x)), formatters={"Name": lambda x: "<a href=\"https://deckbox.org/mtg/" + x + "\" target=_blank>" + x + "</a>"})
-    # print(html)
-    return html
+    """returns formatted html string from dataframe using the conventions of my reports, see writeCardTable"""
+    htmlStringWriter = io.StringIO()
+    writeCardTable(htmlStringWriter, [df])
+    return htmlStringWriter.getvalue()
+
+
+def writeCardTable(htmlStringWriter, listFrames, intChunkRows=REPORT_CHUNK_ROWS, intMaxRows=None):
+    """write one table of cards (the frames one after the other) using the conventions of my reports
+    basically I want left-aligned, wrapping column headers, links for card names, currency formatted, green background for positive
+    cells get formatted a column at a time and rows go out intChunkRows at a time, the markup is what DataFrame.to_html used to make
+    intMaxRows cuts the table off there with a note about how many more there are (for email)"""
+    listFrames = [df for df in listFrames if len(df) > 0]
+    if len(listFrames) == 0:  # don't bother if there's nothing there...
+        htmlStringWriter.write("<b>N/A - No match")
+        return
+
+    intMore = 0
+    if intMaxRows is not None:
+        intMore = max(0, sum(len(df) for df in listFrames) - intMaxRows)
+        listCapped = []
+        for df in listFrames:
+            intRoom = intMaxRows - sum(len(dfCapped) for dfCapped in listCapped)
+            if intRoom > 0:
+                listCapped.append(df.iloc[:intRoom])
+        listFrames = listCapped
+
+    htmlStringWriter.write("<table border=\"1\" class=\"dataframe\">\n  <thead>\n    <tr style=\"text-align: left;\">\n")
+    htmlStringWriter.write("".join("      <th>" + strHeader + "</th>\n" for strColumn, strHeader, strFormat in REPORT_COLUMNS))
+    htmlStringWriter.write("    </tr>\n  </thead>\n  <tbody>\n")
+    for df in listFrames:
+        for intStart in range(0, len(df), intChunkRows):
+            dfChunk = df.iloc[intStart:intStart + intChunkRows]
+            arrRows = numpy.full(len(dfChunk), "    <tr>\n", dtype=object)
+            for strColumn, strHeader, strFormat in REPORT_COLUMNS:
+                arrRows = arrRows + "      <td>" + formatCardCells(dfChunk[strColumn], strFormat) + "</td>\n"
+            htmlStringWriter.write("".join(arrRows + "    </tr>\n"))
+    htmlStringWriter.write("  </tbody>\n</table>")
+    if intMore > 0:
+        htmlStringWriter.write("<p><i>... and " + str(intMore) + " more, the full list is in the report on disk</i></p>")
+
+
+def writeCardTableData(htmlStringWriter, listFrames, dictPayload):
+    """"data" report mode version of writeCardTable: the rows go in the page's json payload (text as ids into one shared list of
+    strings, money as cents) and the table is just a placeholder that the inline-data-js script renders as it's scrolled"""
+    listFrames = [df for df in listFrames if len(df) > 0]
+    if len(listFrames) == 0:
+        htmlStringWriter.write("<b>N/A - No match")
+        return
+
+    listCols = []
+    for strColumn, strHeader, strFormat in REPORT_COLUMNS:
+        if strFormat in ("text", "link"):
+            listCols.append(numpy.concatenate([payloadStringIds(df[strColumn], dictPayload) for df in listFrames]).tolist())
+        else:
+            listCols.append(numpy.concatenate([df[strColumn].to_numpy(dtype="int64") for df in listFrames]).tolist())
+    dictPayload["tables"].append({"n": sum(len(df) for df in listFrames), "cols": listCols})
+    htmlStringWriter.write("<div class=\"cardtable\" data-table=\"" + str(len(dictPayload["tables"]) - 1) + "\"></div>")
 
 
-def buildHTMLReport(dfMergeCards, dictResults, dictResultStats, strTodayFileName, strOldFileName):
-    """make a relatively decent looking report that gets emailed out and written to disk"""
+def payloadStringIds(series, dictPayload):
+    """return the payload string ids for a column, adding strings it hasn't seen yet. missing values are "NaN" like in the static report"""
+    arrCodes, uniques = pandas.factorize(series)
+    listIds = []
+    for strValue in [str(value) for value in uniques] + ["NaN"]:
+        if strValue not in dictPayload["string-ids"]:
+            dictPayload["string-ids"][strValue] = len(dictPayload["strings"])
+            dictPayload["strings"].append(strValue)
+        listIds.append(dictPayload["string-ids"][strValue])
+    return numpy.array(listIds, dtype="int64")[arrCodes]
+
+
+def newReportPayload():
+    return {"headers": [strHeader for strColumn, strHeader, strFormat in REPORT_COLUMNS],
+            "formats": [strFormat for strColumn, strHeader, strFormat in REPORT_COLUMNS],
+            "good": REPORT_GOOD_COLOR, "bad": REPORT_BAD_COLOR, "strings": [], "string-ids": {}, "tables": []}
+
 
+def writeReportPayload(htmlStringWriter, dictPayload):
+    """write the json payload for a "data" mode report, "</" gets escaped so a card name can't end the script tag"""
+    strJSON = json.dumps({strKey: value for strKey, value in dictPayload.items() if strKey != "string-ids"}, separators=(",", ":"))
+    htmlStringWriter.write("<script id=\"CardData\" type=\"application/json\">" + strJSON.replace("</", "<\\/") + "</script>")
+
+
+def formatCardCells(series, strFormat):
+    """return an object array of cell html for a column, strFormat is one of the REPORT_COLUMNS formats"""
+    if strFormat == "link":
+        return formatDistinct(series, lambda x: "<a href=\"https://deckbox.org/mtg/" + x + "\" target=_blank>" + x + "</a>")
+    if strFormat == "money":
+        return formatDistinct(series, lambda x: "${:,.2f}".format(x / 100))
+    if strFormat == "change":
+        return colorCells(series.to_numpy(), formatDistinct(series, str))
+    if strFormat == "money-change":
+        return colorCells(series.to_numpy(), formatDistinct(series, lambda x: "${:,.2f}".format(x / 100)))
+    return formatDistinct(series, str)
+
+
+def formatDistinct(series, fnFormat):
+    """format each distinct value in a column once (collections repeat names, sets, prices, counts all over) and spread the strings
+    back out to every row. missing values come out as NaN, like they did from to_html"""
+    arrCodes, uniques = pandas.factorize(series)
+    arrFormatted = numpy.array([fnFormat(value) for value in uniques] + ["NaN"], dtype=object)
+    return arrFormatted[arrCodes]
+
+
+def colorCells(arrValues, arrCells):
+    """wrap cells in a div with a red background for negative values, green for positive, none for no change"""
+    arrColors = numpy.select([arrValues < 0, arrValues > 0], [REPORT_BAD_COLOR, REPORT_GOOD_COLOR], "").astype(object)
+    return "<div style=\"background-color: " + arrColors + "\">" + arrCells + "</div>"
+
+
+def prettySnapshotDate(strFileName):
+    """YYYYMMDD-magic-cards.csv -> Month DD, YYYY"""
+    strDate = strFileName.split("-")[0]
+    return datetime.date(int(strDate[0:4]), int(strDate[4:6]), int(strDate[6:8])).strftime("%B %d, %Y")
+
+
+def writeReportHead(htmlStringWriter, strTodayFileName, strMode="static"):
+    """write the html head (title, tooltip and filter scripts, css) and the page heading. "data" mode gets the script that renders
+    the card tables from the payload"""
     with open("./templates/inline-css", "r") as file:
         cssInlineStyle = file.read()
 
-    with open("./templates/inline-js", "r") as file:
+    with open("./templates/inline-data-js" if strMode == "data" else "./templates/inline-js", "r") as file:
         strJSFilterScript = file.read()
 
-    # TODO-replace this with a template file for easier formatting
-    # since I want links in html, I have to have a really long colwidth, -1=no limit, rather than figuring out max needed. I typically don't display so this doesn't matter
-    pandas.set_option('display.max_colwidth', None)
-    strPrettyTodayFileName = strTodayFileName.split("-")[0]
-    strPrettyTodayFileName = datetime.date(int(strPrettyTodayFileName[0:4]), int(
-        strPrettyTodayFileName[4:6]), int(strPrettyTodayFileName[6:8])).strftime("%B %d, %Y")
-    strPrettyOldFileName = strOldFileName.split("-")[0]
-    strPrettyOldFileName = datetime.date(int(strPrettyOldFileName[0:4]), int(
-        strPrettyOldFileName[4:6]), int(strPrettyOldFileName[6:8])).strftime("%B %d, %Y")
-    htmlStringWriter = io.StringIO()
     htmlStringWriter.write("<html><head>")
     htmlStringWriter.write(
         "<meta http-equiv=\"content-type\" content=\"text/html; charset=utf-8\">")
     htmlStringWriter.write(
-        "<title>Brian's Card Report for " + strPrettyTodayFileName + "</title>")
+        "<title>Brian's Card Report for " + prettySnapshotDate(strTodayFileName) + "</title>")
     htmlStringWriter.write(
         "<script src=\"https://deckbox.org/assets/external/tooltip.js\" charset=\"utf-8\"></script>")
     htmlStringWriter.write(strJSFilterScript)
@@ -826,114 +2495,527 @@ def buildHTMLReport(dfMergeCards, dictResults, dictResultStats, strTodayFileName
     htmlStringWriter.write("<body class=\"\">")
     htmlStringWriter.write(
         "<h1>Comparing shifts in magic card prices in my library.</h1>")
-    htmlStringWriter.write("<h2>" + strPrettyTodayFileName
-                           + " with " + strPrettyOldFileName + "</h2>")
+
+
+def writeReportSection(htmlStringWriter, dfMergeCards, dictResults, dictResultStats, bFilterInput=True, dictPayload=None, intMaxRows=None,
+                       listTiers=PRICE_TIERS):
+    """write the summary counts, overall stats and one report per box for one comparison
+    with a dictPayload the card tables go in it ("data" mode), otherwise they're static, at most intMaxRows cards each if that's set"""
+    # box shifts in the order I like to read them, most expensive destination first
+    listUpgrades = [(tierOld, tierNew) for tierNew in reversed(listTiers) for tierOld in reversed(listTiers)
+                    if listTiers.index(tierOld) < listTiers.index(tierNew)]
+    listDowngrades = [(tierOld, tierNew) for tierOld in reversed(listTiers) for tierNew in reversed(listTiers)
+                      if listTiers.index(tierOld) > listTiers.index(tierNew)]
     htmlStringWriter.write("<table border=0 style=\"font-size : 18px\">")
     htmlStringWriter.write("<tr><td>")
     htmlStringWriter.write(
         "Total cards processed: </td><td><b>" + str(len(dfMergeCards)) + "</b>")
-    htmlStringWriter.write(
-        "</td><td colspan=3 align=\"right\"><input type=\"text\" id=\"FilterInput\" onkeyup=\"filterTDs()\" placeholder=\"Filter by text..\"></td></tr>")
+    if bFilterInput:
+        htmlStringWriter.write(
+            "</td><td colspan=" + str(len(listUpgrades)) + " align=\"right\"><input type=\"text\" id=\"FilterInput\" "
+            + ("oninput=\"filterRowsSoon()\"" if dictPayload is not None else "onkeyup=\"filterTDs()\"") + " placeholder=\"Filter by text..\"></td></tr>")
+    else:
+        htmlStringWriter.write("</td><td colspan=" + str(len(listUpgrades)) + ">&nbsp;</td></tr>")
     htmlStringWriter.write("<tr><td>")
     htmlStringWriter.write("New cards:</td><td><b>"
                            + str(dictResultStats["count-new-cards"]) + "</b>")
-    htmlStringWriter.write("</td><td colspan=3>&nbsp;</td></tr>")
+    htmlStringWriter.write("</td><td colspan=" + str(len(listUpgrades)) + ">&nbsp;</td></tr>")
     htmlStringWriter.write("<tr><td>")
     htmlStringWriter.write("Gone cards:</td><td><b>"
                            + str(dictResultStats["count-gone-cards"]) + "</b>")
-    htmlStringWriter.write("</td><td colspan=3>&nbsp;</td></tr>")
+    htmlStringWriter.write("</td><td colspan=" + str(len(listUpgrades)) + ">&nbsp;</td></tr>")
     htmlStringWriter.write("<tr><td>")
     htmlStringWriter.write("Unchanged cards:</td><td><b>"
                            + str(dictResultStats["count-unch-cards"]) + "</b> ")
-    htmlStringWriter.write("</td><td colspan=3>&nbsp;</td></tr>")
-    htmlStringWriter.write("<tr><td>")
-    htmlStringWriter.write("Positive card shifts: </td><td>")
-    htmlStringWriter.write("<b>" + str(dictResultStats["count-bulk-to-dollar"]
-                                       + dictResultStats["count-bulk-to-trades"] + dictResultStats["count-dollar-to-trades"]) + "</b> ")
-    htmlStringWriter.write("</td><td>")
-    htmlStringWriter.write("From Dollar to Trades: <b>"
-                           + str(dictResultStats["count-dollar-to-trades"]) + "</b>; ")
-    htmlStringWriter.write("</td><td>")
-    htmlStringWriter.write("From Bulk to Trades: <b>"
-                           + str(dictResultStats["count-bulk-to-trades"]) + "</b>; ")
-    htmlStringWriter.write("</td><td>")
-    htmlStringWriter.write("From Bulk to Dollar: <b>"
-                           + str(dictResultStats["count-bulk-to-dollar"]) + "</b> ")
-    htmlStringWriter.write("</td></tr>")
-    htmlStringWriter.write("<tr><td>")
-    htmlStringWriter.write("Negative card shifts: </td><td>")
-    htmlStringWriter.write("<b>" + str(dictResultStats["count-trades-to-dollar"]
-                                       + dictResultStats["count-trades-to-bulk"] + dictResultStats["count-dollar-to-bulk"]) + "</b> ")
-    htmlStringWriter.write("</td><td>")
-    htmlStringWriter.write("From Trades to Dollar: <b>"
-                           + str(dictResultStats["count-trades-to-dollar"]) + "</b>; ")
-    htmlStringWriter.write("</td><td>")
-    htmlStringWriter.write("From Trades to Bulk: <b>"
-                           + str(dictResultStats["count-trades-to-bulk"]) + "</b>; ")
-    htmlStringWriter.write("</td><td>")
-    htmlStringWriter.write("From Dollar to Bulk: <b>"
-                           + str(dictResultStats["count-dollar-to-bulk"]) + "</b> ")
-    htmlStringWriter.write("</td></tr></table>")
-    htmlStringWriter.write(htmlStats(dfMergeCards))
+    htmlStringWriter.write("</td><td colspan=" + str(len(listUpgrades)) + ">&nbsp;</td></tr>")
+
+    for strLabel, listShifts in (("Positive", listUpgrades), ("Negative", listDowngrades)):
+        htmlStringWriter.write("<tr><td>")
+        htmlStringWriter.write(strLabel + " card shifts: </td><td>")
+        htmlStringWriter.write("<b>" + str(sum(dictResultStats["count-" + tierOld[0] + "-to-" + tierNew[0]]
+                                               for tierOld, tierNew in listShifts)) + "</b> ")
+        for intShift, (tierOld, tierNew) in enumerate(listShifts):
+            htmlStringWriter.write("</td><td>")
+            htmlStringWriter.write("From " + tierOld[1] + " to " + tierNew[1] + ": <b>"
+                                   + str(dictResultStats["count-" + tierOld[0] + "-to-" + tierNew[0]])
+                                   + ("</b>; " if intShift < len(listShifts) - 1 else "</b> "))
+        htmlStringWriter.write("</td></tr>")
+    htmlStringWriter.write("</table>")
+    dfBucketStats = dictResults["bucket-stats"]
+    htmlStringWriter.write(htmlStats(statsDictFromTable(dfBucketStats, "all")))
     htmlStringWriter.write("<hr/>")
-    htmlStringWriter.write("<h1>Report #1 - Trades</h1>")
-    if (len(dictResults["trades-to-dollar"]) > 0):
-        htmlStringWriter.write(
-            "<h2>Trades downgraded to Dollar</h2>" + htmlStats(dictResults["trades-to-dollar"]))
-    if (len(dictResults["trades-to-bulk"]) > 0):
-        htmlStringWriter.write(
-            "<h2>Trades downgraded to Bulk</h2>" + htmlStats(dictResults["trades-to-bulk"]))
-    htmlStringWriter.write(toHTMLDefaulter(
-        dictResults["trades-to-dollar"].append(dictResults["trades-to-bulk"])))
 
-    htmlStringWriter.write("<h1>Report #2 - Dollar</h1>")
-    if(len(dictResults["dollar-to-trades"]) > 0):
-        htmlStringWriter.write(
-            "<h2>Dollar upgrades to Trades</h2>" + htmlStats(dictResults["dollar-to-trades"]))
-    if(len(dictResults["dollar-to-bulk"]) > 0):
-        htmlStringWriter.write(
-            "<h2>Dollar downgraded to Bulk</h2>" + htmlStats(dictResults["dollar-to-bulk"]))
-    htmlStringWriter.write(toHTMLDefaulter(
-        dictResults["dollar-to-trades"].append(dictResults["dollar-to-bulk"])))
+    # one report per box, most expensive first, with every card that has to move out of it
+    for intReport, tierOld in enumerate(reversed(listTiers)):
+        htmlStringWriter.write("<h1>Report #" + str(intReport + 1) + " - " + tierOld[1] + "</h1>")
+        listMoves = []
+        for tierNew in reversed(listTiers):
+            if tierNew == tierOld:
+                continue
+            strBucket = tierOld[0] + "-to-" + tierNew[0]
+            dfMoves = dictResults[strBucket]
+            listMoves.append(dfMoves)
+            if (len(dfMoves) > 0):
+                strDirection = "upgraded" if listTiers.index(tierNew) > listTiers.index(tierOld) else "downgraded"
+                htmlStringWriter.write(
+                    "<h2>" + tierOld[1] + " " + strDirection + " to " + tierNew[1] + "</h2>" + htmlStats(statsDictFromTable(dfBucketStats, strBucket)))
+        if dictPayload is not None:
+            writeCardTableData(htmlStringWriter, listMoves, dictPayload)
+        else:
+            writeCardTable(htmlStringWriter, listMoves, intMaxRows=intMaxRows)
 
-    htmlStringWriter.write("<h1>Report #3 - Bulk</h1>")
-    if(len(dictResults["bulk-to-trades"]) > 0):
-        htmlStringWriter.write(
-            "<h2>Bulk upgraded to Trades</h2>" + htmlStats(dictResults["bulk-to-trades"]))
-    if(len(dictResults["bulk-to-dollar"]) > 0):
-        htmlStringWriter.write(
-            "<h2>Bulk upgraded to Dollar</h2>" + htmlStats(dictResults["bulk-to-dollar"]))
-    htmlStringWriter.write(toHTMLDefaulter(
-        dictResults["bulk-to-trades"].append(dictResults["bulk-to-dollar"])))
+
+def writeReportFoot(htmlStringWriter):
     htmlStringWriter.write(
         "<br/>Thank you drive through...v" + CURRENT_VERSION + "..." + HOST_NAME)
     htmlStringWriter.write("</body></html>")
-    htmlString = htmlStringWriter.getvalue()
-    htmlStringWriter.close()
-    return htmlString
+
+
+def buildHTMLReport(dfMergeCards, dictResults, dictResultStats, strTodayFileName, strOldFileName):
+    """make a relatively decent looking report that gets emailed out and written to disk, as a string. main() streams it straight to the file"""
+    htmlStringWriter = io.StringIO()
+    writeHTMLReport(htmlStringWriter, dfMergeCards, dictResults, dictResultStats, strTodayFileName, strOldFileName)
+    return htmlStringWriter.getvalue()
+
+
+def writeHTMLReport(htmlStringWriter, dfMergeCards, dictResults, dictResultStats, strTodayFileName, strOldFileName, strMode="static", intMaxRows=None,
+                    listTiers=PRICE_TIERS):
+    """write the report for one comparison to a file (or anything with write)
+    strMode "static" is plain tables, "data" embeds the cards as json and renders what's scrolled into view (for big move lists)
+    intMaxRows caps the static tables, for email"""
+
+    # TODO-replace this with a template file for easier formatting
+    dictPayload = newReportPayload() if strMode == "data" else None
+    writeReportHead(htmlStringWriter, strTodayFileName, strMode)
+    htmlStringWriter.write("<h2>" + prettySnapshotDate(strTodayFileName)
+                           + " with " + prettySnapshotDate(strOldFileName) + "</h2>")
+    writeReportSection(htmlStringWriter, dfMergeCards, dictResults, dictResultStats, dictPayload=dictPayload, intMaxRows=intMaxRows,
+                       listTiers=listTiers)
+    if dictPayload is not None:
+        writeReportPayload(htmlStringWriter, dictPayload)
+    writeReportFoot(htmlStringWriter)
+
+
+def buildHorizonReport(listHorizons, strTodayFileName):
+    """one report comparing today against several older snapshots as a string, in: list of (label, old file name, merged df, results, stats)"""
+    htmlStringWriter = io.StringIO()
+    writeHorizonReport(htmlStringWriter, listHorizons, strTodayFileName)
+    return htmlStringWriter.getvalue()
+
+
+def writeHorizonReport(htmlStringWriter, listHorizons, strTodayFileName, strMode="static", intMaxRows=None, listTiers=PRICE_TIERS):
+    """write the report comparing today against several older snapshots to a file (or anything with write), modes like writeHTMLReport"""
+    dictPayload = newReportPayload() if strMode == "data" else None
+    writeReportHead(htmlStringWriter, strTodayFileName, strMode)
+    for intHorizon, (strLabel, strOldFileName, dfMergeCards, dictResults, dictResultStats) in enumerate(listHorizons):
+        if intHorizon > 0:
+            htmlStringWriter.write("<hr/>")
+        htmlStringWriter.write("<h2>" + prettySnapshotDate(strTodayFileName) + " with "
+                               + prettySnapshotDate(strOldFileName) + " (" + strLabel + ")</h2>")
+        # only one filter box, it filters every table on the page anyway
+        writeReportSection(htmlStringWriter, dfMergeCards, dictResults, dictResultStats, bFilterInput=(intHorizon == 0),
+                           dictPayload=dictPayload, intMaxRows=intMaxRows, listTiers=listTiers)
+    if dictPayload is not None:
+        writeReportPayload(htmlStringWriter, dictPayload)
+    writeReportFoot(htmlStringWriter)
 
 
 def buildCompareDFs(strTodayFileName):
     """read in and return today's CSV as DF, determine appropriate old CSV as DF, and the old file name for use later"""
 
     # get today's file
-    dfTodaysCards = pandas.read_csv(
-        DATA_DIR_NAME + strTodayFileName, dtype={'Card Number': object})
-    dfTodaysCards = cleanCardDataFrame(dfTodaysCards)
+    dfTodaysCards = readCleanSnapshot(strTodayFileName)
+    strOldFileName, dfOldCards = readCompareCards()
+    return dfTodaysCards, dfOldCards, strOldFileName
 
-    # getting older file is a bit trickier, check the run log, find the most recent run, find the old file used, get the next recent old file to compare with
-    dictRunLog = readRunLog()
 
-    strOldFileName = determineCompareFile(dictRunLog)
+def readCompareCards():
+    """pick the snapshot to compare today against and read it, returns the file name and the df"""
+    # getting older file is a bit trickier, check the run log, find the most recent run, find the old file used, get the next recent old file to compare with
+    strOldFileName = determineCompareFile(lastRun())
     print("ToCompareAgainst: " + strOldFileName)
 
-    dfOldCards = pandas.read_csv(
-        DATA_DIR_NAME + strOldFileName, dtype={'Card Number': object})
-    dfOldCards = cleanCardDataFrame(dfOldCards)
-    dfOldCards = dfOldCards.rename(
+    # old snapshots get compared against over and over, so these mostly come straight from the cache
+    with stageSpan("ingest") as span:
+        dfOldCards = readOldCards(strOldFileName)
+        span["rows"] = len(dfOldCards)
+    return strOldFileName, dfOldCards
+
+
+def fetchTodaysCards(strTodayFileName, fMinRowRatio=DECKBOX_MIN_ROW_RATIO):
+    """make sure today's export is there (going to Deckbox for it if it isn't) and read it
+    a fresh download was already parsed while it came in, so that only needs its card ids and caching"""
+    with stageSpan("fetch"):
+        dfFetched = fetchAndWriteDeckboxLibrary(strTodayFileName, fMinRowRatio)
+    with stageSpan("ingest") as span:
+        if dfFetched is None:
+            dfTodaysCards = readCleanSnapshot(strTodayFileName)
+        else:
+            dfTodaysCards = addCardIds(dfFetched)
+            writeSnapshotCache(strTodayFileName, dfTodaysCards)
+        span["rows"] = len(dfTodaysCards)
+    return dfTodaysCards
+
+
+def startupTasks(strTodayFileName, dictConfig, dictCardLibrary=None):
+    """the start of a run is three independent things, two of them waiting on the network: today's export (fetch and parse), the card
+    library (freshness check, download, index) and parsing the snapshot to compare against. Run them all at once
+    returns today's df, the compare df, the compare file name and the sort index (dictCardLibrary if one's passed in, batch mode does)"""
+    dictTasks = {"deckbox export": lambda: fetchTodaysCards(strTodayFileName, dictConfig.get("deckbox-min-row-ratio", DECKBOX_MIN_ROW_RATIO))}
+    if dictCardLibrary is not None:
+        dictTasks["card library"] = lambda: dictCardLibrary
+    else:
+        dictTasks["card library"] = lambda: buildCardLibrary(dictConfig.get("library-ttl-hours", LIBRARY_TTL_HOURS))
+    # on the very first run there's nothing to compare against until today's export shows up, so that one waits
+    if len(catalogSnapshots()) > 0:
+        dictTasks["compare snapshot"] = readCompareCards
+    dictResults = runConcurrently(dictTasks, dictConfig.get("startup-timeout-seconds", STARTUP_TIMEOUT_SECONDS))
+    strOldFileName, dfOldCards = dictResults["compare snapshot"] if "compare snapshot" in dictResults else readCompareCards()
+    return dictResults["deckbox export"], dfOldCards, strOldFileName, dictResults["card library"]
+
+
+def runConcurrently(dictTasks, fTimeout):
+    """run independent tasks (name -> function) at the same time in threads and return name -> result
+    every task that fails, or is still going after fTimeout seconds, gets reported by name and then the whole thing raises RuntimeError"""
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(dictTasks), thread_name_prefix="card-check")
+    try:
+        dictFutures = {strName: executor.submit(fn) for strName, fn in dictTasks.items()}
+        concurrent.futures.wait(dictFutures.values(), timeout=fTimeout)
+    finally:
+        # don't sit on a stuck task, its request timeout ends it eventually
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    dictResults = {}
+    listFailures = []
+    for strName, future in dictFutures.items():
+        if not future.done():
+            print(strName + " is still going after " + str(fTimeout) + " seconds, giving up on it")
+            listFailures.append((strName, None))
+        elif future.exception() is not None:
+            print(strName + " failed: " + repr(future.exception()))
+            listFailures.append((strName, future.exception()))
+        else:
+            dictResults[strName] = future.result()
+    if len(listFailures) > 0:
+        raise RuntimeError("couldn't get started, failed: " + ", ".join(strName for strName, err in listFailures)) from listFailures[0][1]
+    return dictResults
+
+
+def readOldCards(strOldFileName):
+    """read a snapshot to compare against, with the count and price columns renamed for the merge"""
+    dfOldCards = readCleanSnapshot(strOldFileName)
+    return dfOldCards.rename(
         index=str, columns={"Count": "OldCount", "Price": "OldPrice"})
 
-    return dfTodaysCards, dfOldCards, strOldFileName
+
+def cachedMerge(dfNew, dfOld, strTodayFileName, strOldFileName, dictCardLibrary, dictNameCache=None, bWriteMerged=True):
+    """buildMergeDF, unless it's already been done for exactly these inputs (both CSVs' contents, the library version, the card ids)
+    returns the merged df and the stage cache key, which is what the query stage's key is built on"""
+    strKey = stageCacheKey("merge", [snapshotSHA1(strTodayFileName), snapshotSHA1(strOldFileName),
+                                     libraryVersionKey(Path(LIBRARY_ZIP_FILE_NAME)), identityStoreId()])
+    cached = readStageCache(strKey)
+    if cached is not None:
+        print("same inputs as an earlier run, using its merge of " + strTodayFileName + " with " + strOldFileName)
+        return cached[0], strKey
+    dfMergeCards = buildMergeDF(dfNew, dfOld, dictCardLibrary, dictNameCache, bWriteMerged)
+    writeStageCache(strKey, dfMergeCards, {})
+    return dfMergeCards, strKey
+
+
+def cachedQuery(dfMergeCards, strMergeKey, listTiers=PRICE_TIERS):
+    """queryForReports, unless it's already been done on the same merge with the same boxes, then only the split into buckets gets redone
+    either way dfMergeCards comes out with its "Bucket" column"""
+    strKey = stageCacheKey("query", [strMergeKey, listTiers])
+    cached = readStageCache(strKey)
+    if cached is not None:
+        dfBuckets, dictExtra = cached
+        dfMergeCards["Bucket"] = pandas.Categorical.from_codes(dfBuckets["Bucket"].cat.codes.to_numpy(), categories=transitionBuckets(listTiers))
+        dictResults, dictResultStats = splitBuckets(dfMergeCards, listTiers)
+        dictResults["bucket-stats"] = pandas.DataFrame(**dictExtra["bucket-stats"])
+        dictResultStats["stats"] = dictExtra["stats"]
+        return dictResults, dictResultStats
+    dictResults, dictResultStats = queryForReports(dfMergeCards, listTiers)
+    writeStageCache(strKey, dfMergeCards[["Bucket"]], {"bucket-stats": dictResults["bucket-stats"].to_dict(orient="split"),
+                                                       "stats": dictResultStats["stats"]})
+    return dictResults, dictResultStats
+
+
+def horizonCompareFile(strTodayFileName, intDays, listCardsCSVs):
+    """pick the snapshot to compare against for "about intDays ago": the newest one on or before that date
+    if nothing is that old, the oldest there is. None if there's nothing older than today at all"""
+    dtTarget = datetime.datetime.strptime(strTodayFileName.split("-")[0], "%Y%m%d") - datetime.timedelta(days=intDays)
+    strTarget = today_csv_file_name(dtTarget.strftime("%Y%m%d"))
+    listOlder = [strFileName for strFileName in sorted(listCardsCSVs) if strFileName < strTodayFileName]
+    if len(listOlder) == 0:
+        return None
+    listCandidates = [strFileName for strFileName in listOlder if strFileName <= strTarget]
+    return listCandidates[-1] if len(listCandidates) > 0 else listOlder[0]
+
+
+def compareHorizons(strTodayFileName, dfTodaysCards, listHorizonDays, dictCardLibrary, dictNameCache, listTiers=PRICE_TIERS):
+    """compare today (already parsed) against a snapshot from about N days ago for each N, sharing the library and categorized names
+    returns a list of (label, old file name, merged df, results, stats), so the extra cost is just a join and query per horizon"""
+    listCardsCSVs = catalogSnapshots()
+    listHorizons = []
+    for intDays in listHorizonDays:
+        strOldFileName = horizonCompareFile(strTodayFileName, intDays, listCardsCSVs)
+        if strOldFileName is None:
+            print("nothing old enough to compare " + str(intDays) + " days back")
+            continue
+        print("ToCompareAgainst (" + str(intDays) + " days): " + strOldFileName)
+        with stageSpan("ingest") as span:
+            dfOldCards = readOldCards(strOldFileName)
+            span["rows"] = len(dfOldCards)
+        with stageSpan("merge") as span:
+            dfMergeCards, strMergeKey = cachedMerge(dfTodaysCards, dfOldCards, strTodayFileName, strOldFileName, dictCardLibrary, dictNameCache,
+                                                    bWriteMerged=False)
+            span["rows"] = len(dfMergeCards)
+        with stageSpan("query", len(dfMergeCards)):
+            dictResults, dictResultStats = cachedQuery(dfMergeCards, strMergeKey, listTiers)
+        listHorizons.append((str(intDays) + " days", strOldFileName, dfMergeCards, dictResults, dictResultStats))
+    return listHorizons
+
+
+def residentFileKey(strFileName):
+    """what a resident snapshot is good for: the file holding it, its size and mtime. A rewritten or stored away snapshot gets read again"""
+    strPath = snapshotFilePath(strFileName)
+    statFile = os.stat(strPath)
+    return (strPath, statFile.st_size, statFile.st_mtime_ns)
+
+
+def residentSnapshot(strFileName):
+    """a snapshot from the daemon's memory if it's been read before and its file hasn't changed, otherwise read it and keep it
+    (the DAEMON_RESIDENT_SNAPSHOTS most recently used). Callers get their own copy, so the merge is free to change it"""
+    tupleKey = residentFileKey(strFileName)
+    with residentLock:
+        tupleResident = daemonState["snapshots"].get(strFileName)
+        if tupleResident is not None and tupleResident[0] == tupleKey:
+            daemonState["snapshots"].move_to_end(strFileName)
+            return tupleResident[1].copy()
+    df = loadCleanSnapshot(strFileName)
+    with residentLock:
+        daemonState["snapshots"][strFileName] = (tupleKey, df)
+        daemonState["snapshots"].move_to_end(strFileName)
+        while len(daemonState["snapshots"]) > DAEMON_RESIDENT_SNAPSHOTS:
+            daemonState["snapshots"].popitem(last=False)
+    return df.copy()
+
+
+def residentCardLibrary(fTTLHours=LIBRARY_TTL_HOURS):
+    """the sort index, loaded once and again only when the library zip changes (the data/ watcher keeps the zip fresh)"""
+    if daemonState["card-library"] is None or libraryVersionKey(Path(LIBRARY_ZIP_FILE_NAME)) != daemonState["library-key"]:
+        daemonState["card-library"] = buildCardLibrary(fTTLHours)
+        daemonState["library-key"] = libraryVersionKey(Path(LIBRARY_ZIP_FILE_NAME))
+    return daemonState["card-library"]
+
+
+def residentMerge(strNewFileName, strOldFileName, fTTLHours=LIBRARY_TTL_HOURS, listTiers=PRICE_TIERS):
+    """merged and queried snapshots (df, results, stats) from the daemon's memory, or made from the resident snapshots and kept
+    only good as long as both files, the library and the boxes are the same"""
+    dictCardLibrary = residentCardLibrary(fTTLHours)
+    tupleKey = (residentFileKey(strNewFileName), residentFileKey(strOldFileName), daemonState["library-key"], str(listTiers))
+    with residentLock:
+        tupleResident = daemonState["merges"].get((strNewFileName, strOldFileName))
+        if tupleResident is not None and tupleResident[0] == tupleKey:
+            daemonState["merges"].move_to_end((strNewFileName, strOldFileName))
+            return tupleResident[1]
+    dfMergeCards, strMergeKey = cachedMerge(readCleanSnapshot(strNewFileName), readOldCards(strOldFileName), strNewFileName, strOldFileName,
+                                            dictCardLibrary, bWriteMerged=False)
+    dictResults, dictResultStats = cachedQuery(dfMergeCards, strMergeKey, listTiers)
+    with residentLock:
+        daemonState["merges"][(strNewFileName, strOldFileName)] = (tupleKey, (dfMergeCards, dictResults, dictResultStats))
+        while len(daemonState["merges"]) > DAEMON_RESIDENT_MERGES:
+            daemonState["merges"].popitem(last=False)
+    return dfMergeCards, dictResults, dictResultStats
+
+
+def runDaemon(dictConfig):
+    """stay up with the card library and recent snapshots parsed in memory, answering requests on a local socket, so a compare or a
+    "what moved this week" doesn't pay for the imports, the library and the parsing every time. One json request per line and one json
+    reply per line, see daemonRequest for what it can do. From a shell: check.py --ask '{"command": "status"}', or nc -U data/check.sock
+    meanwhile a thread watches data/ for new exports and reads them ahead of time"""
+    strSocket = dictConfig.get("daemon-socket", DAEMON_SOCKET_FILE_NAME)
+    if os.path.exists(strSocket):
+        # the socket of a daemon that died refuses connections, anything else (even a slow answer) means one is still there
+        try:
+            askDaemon({"command": "status"}, strSocket, 5)
+        except (ConnectionRefusedError, FileNotFoundError):
+            os.remove(strSocket)
+        except OSError as err:
+            raise RuntimeError("something is listening on " + strSocket + " but didn't answer (" + repr(err) + "), not starting another daemon")
+        else:
+            raise RuntimeError("there's already a daemon listening on " + strSocket)
+
+    daemonState.update({"resident": True, "started": datetime.datetime.now().timestamp(), "requests": 0})
+    try:
+        # warm up: the library, the catalog and the newest snapshots, which is what the next compare will want
+        with daemonRequestLock:
+            daemonTick(dictConfig)
+            for strFileName in catalogSnapshots()[-2:]:
+                readCleanSnapshot(strFileName)
+        server = socketserver.ThreadingUnixStreamServer(strSocket, DaemonHandler)
+        server.dictConfig = dictConfig
+        evStop = threading.Event()
+        threading.Thread(target=watchDataDir, args=(dictConfig, evStop), name="daemon-watch", daemon=True).start()
+        print("daemon listening on " + strSocket)
+        try:
+            server.serve_forever()
+        finally:
+            evStop.set()
+            server.server_close()
+            if os.path.exists(strSocket):
+                os.remove(strSocket)
+    finally:
+        daemonState.update({"resident": False, "card-library": None, "library-key": None})
+        daemonState["snapshots"].clear()
+        daemonState["merges"].clear()
+    print("daemon stopped after " + str(daemonState["requests"]) + " requests")
+
+
+def watchDataDir(dictConfig, evStop):
+    """the daemon's watcher thread, a daemonTick every "daemon-poll-seconds" until evStop. Polling, so it works wherever data/ lives"""
+    while not evStop.wait(dictConfig.get("daemon-poll-seconds", DAEMON_POLL_SECONDS)):
+        with daemonRequestLock:
+            try:
+                daemonTick(dictConfig)
+            except Exception as err:
+                # a bad export or no network shouldn't take the daemon down, the next look might go better
+                print("daemon couldn't look around data/: " + repr(err))
+
+
+def daemonTick(dictConfig):
+    """one look around for the daemon: exports that showed up in data/ get cataloged and parsed ahead of time, and the card library
+    gets its usual freshness check (nothing happens inside its TTL)"""
+    fTTLHours = dictConfig.get("library-ttl-hours", LIBRARY_TTL_HOURS)
+    freshenCardLibrary(Path(LIBRARY_ZIP_FILE_NAME), fTTLHours)
+    residentCardLibrary(fTTLHours)
+    setKnown = set(catalogSnapshots())
+    for strFileName in sorted(strName for strName in os.listdir(DATA_DIR_NAME) if strName.endswith("magic-cards.csv")):
+        if strFileName not in setKnown:
+            print("daemon found a new export: " + strFileName)
+            registerSnapshot(strFileName)
+            readCleanSnapshot(strFileName)
+
+
+def daemonRequest(dictRequest, dictConfig):
+    """do what one daemon request asks and return the reply:
+    "status": what's loaded. "compare": a whole run like main's, "mail": false to skip the email. "render": write the report for
+    "new-file" with "old-file" (the last run's by default) again, "mode" static or data, "html": true to get it back too.
+    "moves": what moved since about "days" ago, the biggest "limit" changes. "card": the newest snapshot's rows (up to "limit") for names
+    containing "name".
+    "shutdown": stop"""
+    strCommand = dictRequest.get("command")
+    fTTLHours = dictConfig.get("library-ttl-hours", LIBRARY_TTL_HOURS)
+    listTiers = priceTiers(dictConfig)
+    if strCommand == "status":
+        # answered without daemonRequestLock (see DaemonHandler), so it only reads and only under residentLock
+        bBusy = not daemonRequestLock.acquire(blocking=False)
+        if not bBusy:
+            daemonRequestLock.release()
+        with residentLock:
+            return {"version": CURRENT_VERSION, "up-seconds": round(datetime.datetime.now().timestamp() - daemonState["started"], 1),
+                    "requests": daemonState["requests"], "snapshots": list(daemonState["snapshots"]),
+                    "merges": [list(tupleFiles) for tupleFiles in daemonState["merges"]], "library-key": daemonState["library-key"],
+                    "busy": bBusy}
+
+    if strCommand == "compare":
+        startStageSpans()
+        startHttp(dictConfig)
+        dictOutcome = compareCollection(dictConfig, datetime.datetime.now(), residentCardLibrary(fTTLHours), bMail=dictRequest.get("mail", True))
+        return {"new-file": dictOutcome["new-file"], "old-file": dictOutcome["old-file"], "report-file": dictOutcome["report-file"],
+                "stats": dictOutcome["stats"], "stages": stageSpanReport()}
+
+    if strCommand == "render":
+        dictLastRun = lastRun() or {}
+        strNewFileName = dictRequest.get("new-file", dictLastRun.get("new-file"))
+        strOldFileName = dictRequest.get("old-file", dictLastRun.get("old-file"))
+        if strNewFileName is None or strOldFileName is None:
+            raise ValueError("no run logged yet, say which new-file and old-file to render")
+        dfMergeCards, dictResults, dictResultStats = residentMerge(strNewFileName, strOldFileName, fTTLHours, listTiers)
+        strReportFileName = DATA_DIR_NAME + strNewFileName.split("-")[0] + "-report.htm"
+        with open(strReportFileName, "w", encoding="utf-8") as file:
+            writeHTMLReport(file, dfMergeCards, dictResults, dictResultStats, strNewFileName, strOldFileName,
+                            dictRequest.get("mode", dictConfig.get("report-mode", "static")), listTiers=listTiers)
+        dictReply = {"new-file": strNewFileName, "old-file": strOldFileName, "report-file": strReportFileName,
+                     "bytes": os.path.getsize(strReportFileName)}
+        if dictRequest.get("html"):
+            with open(strReportFileName, "r", encoding="utf-8") as file:
+                dictReply["html"] = file.read()
+        return dictReply
+
+    if strCommand == "moves":
+        listCardsCSVs = catalogSnapshots()
+        strNewFileName = dictRequest.get("new-file", listCardsCSVs[-1] if len(listCardsCSVs) > 0 else None)
+        strOldFileName = None if strNewFileName is None else horizonCompareFile(strNewFileName, dictRequest.get("days", 7), listCardsCSVs)
+        if strOldFileName is None:
+            raise ValueError("need at least two snapshots to say what moved")
+        dfMergeCards, dictResults, dictResultStats = residentMerge(strNewFileName, strOldFileName, fTTLHours, listTiers)
+        # pick the rows off the one column, only those few get pulled out of the frame
+        arrTotalChange = dfMergeCards["TotalChange"].to_numpy()
+        arrMoved = numpy.flatnonzero(arrTotalChange != 0)
+        arrMagnitude = numpy.abs(arrTotalChange[arrMoved])
+        intLimit = min(dictRequest.get("limit", 20), len(arrMoved))
+        arrTop = numpy.argpartition(-arrMagnitude, intLimit - 1)[:intLimit] if intLimit > 0 else arrMoved[:0]
+        arrTop = arrMoved[arrTop[numpy.lexsort((arrTop, -arrMagnitude[arrTop]))]]
+        dfTop = dollarFrame(dfMergeCards.iloc[arrTop][["Name", "Edition", "Condition", "IsFoil", "OldCount", "NewCount", "OldPrice", "NewPrice",
+                                                       "TotalChange", "Bucket"]])
+        return {"new-file": strNewFileName, "old-file": strOldFileName, "stats": dictResultStats["stats"],
+                "buckets": {strBucket: dictResultStats["count-" + strBucket] for strBucket in transitionBuckets(listTiers)},
+                "moves": dfTop.to_dict(orient="records")}
+
+    if strCommand == "card":
+        listCardsCSVs = catalogSnapshots()
+        if len(listCardsCSVs) == 0:
+            raise ValueError("no snapshots yet")
+        df = readCleanSnapshot(listCardsCSVs[-1])
+        # match against the distinct names, not every row
+        listNames = [strName for strName in df["Name"].cat.categories if str(dictRequest.get("name", "")).lower() in strName.lower()]
+        arrMatches = numpy.flatnonzero(df["Name"].isin(listNames).to_numpy())
+        dfCards = df.iloc[arrMatches[:dictRequest.get("limit", 100)]]
+        dfCards = dfCards.assign(Price=dollars(dfCards["Price"]))[["Name", "Edition", "Card Number", "Condition", "Foil", "Count",
+                                                                   "Tradelist Count", "Price"]]
+        return {"file": listCardsCSVs[-1], "matches": len(arrMatches),
+                "cards": dfCards.astype(object).where(dfCards.notna(), None).to_dict(orient="records")}
+
+    if strCommand == "shutdown":
+        return {"stopping": True}
+    raise ValueError("don't know how to " + str(strCommand))
+
+
+class DaemonHandler(socketserver.StreamRequestHandler):
+    """one client connection to the daemon, it can send as many requests as it likes, a line each"""
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            dictRequest = {}
+            fStart = timer()
+            try:
+                dictRequest = json.loads(line)
+                with residentLock:
+                    daemonState["requests"] += 1
+                # status answers straight away even in the middle of a compare, it's how a second daemon tells this one is alive
+                with daemonRequestLock if dictRequest.get("command") != "status" else contextlib.nullcontext():
+                    dictReply = dict(daemonRequest(dictRequest, self.server.dictConfig), ok=True)
+            except Exception as err:
+                print("daemon request " + line.decode("utf-8", "replace").strip() + " failed: " + repr(err))
+                dictReply = {"ok": False, "error": repr(err)}
+            dictReply["seconds"] = round(timer() - fStart, 4)
+            self.wfile.write((json.dumps(dictReply, default=default_numpy) + "\n").encode("utf-8"))
+            if dictReply["ok"] and dictRequest.get("command") == "shutdown":
+                self.server.shutdown()
+                return
+
+
+def askDaemon(dictRequest, strSocketFileName=DAEMON_SOCKET_FILE_NAME, fTimeout=None):
+    """send the daemon one request and return its reply"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(fTimeout)
+        sock.connect(strSocketFileName)
+        sock.sendall((json.dumps(dictRequest) + "\n").encode("utf-8"))
+        with sock.makefile("rb") as file:
+            return json.loads(file.readline())
 
 
 def today_csv_file_name(strToday=datetime.datetime.now().strftime("%Y%m%d")):
@@ -941,35 +3023,253 @@ def today_csv_file_name(strToday=datetime.datetime.now().strftime("%Y%m%d")):
     return strTodayFileName
 
 
+def collectionConfigs(dictConfig):
+    """the config for each collection in batch mode: the shared settings with the collection's own on top
+    a collection is something like {"name": "consignment", "deckbox-set-id": "123", "cookie-file": "cookies-consign.json",
+    "data-dir": "data/consignment/", "trade-box-threshold": 10, "bulk-box-threshold": 3}, anything else overrides the shared config"""
+    dictShared = {strKey: value for strKey, value in dictConfig.items() if strKey != "collections"}
+    return [dict(dictShared, **dictCollection) for dictCollection in dictConfig["collections"]]
+
+
+def useCollection(dictConfig):
+    """point data/ and everything under it, the cookies, the Deckbox set and the box thresholds at one collection
+    whatever the collection's config (shared settings included, see collectionConfigs) leaves out goes back to DEFAULT_COLLECTION_SETTINGS,
+    never to the last collection's, a pool worker runs one collection after another. The card library zip and its sort index stay put"""
+    global DATA_DIR_NAME, RUN_LOG_FILE_NAME, SNAPSHOT_CACHE_DIR_NAME, HISTORY_DB_FILE_NAME, STAGE_CACHE_DIR_NAME, SNAPSHOT_STORE_DIR_NAME
+    global COOKIE_FILE_NAME, DECKBOX_SET_ID, TRADE_BOX_THRESHOLD, BULK_BOX_THRESHOLD
+    DATA_DIR_NAME = dictConfig["data-dir"].rstrip("/") + "/"
+    RUN_LOG_FILE_NAME = DATA_DIR_NAME + "run-log.json"
+    SNAPSHOT_CACHE_DIR_NAME = DATA_DIR_NAME + "cache/"
+    HISTORY_DB_FILE_NAME = DATA_DIR_NAME + "card-history.db"
+    STAGE_CACHE_DIR_NAME = DATA_DIR_NAME + "stages/"
+    SNAPSHOT_STORE_DIR_NAME = DATA_DIR_NAME + "snapshots/"
+    dictSettings = dict(DEFAULT_COLLECTION_SETTINGS, **{strKey: dictConfig[strKey] for strKey in DEFAULT_COLLECTION_SETTINGS if strKey in dictConfig})
+    COOKIE_FILE_NAME = dictSettings["cookie-file"]
+    DECKBOX_SET_ID = str(dictSettings["deckbox-set-id"])
+    TRADE_BOX_THRESHOLD = dictSettings["trade-box-threshold"]
+    BULK_BOX_THRESHOLD = dictSettings["bulk-box-threshold"]
+    os.makedirs(DATA_DIR_NAME, exist_ok=True)
+
+
+def compareCollectionWorker(dictConfig, strLibraryZip, strIndexFileName, bDebug):
+    """a batch worker process's job: switch to the collection, read the shared sort index (never AtomicCards) and run the compare
+    each worker reads the index into a dict of its own, that's one copy per worker but still a lot cheaper than indexing AtomicCards.
+    the email is left to the batch process, see runBatch"""
+    if bDebug:
+        logging.getLogger(__name__).setLevel(logging.DEBUG)
+    global LIBRARY_ZIP_FILE_NAME
+    LIBRARY_ZIP_FILE_NAME = strLibraryZip
+    useCollection(dictConfig)
+    startStageSpans()
+    startHttp(dictConfig)
+    dictCardLibrary = readSortIndex(libraryVersionKey(Path(strLibraryZip)), strIndexFileName)
+    if dictCardLibrary is None:
+        raise RuntimeError("the shared sort index " + strIndexFileName + " doesn't match " + strLibraryZip + " anymore")
+    print("comparing collection " + str(dictConfig.get("name")) + " in " + DATA_DIR_NAME)
+    return compareCollection(dictConfig, datetime.datetime.now(), dictCardLibrary, bMail=False)
+
+
+def runBatch(dictConfig, dtScriptStart):
+    """compare every collection in the config's "collections", in a pool of worker processes ("batch-workers", default one per cpu)
+    the card library gets freshened and indexed once here, the workers only read the index file. each collection gets its own report
+    and email, and there's one summary of them all, written to data/ and mailed to the shared "to-email" """
+    listConfigs = collectionConfigs(dictConfig)
+    with stageSpan("library"):
+        buildCardLibrary(dictConfig.get("library-ttl-hours", LIBRARY_TTL_HOURS))
+    bDebug = logging.getLogger(__name__).getEffectiveLevel() <= logging.DEBUG
+
+    intWorkers = min(len(listConfigs), dictConfig.get("batch-workers", os.cpu_count() or 1))
+    listOutcomes = []
+    with stageSpan("collections", len(listConfigs)):
+        with concurrent.futures.ProcessPoolExecutor(max_workers=intWorkers) as executor:
+            listFutures = [executor.submit(compareCollectionWorker, dictCollection, os.path.abspath(LIBRARY_ZIP_FILE_NAME),
+                                           os.path.abspath(SORT_INDEX_FILE_NAME), bDebug) for dictCollection in listConfigs]
+            for dictCollection, future in zip(listConfigs, listFutures):
+                try:
+                    listOutcomes.append((dictCollection, future.result(), None))
+                except Exception as err:
+                    print("collection " + str(dictCollection.get("name")) + " failed: " + repr(err))
+                    listOutcomes.append((dictCollection, None, err))
+
+    strToday = datetime.datetime.now().strftime("%Y%m%d")
+    strSummaryFileName = DATA_DIR_NAME + strToday + "-batch-summary.htm"
+    with open(strSummaryFileName, "w", encoding="utf-8") as file:
+        writeBatchSummary(file, listOutcomes, today_csv_file_name(strToday))
+    print("batch summary in " + strSummaryFileName)
+
+    # every email from one process, so they share the one pooled connection
+    if not bDebug:
+        for dictCollection, dictOutcome, err in listOutcomes:
+            if dictOutcome is not None and dictOutcome["report-file"] is not None:
+                with open(dictOutcome["report-file"], "r", encoding="utf-8") as file:
+                    queueMail(file.read(), dictCollection, dictOutcome["summary-html"], os.path.basename(dictOutcome["report-file"]) + ".gz")
+        with open(strSummaryFileName, "r", encoding="utf-8") as file:
+            queueMail(file.read(), dictConfig, None, os.path.basename(strSummaryFileName) + ".gz")
+
+    # same as a single run, a failed email gets reported after the timings (nothing was queued in debug mode)
+    try:
+        finishMail()
+    finally:
+        print("Total time elapsed: " + str(datetime.datetime.now().timestamp() - dtScriptStart.timestamp()))
+        printStageSpans()
+    listFailed = [str(dictCollection.get("name")) for dictCollection, dictOutcome, err in listOutcomes if err is not None]
+    if len(listFailed) > 0:
+        raise RuntimeError("batch finished, but these collections failed: " + ", ".join(listFailed)) \
+            from next(err for dictCollection, dictOutcome, err in listOutcomes if err is not None)
+    return listOutcomes
+
+
+def writeBatchSummary(htmlStringWriter, listOutcomes, strTodayFileName):
+    """one page over all the collections in a batch: a row each with the headline numbers and where its report is, then each one's stats
+    in: list of (collection config, what compareCollection returned or None, the exception if it failed)"""
+    writeReportHead(htmlStringWriter, strTodayFileName)
+    htmlStringWriter.write("<h2>" + prettySnapshotDate(strTodayFileName) + ", " + str(len(listOutcomes)) + " collections</h2>")
+    htmlStringWriter.write("<table border=1 class=\"dataframe\"><thead><tr style=\"text-align: left;\"><th>Collection</th><th>Compared with</th>"
+                           "<th>Cards</th><th>To move</th><th>New</th><th>Gone</th><th>Value</th><th>Net change</th><th>Report</th></tr></thead><tbody>")
+    for dictCollection, dictOutcome, err in listOutcomes:
+        htmlStringWriter.write("<tr><td>" + str(dictCollection.get("name", dictCollection["data-dir"])) + "</td>")
+        if err is not None:
+            htmlStringWriter.write("<td colspan=8>failed: " + str(err).replace("<", "&lt;") + "</td></tr>")
+        elif dictOutcome["report-file"] is None:
+            htmlStringWriter.write("<td>" + prettySnapshotDate(dictOutcome["old-file"]) + "</td><td colspan=7>no changes</td></tr>")
+        else:
+            dictStats = dictOutcome["stats"]
+            htmlStringWriter.write("<td>" + prettySnapshotDate(dictOutcome["old-file"]) + "</td><td>" + str(dictStats["stats"]["total-cards"])
+                                   + "</td><td>" + str(dictStats["count-all-results"] - dictStats["count-unch-cards"] - dictStats["count-new-cards"]
+                                                       - dictStats["count-gone-cards"]) + "</td><td>" + str(dictStats["count-new-cards"])
+                                   + "</td><td>" + str(dictStats["count-gone-cards"]) + "</td><td>" + "${:,.2f}".format(dictStats["stats"]["total-value"])
+                                   + "</td><td>" + "${:,.2f}".format(dictStats["stats"]["net-value-change"]) + "</td><td>"
+                                   + dictOutcome["report-file"] + "</td></tr>")
+    htmlStringWriter.write("</tbody></table>")
+    for dictCollection, dictOutcome, err in listOutcomes:
+        if dictOutcome is not None and dictOutcome["report-file"] is not None:
+            htmlStringWriter.write("<h2>" + str(dictCollection.get("name", dictCollection["data-dir"])) + "</h2>" + htmlStats(dictOutcome["stats"]["stats"]))
+    writeReportFoot(htmlStringWriter)
+
+
 def main():
     dtScriptStart = datetime.datetime.now()
     print("Hello World from version " + CURRENT_VERSION + " on " + HOST_NAME)
 
-    dictConfig = configure()
-
+    # --profile dumps cProfile stats per stage (and traces memory), --trace-memory just adds peak memory per stage to the metrics
+    bProfile = "--profile" in sys.argv
+    startStageSpans(bProfile or "--trace-memory" in sys.argv,
+                    DATA_DIR_NAME + "profile/" + dtScriptStart.strftime("%Y%m%d-%H%M%S") + "/" if bProfile else None)
+
+    with stageSpan("config"):
+        dictConfig = configure()
+
+    # --record-http saves every response, --replay-http runs from those alone (see startHttp)
+    if "--record-http" in sys.argv:
+        dictConfig["http-mode"] = "record"
+    elif "--replay-http" in sys.argv:
+        dictConfig["http-mode"] = "replay"
+    startHttp(dictConfig)
+
+    # --migrate-snapshots moves every snapshot CSV but the newest into the snapshot store, then stops
+    if "--migrate-snapshots" in sys.argv:
+        migrateSnapshots()
+        return
+    # --batch runs every collection in the config's "collections" list instead, see runBatch
+    if "--batch" in sys.argv:
+        runBatch(dictConfig, dtScriptStart)
+        return
+    # --daemon stays up with everything loaded and answers compares and queries on a local socket (see runDaemon), --ask '<json>' asks it
+    if "--daemon" in sys.argv:
+        runDaemon(dictConfig)
+        return
+    if "--ask" in sys.argv:
+        print(json.dumps(askDaemon(json.loads(sys.argv[sys.argv.index("--ask") + 1]), dictConfig.get("daemon-socket", DAEMON_SOCKET_FILE_NAME)),
+                         indent=1))
+        return
+    compareCollection(dictConfig, dtScriptStart)
+
+
+def compareCollection(dictConfig, dtScriptStart, dictCardLibrary=None, bMail=True):
+    """one whole compare run for the collection data/ (and the Deckbox set, cookies) points at: fetch, merge, query, report, mail, log
+    batch mode passes in the already loaded dictCardLibrary and bMail=False, so its process mails everything over one connection
+    returns the files compared, the report file, the email summary (if the report needs one) and the result stats"""
     strToday = datetime.datetime.now().strftime("%Y%m%d")
 
     strTodayFileName = today_csv_file_name(strToday)
     print("CSV that I want for today: " + strTodayFileName)
 
-    fetchAndWriteDeckboxLibrary(strTodayFileName)
+    # the Deckbox export, the card library and the compare snapshot all at once, see startupTasks
+    with stageSpan("startup"):
+        dfTodaysCards, dfOldCards, strOldFileName, dictCardLibrary = startupTasks(strTodayFileName, dictConfig, dictCardLibrary)
 
     debug("OK cool, now I have a CSV of my library, a dictionary of every magic card ever that's up to date. Now I can check for price diffs")
 
-    dfTodaysCards, dfOldCards, strOldFileName = buildCompareDFs(strTodayFileName)
-    dfMergeCards = buildMergeDF(dfTodaysCards, dfOldCards)
-    dictResults, dictResultStats = queryForReports(dfMergeCards)
+    # nothing changed since the snapshot it'd be compared with, so there's nothing to report. Just log the run so the next one moves on
+    # not with compare horizons though, the week/month/quarter sections can still have changes in them
+    listHorizonDays = dictConfig.get("compare-horizons", [])
+    if len(listHorizonDays) == 0 and snapshotSHA1(strTodayFileName) == snapshotSHA1(strOldFileName):
+        print(strTodayFileName + " is identical to " + strOldFileName + ", nothing to report")
+        # the history still gets today's date (and nothing else, no card changed), so card series don't skip the quiet days
+        with stageSpan("history", len(dfTodaysCards)):
+            updateHistory(strTodayFileName, dfTodaysCards)
+        if (logging.getLogger(__name__).getEffectiveLevel() > logging.DEBUG):
+            updateRunLog(strOldFileName, strTodayFileName, dtScriptStart, datetime.datetime.now(), {"identical-to-old-file": True})
+        return {"new-file": strTodayFileName, "old-file": strOldFileName, "report-file": None, "summary-html": None,
+                "stats": {"identical-to-old-file": True}}
+
+    # merge and query come from the stage cache when they've been done on these exact inputs before (reruns, report layout tweaks)
+    dictNameCache = {}
+    listTiers = priceTiers(dictConfig)
+    with stageSpan("merge") as span:
+        dfMergeCards, strMergeKey = cachedMerge(dfTodaysCards, dfOldCards, strTodayFileName, strOldFileName, dictCardLibrary, dictNameCache)
+        span["rows"] = len(dfMergeCards)
+    with stageSpan("query", len(dfMergeCards)):
+        dictResults, dictResultStats = cachedQuery(dfMergeCards, strMergeKey, listTiers)
+
+    # all the work is done, now just print the reports (straight into the report file), first the changes from bulk
+    # "report-mode": "data" makes the report on disk a json backed page that copes with huge move lists, email still gets plain tables
+    strReportFileName = DATA_DIR_NAME + strToday + "-report.htm"
+    strReportMode = dictConfig.get("report-mode", "static")
+    if len(listHorizonDays) > 0:
+        # also compare against snapshots from a week/month/quarter (whatever's configured) ago, all in the one report and log entry
+        listHorizons = compareHorizons(strTodayFileName, dfTodaysCards, listHorizonDays, dictCardLibrary, dictNameCache, listTiers)
+        listHorizons = [("last run", strOldFileName, dfMergeCards, dictResults, dictResultStats)] + listHorizons
+        intReportRows = sum(len(horizon[2]) for horizon in listHorizons)
+        dictResultStats["horizons"] = {strLabel: dict(dictHorizonStats, **{"old-file": strHorizonFileName})
+                                       for strLabel, strHorizonFileName, dfHorizon, dictHorizonResults, dictHorizonStats in listHorizons[1:]}
+
+        def writeReport(file, strMode, intMaxRows=None):
+            writeHorizonReport(file, listHorizons, strTodayFileName, strMode, intMaxRows, listTiers)
+    else:
+        intReportRows = len(dfMergeCards)
 
-    # all the work is done, now just print the reports, first the changes from bulk
-    htmlString = buildHTMLReport(dfMergeCards, dictResults, dictResultStats, strTodayFileName, strOldFileName)
+        def writeReport(file, strMode, intMaxRows=None):
+            writeHTMLReport(file, dfMergeCards, dictResults, dictResultStats, strTodayFileName, strOldFileName, strMode, intMaxRows, listTiers)
 
-    with open(DATA_DIR_NAME + strToday + "-report.htm", "w", encoding="utf-8") as file:
-        file.write(htmlString)
+    with stageSpan("render", intReportRows):
+        with open(strReportFileName, "w", encoding="utf-8") as file:
+            writeReport(file, strReportMode)
 
+    strSummaryHTML = None
     # don't send mail if debug mode, this takes a few seconds and I usually don't want emails while testing stuff
+    # it goes out on a background thread while the history and run log get written, finishMail waits for it at the end
     if (logging.getLogger(__name__).getEffectiveLevel() > logging.DEBUG):
         print("log level is not debug, email")
-        sendMail(htmlString, dictConfig)
+        with open(strReportFileName, "r", encoding="utf-8") as file:
+            strHTML = file.read()
+        if strReportMode == "data" or len(strHTML.encode("utf-8")) > dictConfig.get("email-max-bytes", MAIL_MAX_HTML_BYTES):
+            # mail clients don't run scripts and big messages are slow, so the body is a static copy cut short if the move lists
+            # are long, and the full report goes along gzipped
+            htmlStringWriter = io.StringIO()
+            writeReport(htmlStringWriter, "static", dictConfig.get("email-max-rows", REPORT_EMAIL_MAX_ROWS))
+            strSummaryHTML = htmlStringWriter.getvalue()
+        if bMail:
+            queueMail(strHTML, dictConfig, strSummaryHTML, os.path.basename(strReportFileName) + ".gz")
+
+    # keep the price history going, only today's changes get written
+    with stageSpan("history", len(dfTodaysCards)):
+        updateHistory(strTodayFileName, dfTodaysCards)
+
+    # "snapshot-store": true keeps old snapshots as deltas instead of a whole CSV each, everything before today moves in
+    if dictConfig.get("snapshot-store"):
+        with stageSpan("store"):
+            storeOldSnapshots(strTodayFileName)
 
     dtScriptEnd = datetime.datetime.now()
     print("Total time elapsed: " + str(dtScriptEnd.timestamp() - dtScriptStart.timestamp()))
@@ -977,7 +3277,22 @@ def main():
     # don't log the run and clog up the log if debug mode
     if (logging.getLogger(__name__).getEffectiveLevel() > logging.DEBUG):
         print("log level is not debug, log run")
-        updateRunLog(strOldFileName, strTodayFileName, dtScriptStart, dtScriptEnd, dictResultStats)
+        with stageSpan("run-log"):
+            updateRunLog(strOldFileName, strTodayFileName, dtScriptStart, dtScriptEnd, dictResultStats)
+
+    # an email that didn't go out still gets reported, just after the timings and metrics of the run it was for
+    try:
+        finishMail()
+    finally:
+        printStageSpans()
+        printHttpMetrics()
+        if dictConfig.get("metrics-file"):
+            # the run-log stage only makes it into this copy, the run log entry was built before it finished
+            writeMetricsFile(dictConfig["metrics-file"],
+                             dict(runLogEntry(strOldFileName, strTodayFileName, dtScriptStart, dtScriptEnd, dictResultStats),
+                                  **{"when-run": dtScriptStart.strftime("%Y%m%d-%H:%M:%S:%f"), "collection": dictConfig.get("name")}))
+    return {"new-file": strTodayFileName, "old-file": strOldFileName, "report-file": strReportFileName, "summary-html": strSummaryHTML,
+            "stats": dictResultStats}
 
 
 if __name__ == "__main__":
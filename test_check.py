@@ -6,11 +6,28 @@ Used for debugging.
 Dumps out a full inventory to data dir.
 """
 
+import bench_check
 import check
 from pathlib import Path
+import hashlib
+import datetime
+import email
+import gzip
+import http.server
+import io
 import json
+import os
+import shutil
+import socket
+import socketserver
+import threading
+import time
+import tracemalloc
 import numpy
+import pandas
+import pytest
 import platform
+import zipfile
 
 
 def main():
@@ -29,12 +46,9 @@ def test_platform_node():
 
 def test_card_lib():
 
-    cardLibraryFile = Path(check.DATA_DIR_NAME + "AllCards.json")
+    cardLibraryZip = Path(check.DATA_DIR_NAME + "AllCards.zip")
 
-    with cardLibraryFile.open() as file:
-        cardLibraryDict = json.load(file)
-
-    return cardLibraryDict
+    return check.readLibraryZip(cardLibraryZip)
 
 
 def test_inventory():
@@ -47,12 +61,967 @@ def test_inventory():
 
 def test_sort_category(card_lib, inventory):
     """deckbox doesn't export color, so I add a column used for sorting"""
-    inventory["SortCategory"] = inventory["Name"].apply(
-        check.lookupSortCategory, args=(card_lib,))
+    inventory["SortCategory"] = check.categorizeNames(inventory["Name"], card_lib)
 
     return inventory
 
 
+def test_sort_index_round_trip(tmp_path):
+    """the compact sort index should give back the same categories as the full library, and go stale with the zip"""
+    dict_lib = {"data": {
+        "Lightning Bolt": [{"colors": ["R"], "types": ["Instant"]}],
+        "Fire // Ice": [{"colors": ["R"], "types": ["Instant"]}, {"colors": ["U"], "types": ["Instant"]}],
+        "Forest": [{"colors": [], "types": ["Land"]}],
+        "Sol Ring": [{"colors": [], "types": ["Artifact"]}],
+        "Niv-Mizzet, Parun": [{"colors": ["U", "R"], "types": ["Creature"]}]}}
+    dict_index = check.buildSortIndex(dict_lib)
+    assert dict_index == {"Lightning Bolt": "R", "Fire // Ice": "R", "Forest": "Land",
+                          "Sol Ring": "Colorless", "Niv-Mizzet, Parun": "Gold"}
+
+    index_file = str(tmp_path / "AllCards.sortidx")
+    check.writeSortIndex(dict_index, "123-456", index_file)
+    assert check.readSortIndex("123-456", index_file) == dict_index
+    assert check.readSortIndex("123-789", index_file) is None, "a different library version should force a rebuild"
+    assert check.readSortIndex("123-456", str(tmp_path / "nope")) is None
+
+    assert check.lookupSortCategory("Fire // Ice", dict_index) == "R"
+    assert check.lookupSortCategory("Not A Card", dict_index) == "Unknown"
+
+
+def test_stream_library_zip(tmp_path):
+    """streaming the json out of the zip, even in tiny chunks, should match loading the whole thing"""
+    dict_lib = {"meta": {"date": "2020-01-01", "version": "5.0.0"}, "data": {
+        "Fire // Ice": [{"faceName": "Fire", "colors": ["R"], "types": ["Instant"], "price": 1.5},
+                        {"faceName": "Ice", "colors": ["U"], "types": ["Instant"], "price": -2}],
+        "Forest": [{"colors": [], "types": ["Land"], "text": "({T}: Add {G}.) \u00e9 \\ \" }"}],
+        "Ice": [{"colors": ["G"], "types": ["Sorcery"]}]}}
+    lib_zip = tmp_path / "AllCards.zip"
+    with zipfile.ZipFile(str(lib_zip), "w", zipfile.ZIP_DEFLATED) as zip:
+        zip.writestr("AtomicCards.json", json.dumps(dict_lib, indent=2))
+
+    dict_index = check.readLibraryZip(lib_zip)
+    assert dict_index == {"Fire // Ice": "R", "Forest": "Land", "Ice": "G", "Fire": "R"}, \
+        "face names get indexed, but never over a real card"
+    assert check.buildSortIndex(dict_lib) == dict_index
+
+    entries = list(check.iterLibraryEntries(io.StringIO(json.dumps(dict_lib)), intChunkSize=3))
+    assert [name for name, entry in entries] == ["Fire // Ice", "Forest", "Ice"]
+    assert entries[0][1] == dict_lib["data"]["Fire // Ice"]
+
+    # the old flat AllCards layout still works
+    entries = list(check.iterLibraryEntries(io.StringIO(json.dumps({"Forest": {"types": ["Land"]}, "Ice": {"colors": ["U"]}})), 4))
+    assert entries == [("Forest", {"types": ["Land"]}), ("Ice", {"colors": ["U"]})]
+
+
+def test_categorize_names():
+    """each distinct name gets looked up once and broadcast back as an ordered category"""
+    dict_index = {"Lightning Bolt": "R", "Fire": "R", "Forest": "Land", "Swords to Plowshares": "W"}
+    names = pandas.Series(["Forest", "Lightning Bolt", "Fire // Ice", "Forest", None, "Mystery", "Swords to Plowshares"],
+                          index=[10, 11, 12, 13, 14, 15, 16])
+    categories = check.categorizeNames(names, dict_index)
+    assert list(categories) == ["Land", "R", "R", "Land", "Unknown", "Unknown", "W"]
+    assert list(categories.index) == list(names.index)
+    assert categories.cat.ordered
+    assert list(categories.sort_values()) == ["W", "R", "R", "Land", "Land", "Unknown", "Unknown"]
+    assert list(categories) == [check.lookupSortCategory(name, dict_index) if name else "Unknown" for name in names]
+
+
+def test_classify_box_transitions():
+    """every row lands in exactly one bucket, and a price sitting on a threshold belongs to the higher box"""
+    df = pandas.DataFrame({
+        "OldPrice": [50, 50, 300, 1000, 1000, 299, 0, 1200, 999, 300],
+        "NewPrice": [1000, 300, 1000, 300, 10, 200, 400, 0, 900, 299],
+        "IsNew": [False, False, False, False, False, False, True, False, False, False],
+        "IsGone": [False, False, False, False, False, False, False, True, False, False]})
+    buckets = check.classifyBoxTransitions(df)
+    assert list(buckets) == ["bulk-to-trades", "bulk-to-dollar", "dollar-to-trades", "trades-to-dollar", "trades-to-bulk",
+                             "unch-cards", "new-cards", "gone-cards", "unch-cards", "dollar-to-bulk"]
+
+    tiers = [("cheap", "Cheap", 0), ("mid", "Mid", 1), ("nice", "Nice", 5), ("wow", "Wow", 100)]
+    assert set(check.transitionBuckets(tiers)) >= {"cheap-to-wow", "wow-to-mid", "unch-cards"}
+    assert list(check.classifyBoxTransitions(df, tiers)) == ["cheap-to-nice", "cheap-to-mid", "mid-to-nice", "nice-to-mid",
+                                                             "nice-to-cheap", "unch-cards", "new-cards", "gone-cards",
+                                                             "unch-cards", "unch-cards"]
+
+
+def test_stats_table_matches_per_bucket_stats():
+    """one grouped pass should give the same numbers as working out each bucket on its own"""
+    df = pandas.DataFrame({"OldCount": [1, 2, 0, 4, 1], "NewCount": [2, 2, 3, 0, 1],
+                           "OldPrice": [50, 1200, 0, 400, 300], "NewPrice": [1100, 200, 500, 0, 300],
+                           "IsNew": [False, False, True, False, False], "IsGone": [False, False, False, True, False]})
+    df["CountChange"] = df["NewCount"] - df["OldCount"]
+    df["TotalChange"] = df["NewPrice"] * df["NewCount"] - df["OldPrice"] * df["OldCount"]
+    buckets = check.classifyBoxTransitions(df)
+
+    table = check.calcStatsTable(df, buckets)
+    assert set(table.index) == set(check.transitionBuckets()) | {"all"}
+    for bucket in ["bulk-to-trades", "trades-to-bulk", "new-cards", "gone-cards", "unch-cards", "dollar-to-trades"]:
+        assert check.statsDictFromTable(table, bucket) == check.calcStatsDict(df[buckets == bucket]), bucket
+    stats = check.statsDictFromTable(table, "all")
+    assert stats["total-cards"] == 5 and isinstance(stats["total-cards"], int)
+    assert stats["net-value-change"] == df["TotalChange"].sum() / 100, "money is reported in dollars"
+    assert check.htmlStats(stats) == check.htmlStats(df)
+    assert "Total cards: 5 (8 inv, net: 0)." in check.stringStats(stats)
+
+
+class LibraryStandIn(http.server.BaseHTTPRequestHandler):
+    """just enough of mtgjson for the card lib download: ETag, conditional GET, Range/If-Range and a .sha256 file"""
+    body = b"pretend this is a zip " * 5000
+    etag = "\"v1\""
+    requests_seen = []
+
+    def do_GET(self):
+        LibraryStandIn.requests_seen.append((self.path, dict(self.headers)))
+        if self.path.endswith(".sha256"):
+            return self.reply(200, hashlib.sha256(self.body).hexdigest().encode() + b"  AllCards.zip\n")
+        if self.headers.get("If-None-Match") == self.etag:
+            return self.reply(304, b"")
+        range_header = self.headers.get("Range")
+        if range_header and self.headers.get("If-Range") == self.etag:
+            start = int(range_header.split("=")[1].rstrip("-"))
+            if start >= len(self.body):
+                return self.reply(416, b"", {"Content-Range": "bytes */%d" % len(self.body)})
+            return self.reply(206, self.body[start:], {"Content-Range": "bytes %d-%d/%d" % (start, len(self.body) - 1, len(self.body))})
+        return self.reply(200, self.body)
+
+    def reply(self, status, body, headers={}):
+        self.send_response(status)
+        self.send_header("ETag", self.etag)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_stand_in(handler):
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, "http://127.0.0.1:%d/AllCards.zip" % server.server_address[1]
+
+
+def test_freshen_card_library(tmp_path):
+    """download once, skip the network inside the TTL, 304 after it, and resume a partial download with Range"""
+    server, url = start_stand_in(LibraryStandIn)
+    try:
+        lib_zip = tmp_path / "AllCards.zip"
+        LibraryStandIn.requests_seen = []
+        check.freshenCardLibrary(lib_zip, 20, url)
+        assert lib_zip.read_bytes() == LibraryStandIn.body
+        assert check.readLibraryMeta(lib_zip)["etag"] == LibraryStandIn.etag
+        assert check.readLibraryMeta(lib_zip)["sha256"] == hashlib.sha256(LibraryStandIn.body).hexdigest()
+
+        LibraryStandIn.requests_seen = []
+        check.freshenCardLibrary(lib_zip, 20, url)
+        assert LibraryStandIn.requests_seen == [], "inside the TTL there shouldn't be any network at all"
+
+        check.freshenCardLibrary(lib_zip, 0, url)
+        assert [headers.get("If-None-Match") for path, headers in LibraryStandIn.requests_seen] == [LibraryStandIn.etag]
+        assert lib_zip.read_bytes() == LibraryStandIn.body
+
+        # a new version showed up and the last run died halfway through it
+        LibraryStandIn.body = b"a newer zip " * 9000
+        LibraryStandIn.etag = "\"v2\""
+        (tmp_path / "AllCards.zip.part").write_bytes(LibraryStandIn.body[:40000])
+        dict_meta = check.readLibraryMeta(lib_zip)
+        dict_meta["part-etag"] = LibraryStandIn.etag
+        check.writeLibraryMeta(lib_zip, dict_meta)
+        LibraryStandIn.requests_seen = []
+        check.freshenCardLibrary(lib_zip, 0, url)
+        assert LibraryStandIn.requests_seen[0][1]["Range"] == "bytes=40000-"
+        assert lib_zip.read_bytes() == LibraryStandIn.body
+        assert not (tmp_path / "AllCards.zip.part").exists()
+        assert check.readLibraryMeta(lib_zip)["etag"] == "\"v2\""
+
+        # the last run got the whole thing but died before renaming it, and there's no zip at all
+        lib_zip.unlink()
+        (tmp_path / "AllCards.zip.part").write_bytes(LibraryStandIn.body)
+        check.writeLibraryMeta(lib_zip, {"part-etag": LibraryStandIn.etag})
+        LibraryStandIn.requests_seen = []
+        check.freshenCardLibrary(lib_zip, 0, url)
+        assert LibraryStandIn.requests_seen[0][1]["Range"] == "bytes=%d-" % len(LibraryStandIn.body)
+        assert lib_zip.read_bytes() == LibraryStandIn.body and not (tmp_path / "AllCards.zip.part").exists()
+        assert check.readLibraryMeta(lib_zip)["sha256"] == hashlib.sha256(LibraryStandIn.body).hexdigest()
+    finally:
+        server.shutdown()
+
+
+def use_data_dir(tmp_path, monkeypatch):
+    """point everything that lives in data/ at a temp dir"""
+    monkeypatch.setattr(check, "DATA_DIR_NAME", str(tmp_path) + "/")
+    monkeypatch.setattr(check, "SNAPSHOT_CACHE_DIR_NAME", str(tmp_path) + "/cache/")
+    monkeypatch.setattr(check, "STAGE_CACHE_DIR_NAME", str(tmp_path) + "/stages/")
+    monkeypatch.setattr(check, "SNAPSHOT_STORE_DIR_NAME", str(tmp_path) + "/snapshots/")
+    monkeypatch.setattr(check, "HISTORY_DB_FILE_NAME", str(tmp_path) + "/card-history.db")
+
+
+def write_export(path, rows):
+    """write a small deckbox-like export"""
+    header = "Count,Tradelist Count,Name,Edition,Card Number,Condition,Language,Foil,Signed,Artist Proof,Altered Art,Misprint,Promo,Textless,My Price,Type,Rarity,Price\n"
+    with open(str(path), "w") as file:
+        file.write(header)
+        for count, name, edition, number, condition, foil, price in rows:
+            file.write('%d,0,"%s",%s,%s,%s,English,%s,,,,,,,,Instant,Rare,"%s"\n' % (count, name, edition, number, condition, foil, price))
+
+
+def test_snapshot_cache(tmp_path, monkeypatch):
+    """the cache should hand back exactly what parsing the CSV does, and notice when the CSV changes"""
+    use_data_dir(tmp_path, monkeypatch)
+    rows = [(1, "Fire // Ice", "Apocalypse", "128", "Near Mint", "", "$1,234.50"),
+            (4, "Forest", "Alpha", "", "Good (Lightly Played)", "foil", "$0.10"),
+            (2, "Forest", "Alpha", "007", "Near Mint", "", "$3.00")]
+    write_export(tmp_path / "20200101-magic-cards.csv", rows)
+
+    parsed = check.readCleanSnapshot("20200101-magic-cards.csv")
+    assert (tmp_path / "cache" / "20200101-magic-cards.csv" / "meta.json").exists()
+    cached = check.readSnapshotCache("20200101-magic-cards.csv")
+    pandas.testing.assert_frame_equal(cached, parsed)
+    assert list(cached["Price"]) == [123450, 10, 300], "prices are whole cents"
+    assert cached["Name"].dtype == "category"
+    assert list(cached["Card Number"].isna()) == [False, True, False]
+
+    # touching the file doesn't matter, changing it does
+    os.utime(str(tmp_path / "20200101-magic-cards.csv"), (1, 1))
+    assert check.readSnapshotCache("20200101-magic-cards.csv") is not None
+    write_export(tmp_path / "20200101-magic-cards.csv", rows[:2] + [(3, "Forest", "Alpha", "007", "Near Mint", "", "$3.00")])
+    assert check.readSnapshotCache("20200101-magic-cards.csv") is None
+    assert list(check.readCleanSnapshot("20200101-magic-cards.csv")["Count"]) == [1, 4, 3]
+
+
+def test_price_history(tmp_path, monkeypatch):
+    """only changes get stored, but a card's series and the collection at a date come back complete"""
+    use_data_dir(tmp_path, monkeypatch)
+    bolt = ("Lightning Bolt", "Alpha", "", "Near Mint")
+    write_export(tmp_path / "20200101-magic-cards.csv", [(1,) + bolt + ("", "$300.00"), (2, "Forest", "Alpha", "", "Near Mint", "foil", "$1.00")])
+    write_export(tmp_path / "20200201-magic-cards.csv", [(1,) + bolt + ("", "$300.00"), (2, "Forest", "Alpha", "", "Near Mint", "foil", "$1.50")])
+
+    assert check.importHistory() == 2
+    assert check.importHistory() == 0, "already imported snapshots get skipped"
+    write_export(tmp_path / "20200301-magic-cards.csv", [(1,) + bolt + ("", "$350.00")])
+    check.updateHistory("20200301-magic-cards.csv", check.readCleanSnapshot("20200301-magic-cards.csv"))
+
+    con = check.openHistory()
+    assert con.execute("SELECT COUNT(*) FROM observations").fetchone()[0] == 5, "unchanged cards shouldn't be written again"
+    con.close()
+
+    series = check.cardHistory("Lightning Bolt")
+    assert list(series["Date"]) == ["2020-01-01", "2020-02-01", "2020-03-01"]
+    assert list(series["Price"]) == [300.0, 300.0, 350.0]
+    assert list(series["Count"]) == [1, 1, 1]
+    assert list(check.cardHistory("Forest", bFoil=True)["Count"]) == [2, 2, 0]
+    assert len(check.cardHistory("Forest", bFoil=False)) == 0
+
+    assert list(check.collectionAt("2020-02-15")["Price"]) == [1.5, 300.0]
+    assert list(check.collectionAt("2020-03-01")["Name"]) == ["Lightning Bolt"]
+    assert len(check.collectionAt("2019-12-31")) == 0
+
+    # a run where today's export is the same as the last one still puts the day in the history, without writing any cards
+    today = datetime.datetime.now()
+    check.registerSnapshot("20200301-magic-cards.csv")
+    check.writeRunLog("20200301-06:00:00:000000", {"old-file": "20200201-magic-cards.csv", "new-file": "20200301-magic-cards.csv"})
+    shutil.copy(str(tmp_path / "20200301-magic-cards.csv"), str(tmp_path / check.today_csv_file_name(today.strftime("%Y%m%d"))))
+    check.startStageSpans()
+    outcome = check.compareCollection({}, today, {"Lightning Bolt": "R"}, bMail=False)
+    assert outcome["stats"] == {"identical-to-old-file": True}
+    series = check.cardHistory("Lightning Bolt")
+    assert list(series["Date"]) == ["2020-01-01", "2020-02-01", "2020-03-01", today.strftime("%Y-%m-%d")]
+    assert list(series["Price"])[-1] == 350.0
+    con = check.openHistory()
+    assert con.execute("SELECT COUNT(*) FROM observations").fetchone()[0] == 5
+    con.close()
+
+
+def test_history_backfills_on_first_run(tmp_path, monkeypatch):
+    """ingest creates the db for card ids before the history gets updated, the first update should still back fill every snapshot"""
+    use_data_dir(tmp_path, monkeypatch)
+    write_export(tmp_path / "20200101-magic-cards.csv", [(1, "Forest", "Alpha", "", "Near Mint", "", "$1.00")])
+    write_export(tmp_path / "20200201-magic-cards.csv", [(2, "Forest", "Alpha", "", "Near Mint", "", "$1.00")])
+    df = check.readCleanSnapshot("20200201-magic-cards.csv")
+    assert os.path.exists(check.HISTORY_DB_FILE_NAME)
+    check.updateHistory("20200201-magic-cards.csv", df)
+    assert list(check.cardHistory("Forest")["Count"]) == [1, 2]
+
+
+def test_run_log(tmp_path, monkeypatch):
+    """the old json run log moves into the db once, runs get appended, and the compare file comes from the catalog"""
+    use_data_dir(tmp_path, monkeypatch)
+    monkeypatch.setattr(check, "RUN_LOG_FILE_NAME", str(tmp_path) + "/run-log.json")
+    for strFileName in ["20200101-magic-cards.csv", "20200201-magic-cards.csv", "20200301-magic-cards.csv"]:
+        write_export(tmp_path / strFileName, [(1, "Forest", "Alpha", "", "Near Mint", "", "$1.00")])
+    with open(check.RUN_LOG_FILE_NAME, "w") as file:
+        json.dump({"20200201-06:00:00:000000": {"old-file": "20200101-magic-cards.csv", "new-file": "20200201-magic-cards.csv"},
+                   "20200115-06:00:00:000000": {"old-file": "20191201-magic-cards.csv", "new-file": "20200101-magic-cards.csv"}}, file)
+
+    assert check.lastRun()["new-file"] == "20200201-magic-cards.csv"
+    assert not os.path.exists(check.RUN_LOG_FILE_NAME) and os.path.exists(check.RUN_LOG_FILE_NAME + ".migrated")
+    assert check.determineCompareFile(check.lastRun()) == "20200201-magic-cards.csv"
+    assert check.determineCompareFile(None) == "20200101-magic-cards.csv"
+
+    check.writeRunLog("20200301-06:00:00:000000", {"old-file": "20200201-magic-cards.csv", "new-file": "20200301-magic-cards.csv",
+                                                   "stats": {"total-cards": numpy.int64(1)}})
+    assert list(check.readRunLog()) == ["20200115-06:00:00:000000", "20200201-06:00:00:000000", "20200301-06:00:00:000000"]
+    assert check.lastRun()["stats"] == {"total-cards": 1}
+    assert list(check.runsForFile("20200201-magic-cards.csv")) == ["20200201-06:00:00:000000", "20200301-06:00:00:000000"]
+
+    # the catalog doesn't list the directory again, until the file it picks turns out to be gone
+    write_export(tmp_path / "20200401-magic-cards.csv", [(1, "Forest", "Alpha", "", "Near Mint", "", "$1.00")])
+    assert check.catalogSnapshots()[-1] == "20200301-magic-cards.csv"
+    check.registerSnapshot("20200401-magic-cards.csv")
+    assert check.catalogSnapshots()[-1] == "20200401-magic-cards.csv"
+    os.remove(str(tmp_path / "20200301-magic-cards.csv"))
+    assert check.determineCompareFile(check.lastRun()) == "20200101-magic-cards.csv"
+    assert "20200301-magic-cards.csv" not in check.catalogSnapshots()
+
+
+def test_horizon_compare_file():
+    """pick the newest snapshot on or before N days ago, falling back to the oldest one"""
+    csvs = ["20200101-magic-cards.csv", "20200301-magic-cards.csv", "20200325-magic-cards.csv", "20200401-magic-cards.csv"]
+    assert check.horizonCompareFile("20200401-magic-cards.csv", 7, csvs) == "20200325-magic-cards.csv"
+    assert check.horizonCompareFile("20200401-magic-cards.csv", 30, csvs) == "20200301-magic-cards.csv"
+    assert check.horizonCompareFile("20200401-magic-cards.csv", 365, csvs) == "20200101-magic-cards.csv"
+    assert check.horizonCompareFile("20200101-magic-cards.csv", 7, csvs) is None
+
+
+def test_compare_horizons(tmp_path, monkeypatch):
+    """today gets compared against each horizon's snapshot, with names only categorized once across all of them"""
+    use_data_dir(tmp_path, monkeypatch)
+    write_export(tmp_path / "20200101-magic-cards.csv", [(1, "Lightning Bolt", "Alpha", "161", "Near Mint", "", "$2.00")])
+    write_export(tmp_path / "20200325-magic-cards.csv", [(1, "Lightning Bolt", "Alpha", "161", "Near Mint", "", "$5.00")])
+    write_export(tmp_path / "20200401-magic-cards.csv", [(1, "Lightning Bolt", "Alpha", "161", "Near Mint", "", "$12.00"),
+                                                         (1, "Forest", "Alpha", "", "Near Mint", "", "$0.10")])
+    lookups = []
+
+    class CountingLibrary(dict):
+        def get(self, name, default=None):
+            lookups.append(name)
+            return dict.get(self, name, default)
+
+    today = check.readCleanSnapshot("20200401-magic-cards.csv")
+    horizons = check.compareHorizons("20200401-magic-cards.csv", today, [7, 90], CountingLibrary({"Lightning Bolt": "R", "Forest": "Land"}), {})
+    assert [(label, old_file) for label, old_file, merged, results, stats in horizons] == \
+        [("7 days", "20200325-magic-cards.csv"), ("90 days", "20200101-magic-cards.csv")]
+    assert horizons[0][4]["count-dollar-to-trades"] == 1
+    assert horizons[1][4]["count-bulk-to-trades"] == 1
+    assert sorted(lookups) == ["Forest", "Lightning Bolt"]
+
+    html = check.buildHorizonReport(horizons, "20200401-magic-cards.csv")
+    assert "March 25, 2020 (7 days)" in html and "January 01, 2020 (90 days)" in html
+    assert html.count("id=\"FilterInput\"") == 1
+
+
+def test_stage_cache(tmp_path, monkeypatch):
+    """a second merge+query on the same snapshots comes out of the stage cache, the same as the first time"""
+    use_data_dir(tmp_path, monkeypatch)
+    write_export(tmp_path / "20200101-magic-cards.csv", [(1, "Lightning Bolt", "Alpha", "161", "Near Mint", "", "$2.00"),
+                                                         (2, "Forest", "Alpha", "", "Near Mint", "", "$0.10")])
+    write_export(tmp_path / "20200201-magic-cards.csv", [(1, "Lightning Bolt", "Alpha", "161", "Near Mint", "", "$12.00"),
+                                                         (1, "Forest", "Alpha", "", "Near Mint", "foil", "$0.50")])
+    library = {"Lightning Bolt": "R", "Forest": "Land"}
+    old = check.readOldCards("20200101-magic-cards.csv")
+    new = check.readCleanSnapshot("20200201-magic-cards.csv")
+
+    merged, key = check.cachedMerge(new, old, "20200201-magic-cards.csv", "20200101-magic-cards.csv", library, bWriteMerged=False)
+    results, stats = check.cachedQuery(merged, key)
+    html = check.buildHTMLReport(merged, results, stats, "20200201-magic-cards.csv", "20200101-magic-cards.csv")
+
+    build_merge_df = check.buildMergeDF
+    monkeypatch.setattr(check, "buildMergeDF", None)
+    monkeypatch.setattr(check, "queryForReports", None)
+    merged_again, key_again = check.cachedMerge(new, old, "20200201-magic-cards.csv", "20200101-magic-cards.csv", library, bWriteMerged=False)
+    results_again, stats_again = check.cachedQuery(merged_again, key_again)
+    assert key_again == key
+    pandas.testing.assert_frame_equal(merged_again.drop(columns="Bucket"), merged.drop(columns="Bucket"))
+    assert stats_again == stats
+    assert html == check.buildHTMLReport(merged_again, results_again, stats_again, "20200201-magic-cards.csv", "20200101-magic-cards.csv")
+
+    # the key follows the compare file's contents: a copy of it is the same key (still a hit, buildMergeDF is gone), a different one isn't
+    shutil.copy(str(tmp_path / "20200101-magic-cards.csv"), str(tmp_path / "20191201-magic-cards.csv"))
+    merged_copy, key_copy = check.cachedMerge(new, check.readOldCards("20191201-magic-cards.csv"), "20200201-magic-cards.csv",
+                                              "20191201-magic-cards.csv", library, bWriteMerged=False)
+    assert key_copy == key
+    monkeypatch.setattr(check, "buildMergeDF", build_merge_df)
+    write_export(tmp_path / "20191101-magic-cards.csv", [(3, "Forest", "Alpha", "", "Near Mint", "", "$0.10")])
+    merged_other, key_other = check.cachedMerge(new, check.readOldCards("20191101-magic-cards.csv"), "20200201-magic-cards.csv",
+                                                "20191101-magic-cards.csv", library, bWriteMerged=False)
+    assert key_other != key and list(merged_other["OldCount"]) != list(merged["OldCount"])
+
+
+def test_snapshot_store(tmp_path, monkeypatch):
+    """old snapshots move into the store as keyframes and deltas and come back exactly as their CSVs read, under the same names"""
+    use_data_dir(tmp_path, monkeypatch)
+    monkeypatch.setattr(check, "SNAPSHOT_KEYFRAME_EVERY", 3)
+    bolt = (1, "Lightning Bolt", "Alpha", "161", "Near Mint", "", "$2.00")
+    forest = (4, "Forest", "Alpha", "", "Near Mint", "", "$0.10")
+    days = [[bolt, forest, forest],
+            [bolt[:6] + ("$2.50",), forest, forest, (1, "Counterspell", "Beta", "", "Good (Lightly Played)", "foil", "$30.00")],
+            [(2, "Counterspell", "Beta", "", "Good (Lightly Played)", "foil", "$31.00"), forest],
+            [forest, (1, "Black Lotus", "Alpha", "232", "Near Mint", "", "ask me")],
+            [forest]]
+    names = ["202001%02d-magic-cards.csv" % (day + 1) for day in range(len(days))]
+    for name, rows in zip(names, days):
+        write_export(tmp_path / name, rows)
+    from_csv = {name: check.readCleanSnapshot(name) for name in names}
+    hashes = {name: check.snapshotSHA1(name) for name in names}
+
+    assert check.migrateSnapshots() == names[:-1]
+    assert sorted(os.listdir(str(tmp_path / "snapshots"))) == \
+        [names[0] + ".key", names[1] + ".delta.npz", names[2] + ".delta.npz", names[3] + ".key"]
+    assert [name for name in names if os.path.exists(str(tmp_path / name))] == names[-1:]
+    for name in names:
+        pandas.testing.assert_frame_equal(check.readCleanSnapshot(name), from_csv[name])
+        assert check.snapshotSHA1(name) == hashes[name]
+    assert check.rescanSnapshots() == names
+    assert check.determineCompareFile({"old-file": names[1], "new-file": names[2]}) == names[2]
+
+
+def test_merge_on_card_ids(tmp_path, monkeypatch):
+    """the same printing gets the same id in every snapshot, and the merge joins on it"""
+    use_data_dir(tmp_path, monkeypatch)
+    write_export(tmp_path / "20200101-magic-cards.csv", [(1, "Lightning Bolt", "Alpha", "161", "Near Mint", "", "$2.00"),
+                                                         (2, "Forest", "Alpha", "", "Near Mint", "foil", "$0.50")])
+    write_export(tmp_path / "20200201-magic-cards.csv", [(3, "Forest", "Alpha", "", "Near Mint", "foil", "$0.75"),
+                                                         (1, "Forest", "Alpha", "", "Near Mint", "", "$0.10")])
+    old = check.readOldCards("20200101-magic-cards.csv")
+    new = check.readCleanSnapshot("20200201-magic-cards.csv")
+    assert new["CardId"][0] == old["CardId"][1], "same printing, same id"
+    assert new["CardId"][1] not in set(old["CardId"]), "non-foil is a different card"
+
+    merged = check.buildMergeDF(new, old, {"Forest": "Land", "Lightning Bolt": "R"}, bWriteMerged=False).set_index("Name", append=True)
+    assert len(merged) == 3
+    bolt = merged.xs("Lightning Bolt", level="Name").iloc[0]
+    assert bool(bolt["IsGone"]) and bolt["Edition"] == "Alpha" and bolt["OldCount"] == 1 and bolt["NewCount"] == 0
+    forests = merged.xs("Forest", level="Name").set_index("IsFoil")
+    assert forests.loc[True, "OldCount"] == 2 and forests.loc[True, "NewCount"] == 3 and forests.loc[True, "NewPrice"] == 75
+    assert bool(forests.loc[False, "IsNew"])
+
+
+def to_html_reference(df):
+    """how the card tables used to be made, cell by cell with applymap and to_html"""
+    df = df.copy()
+
+    def color(x):
+        return "#E9967A" if x < 0 else "#8FBC8F" if x > 0 else ""
+    df[["CountChange"]] = df[["CountChange"]].applymap(lambda x: "<div style=\"background-color: " + color(x) + "\">" + str(x) + "</div>")
+    df[["PriceChange", "TotalChange"]] = df[["PriceChange", "TotalChange"]].applymap(
+        lambda x: "<div style=\"background-color: " + color(x) + "\">" + "${:,.2f}".format(x / 100) + "</div>")
+    df[["OldPrice", "NewPrice"]] = df[["OldPrice", "NewPrice"]].applymap(lambda x: "${:,.2f}".format(x / 100))
+    df = df.rename(columns={"SortCategory": "Sort", "Condition": "Cond", "IsFoil": "Foil", "CardNumber": "Card#", "OldCount": "Old#",
+                            "NewCount": "New#", "TradeCount": "Trade#", "OldPrice": "Old$", "NewPrice": "New$", "CountChange": "\u0394 Q",
+                            "PriceChange": "\u0394$", "TotalChange": "\u03a3\u0394$"})
+    df = df.drop(columns=["IsNew", "IsGone", "Bucket", "CardId"], errors="ignore")
+    with pandas.option_context("display.max_colwidth", None):
+        return df.to_html(index=False, justify="left", escape=False,
+                          formatters={"Name": lambda x: "<a href=\"https://deckbox.org/mtg/" + x + "\" target=_blank>" + x + "</a>"})
+
+
+def test_card_table_markup(tmp_path, monkeypatch):
+    """the streamed card tables have to be the same markup the old applymap/to_html way made, chunked or not"""
+    use_data_dir(tmp_path, monkeypatch)
+    write_export(tmp_path / "20200101-magic-cards.csv", [(1, "Fire // Ice", "Apocalypse", "128", "Near Mint", "", "$1,999.99"),
+                                                         (2, "Forest", "Alpha", "", "Near Mint", "foil", "$0.50"),
+                                                         (4, "Jace & Vraska", "War", "7", "Played", "", "$12.00")])
+    write_export(tmp_path / "20200201-magic-cards.csv", [(3, "Forest", "Alpha", "", "Near Mint", "foil", "$0.75"),
+                                                         (1, "Fire // Ice", "Apocalypse", "128", "Near Mint", "", "$2,500.00"),
+                                                         (1, "Forest", "Alpha", "", "Near Mint", "", "$0.10"),
+                                                         (4, "Jace & Vraska", "War", "7", "Played", "", "$12.00")])
+    merged = check.buildMergeDF(check.readCleanSnapshot("20200201-magic-cards.csv"), check.readOldCards("20200101-magic-cards.csv"),
+                                {"Forest": "Land", "Fire // Ice": "Gold"}, bWriteMerged=False)
+    results, stats = check.queryForReports(merged.copy())
+    assert "Bucket" not in merged and list(results["unch-cards"]["Bucket"]) == ["unch-cards"] * len(results["unch-cards"])
+
+    assert check.toHTMLDefaulter(merged) == to_html_reference(merged)
+    writer = io.StringIO()
+    check.writeCardTable(writer, [results["unch-cards"], results["new-cards"]], intChunkRows=1)
+    assert writer.getvalue() == to_html_reference(pandas.concat([results["unch-cards"], results["new-cards"]]))
+    assert check.toHTMLDefaulter(results["bulk-to-trades"]) == "<b>N/A - No match"
+
+
+def test_data_report(tmp_path, monkeypatch):
+    """"data" mode puts each card table in the json payload once (and the page script instead of the static filter), the email copy is capped"""
+    use_data_dir(tmp_path, monkeypatch)
+    write_export(tmp_path / "20200101-magic-cards.csv", [(1, "Fire // Ice", "Apocalypse", "128", "Near Mint", "", "$1.00"),
+                                                         (2, "Forest", "Alpha", "", "Near Mint", "foil", "$12.00"),
+                                                         (4, "</script>", "War", "7", "Played", "", "$12.00")])
+    write_export(tmp_path / "20200201-magic-cards.csv", [(3, "Forest", "Alpha", "", "Near Mint", "foil", "$0.75"),
+                                                         (1, "Fire // Ice", "Apocalypse", "128", "Near Mint", "", "$2,500.00"),
+                                                         (4, "</script>", "War", "7", "Played", "", "$1.00")])
+    merged = check.buildMergeDF(check.readCleanSnapshot("20200201-magic-cards.csv"), check.readOldCards("20200101-magic-cards.csv"),
+                                {"Forest": "Land", "Fire // Ice": "Gold"}, bWriteMerged=False)
+    results, stats = check.queryForReports(merged)
+
+    writer = io.StringIO()
+    check.writeHTMLReport(writer, merged, results, stats, "20200201-magic-cards.csv", "20200101-magic-cards.csv", "data")
+    html = writer.getvalue()
+    assert "filterRowsSoon()" in html and "filterTDs()" not in html and "class=\"dataframe\"" not in html.split("</head>")[1]
+    strJSON = html.split("<script id=\"CardData\" type=\"application/json\">")[1].split("</script>")[0]
+    payload = json.loads(strJSON)
+    assert payload["headers"][1] == "Name" and len(payload["tables"]) == html.count("class=\"cardtable\"") == 2
+    dictTable = dict(zip(payload["headers"], payload["tables"][0]["cols"]))
+    assert [payload["strings"][intId] for intId in dictTable["Name"]] == ["Forest", "</script>"]
+    assert dictTable["New$"] == [75, 100] and dictTable["\u03a3\u0394$"] == [225 - 2400, 400 - 4800]
+    assert payload["strings"][payload["tables"][1]["cols"][5][0]] == "128"
+
+    writer = io.StringIO()
+    check.writeHTMLReport(writer, merged, results, stats, "20200201-magic-cards.csv", "20200101-magic-cards.csv", "static", 1)
+    html = writer.getvalue()
+    assert html.count("<a href=") == 2 and "... and 1 more" in html
+
+
+def test_startup_tasks(tmp_path, monkeypatch, capsys):
+    """the startup tasks overlap, and a failing or stuck task is reported by name"""
+    use_data_dir(tmp_path, monkeypatch)
+    write_export(tmp_path / "20200101-magic-cards.csv", [(1, "Forest", "Alpha", "", "Near Mint", "", "$1.00")])
+    write_export(tmp_path / "20200201-magic-cards.csv", [(2, "Forest", "Alpha", "", "Near Mint", "", "$1.50")])
+
+    def slow_library(fTTLHours):
+        time.sleep(0.5)
+        return {"Forest": "Land"}
+    monkeypatch.setattr(check, "buildCardLibrary", slow_library)
+    monkeypatch.setattr(check, "readOldCards", lambda strOldFileName: time.sleep(0.5) or check.readCleanSnapshot(strOldFileName))
+    fStart = time.time()
+    today, old, strOldFileName, library = check.startupTasks("20200201-magic-cards.csv", {})
+    assert time.time() - fStart < 0.9, "library and compare snapshot should load at the same time"
+    assert list(today["Count"]) == [2] and strOldFileName == "20200101-magic-cards.csv" and library == {"Forest": "Land"}
+
+    def broken():
+        raise ValueError("deckbox is down")
+    with pytest.raises(RuntimeError) as excinfo:
+        check.runConcurrently({"fine": lambda: 1, "broken": broken, "stuck": lambda: time.sleep(2)}, 0.2)
+    assert "broken" in str(excinfo.value) and "stuck" in str(excinfo.value) and "fine" not in str(excinfo.value)
+    assert isinstance(excinfo.value.__cause__, ValueError)
+    strOut = capsys.readouterr().out
+    assert "broken failed: ValueError('deckbox is down')" in strOut and "stuck is still going" in strOut
+
+
+class SMTPStandIn(socketserver.StreamRequestHandler):
+    """just enough of an smtp server for sendMail: no tls or login, keeps the messages, can hang up with a 421 on the next N emails"""
+    connections = 0
+    messages = []
+    fail_next = 0
+
+    def handle(self):
+        SMTPStandIn.connections += 1
+        self.reply(b"220 stand-in")
+        while True:
+            line = self.rfile.readline()
+            command = line[:4].upper()
+            if command in (b"", b"QUIT"):
+                return self.reply(b"221 bye") if command else None
+            if command == b"MAIL" and SMTPStandIn.fail_next > 0:
+                SMTPStandIn.fail_next -= 1
+                return self.reply(b"421 try again later")
+            if command == b"DATA":
+                self.reply(b"354 go ahead")
+                lines = []
+                for line in iter(self.rfile.readline, b".\r\n"):
+                    lines.append(line[1:] if line.startswith(b"..") else line)
+                SMTPStandIn.messages.append(email.message_from_bytes(b"".join(lines)))
+            self.reply(b"250 ok")
+
+    def reply(self, line):
+        self.wfile.write(line + b"\r\n")
+
+
+def test_send_mail(monkeypatch):
+    """one pooled connection for several emails sent in the background, big reports get a summary and a gzipped copy, 4xx gets retried"""
+    server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), SMTPStandIn)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(check, "MAIL_RETRY_SECONDS", 0)
+    config = {"outgoing-smtp": "127.0.0.1", "smtp-port": server.server_address[1], "smtp-starttls": False,
+              "from-email": "cards@example.com", "to-email": "me@example.com, you@example.com", "email-max-bytes": 1000}
+    try:
+        SMTPStandIn.connections, SMTPStandIn.messages = 0, []
+        check.queueMail("<p>small</p>", config)
+        big = "<table>" + "<tr><td>Lightning Bolt</td></tr>" * 500 + "</table>"
+        check.queueMail(big, config, "<p>summary</p>", "20200201-report.htm.gz")
+        check.finishMail()
+        assert SMTPStandIn.connections == 1
+        small_mail, big_mail = SMTPStandIn.messages
+        assert small_mail["to"] == "me@example.com, you@example.com"
+        assert [part.get_payload(decode=True) for part in small_mail.get_payload()] == [b"<p>small</p>"]
+        summary, attachment = big_mail.get_payload()
+        assert summary.get_payload(decode=True) == b"<p>summary</p>"
+        assert attachment.get_filename() == "20200201-report.htm.gz"
+        assert gzip.decompress(attachment.get_payload(decode=True)).decode("utf-8") == big
+
+        # too big and no summary still gets a body, and a server hanging up gets another go on a new connection
+        SMTPStandIn.connections, SMTPStandIn.messages, SMTPStandIn.fail_next = 0, [], 1
+        check.sendMail(big, config)
+        assert SMTPStandIn.connections == 2
+        assert b"too big to send inline" in SMTPStandIn.messages[0].get_payload()[0].get_payload(decode=True)
+
+        # past the retries finishMail reports it
+        SMTPStandIn.fail_next = check.MAIL_ATTEMPTS
+        check.queueMail("<p>small</p>", config)
+        with pytest.raises(RuntimeError):
+            check.finishMail()
+    finally:
+        check.closeMailConnections()
+        server.shutdown()
+
+
+def test_use_collection_defaults(tmp_path, monkeypatch):
+    """a collection that leaves settings out gets the defaults (or the shared config's), not the last collection's in the same process"""
+    for name in ["DATA_DIR_NAME", "RUN_LOG_FILE_NAME", "SNAPSHOT_CACHE_DIR_NAME", "HISTORY_DB_FILE_NAME", "STAGE_CACHE_DIR_NAME",
+                 "SNAPSHOT_STORE_DIR_NAME", "COOKIE_FILE_NAME", "DECKBOX_SET_ID", "TRADE_BOX_THRESHOLD", "BULK_BOX_THRESHOLD"]:
+        monkeypatch.setattr(check, name, getattr(check, name))
+    defaults = (check.COOKIE_FILE_NAME, check.DECKBOX_SET_ID, check.TRADE_BOX_THRESHOLD, check.BULK_BOX_THRESHOLD)
+    first, second = check.collectionConfigs({"bulk-box-threshold": 2, "collections": [
+        {"name": "a", "data-dir": str(tmp_path / "a"), "cookie-file": "cookies-a.json", "deckbox-set-id": 111, "trade-box-threshold": 5,
+         "bulk-box-threshold": 1},
+        {"name": "b", "data-dir": str(tmp_path / "b")}]})
+
+    check.useCollection(first)
+    assert (check.COOKIE_FILE_NAME, check.DECKBOX_SET_ID, check.TRADE_BOX_THRESHOLD, check.BULK_BOX_THRESHOLD) == ("cookies-a.json", "111", 5, 1)
+    check.useCollection(second)
+    assert (check.COOKIE_FILE_NAME, check.DECKBOX_SET_ID, check.TRADE_BOX_THRESHOLD, check.BULK_BOX_THRESHOLD) == defaults[:3] + (2,)
+    assert check.priceTiers(second)[1][2] == 2 and check.priceTiers(second)[2][2] == defaults[2]
+    assert check.DATA_DIR_NAME == str(tmp_path / "b") + "/"
+
+
+def test_mail_failure_after_metrics(tmp_path, monkeypatch):
+    """an email that didn't go out fails the run, but only after the timings and the metrics file are written"""
+    use_data_dir(tmp_path, monkeypatch)
+    monkeypatch.setattr(check, "buildCardLibrary", lambda *args: {"Lightning Bolt": "R"})
+    monkeypatch.setattr(check.logging.getLogger(check.__name__), "level", check.logging.INFO)
+    today = check.today_csv_file_name(datetime.datetime.now().strftime("%Y%m%d"))
+    write_export(tmp_path / "20200101-magic-cards.csv", [(1, "Lightning Bolt", "Alpha", "161", "Near Mint", "", "$2.00")])
+    write_export(tmp_path / today, [(1, "Lightning Bolt", "Alpha", "161", "Near Mint", "", "$5.00")])
+    monkeypatch.setattr(check, "queueMail", lambda *args: None)
+
+    def fail_mail():
+        raise RuntimeError("1 of 1 emails didn't go out")
+    monkeypatch.setattr(check, "finishMail", fail_mail)
+    config = {"report-mode": "static", "metrics-file": str(tmp_path / "metrics.jsonl")}
+
+    check.startStageSpans()
+    with pytest.raises(RuntimeError, match="didn't go out"):
+        check.compareCollection(config, datetime.datetime.now())
+    with open(config["metrics-file"]) as file:
+        entry = json.loads(file.readline())
+    assert entry["new-file"] == today and "render" in entry["stages"]
+
+
+def test_run_batch(tmp_path, monkeypatch):
+    """each collection runs in a worker process with its own data dir and boxes, on the one shared sort index, plus a summary of them all"""
+    use_data_dir(tmp_path, monkeypatch)
+    monkeypatch.setattr(check, "LIBRARY_ZIP_FILE_NAME", str(tmp_path / "AllCards.zip"))
+    monkeypatch.setattr(check, "SORT_INDEX_FILE_NAME", str(tmp_path / "AllCards.sortidx"))
+    library = {"Lightning Bolt": "R", "Forest": "Land"}
+    check.writeSortIndex(library, check.libraryVersionKey(Path(check.LIBRARY_ZIP_FILE_NAME)), check.SORT_INDEX_FILE_NAME)
+    monkeypatch.setattr(check, "buildCardLibrary", lambda *args: library)
+    monkeypatch.setattr(check.logging.getLogger(check.__name__), "level", check.logging.DEBUG)
+    today = check.today_csv_file_name(datetime.datetime.now().strftime("%Y%m%d"))
+    for name in ["store", "consignment"]:
+        os.makedirs(str(tmp_path / name))
+        write_export(tmp_path / name / "20200101-magic-cards.csv", [(1, "Lightning Bolt", "Alpha", "161", "Near Mint", "", "$2.00")])
+        write_export(tmp_path / name / today, [(1, "Lightning Bolt", "Alpha", "161", "Near Mint", "", "$5.00")])
+    # one worker, so store runs in the same process right after consignment and still has to get the default boxes
+    config = {"report-mode": "static", "batch-workers": 1, "collections": [
+        {"name": "consignment", "data-dir": str(tmp_path / "consignment") + "/", "bulk-box-threshold": 1, "trade-box-threshold": 4},
+        {"name": "store", "data-dir": str(tmp_path / "store")}]}
+
+    outcomes = check.runBatch(config, datetime.datetime.now())
+    consignment, store = [outcome for collection, outcome, err in outcomes]
+    assert store["report-file"].startswith(str(tmp_path / "store") + "/") and os.path.exists(store["report-file"])
+    assert store["stats"]["count-bulk-to-dollar"] == 1
+    assert consignment["stats"]["count-dollar-to-trades"] == 1
+    assert check.PRICE_TIERS[1][2] == check.BULK_BOX_THRESHOLD, "the batch process itself keeps its boxes"
+    with open(str(tmp_path) + "/" + today.split("-")[0] + "-batch-summary.htm", encoding="utf-8") as file:
+        summary = file.read()
+    assert "<td>store</td>" in summary and "<td>consignment</td>" in summary and consignment["report-file"] in summary
+
+
+def test_read_deckbox_export(tmp_path, capsys):
+    """only the schema columns get read, typed, and a bad price or a blank count gets reported instead of killing the run"""
+    write_export(tmp_path / "export.csv", [(1, "Forest", "Alpha", "", "Near Mint", "", "$1,234.56"),
+                                           (2, "Island", "Beta", "12", "Near Mint", "foil", "ask me"),
+                                           (3, "Swamp", "Beta", "13", "Near Mint", "", ""),
+                                           (9, "Plains", "Beta", "14", "Near Mint", "", "$2.00")])
+    (tmp_path / "export.csv").write_text((tmp_path / "export.csv").read_text().replace('9,0,"Plains"', ',0,"Plains"'))
+    df = check.readDeckboxExport(str(tmp_path / "export.csv"))
+    assert list(df.columns) == list(check.DECKBOX_SCHEMA)
+    assert list(df["Price"]) == [123456, 0, 0, 200]
+    assert list(df["Count"]) == [1, 2, 3, 0] and df["Count"].dtype.kind == "i"
+    assert df["Price"].dtype == "int32" and df["Edition"].dtype == "category"
+    assert list(df["Card Number"].isna()) == [True, False, False, False]
+    strOut = capsys.readouterr().out
+    assert "1 malformed price(s)" in strOut and "1 blank or malformed Count(s)" in strOut and "3: nan" in strOut
+
+    assert list(check.parsePriceCents(pandas.Series(["$0.10", " $3.00 ", None, "$19.99"]))) == [10, 300, 0, 1999]
+
+    (tmp_path / "nope.csv").write_text("Name,Price\nForest,$1.00\n")
+    with pytest.raises(ValueError, match="Count"):
+        check.readDeckboxExport(str(tmp_path / "nope.csv"))
+
+
+class DeckboxStandIn(http.server.BaseHTTPRequestHandler):
+    """just enough of Deckbox for the export download: gzips the body when asked to, can cut it off partway through a row"""
+    body = b""
+    requests_seen = []
+
+    def do_GET(self):
+        DeckboxStandIn.requests_seen.append((self.path, dict(self.headers)))
+        body = self.body
+        self.send_response(200)
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            body = gzip.compress(body)
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_stream_deckbox_export(tmp_path, monkeypatch):
+    """the export comes down gzipped, gets parsed on the way in, and a cut off or shrunken one never becomes today's snapshot"""
+    use_data_dir(tmp_path, monkeypatch)
+    (tmp_path / "cookies.json").write_text("{}")
+    monkeypatch.setattr(check, "COOKIE_FILE_NAME", str(tmp_path / "cookies.json"))
+    server, url = start_stand_in(DeckboxStandIn)
+    monkeypatch.setattr(check, "DECKBOX_EXPORT_URL", url.replace("AllCards.zip", ""))
+    try:
+        write_export(tmp_path / "export.csv", [(i % 4 + 1, "Card %d" % i, "Alpha", str(i), "Near Mint", "", "$%d.25" % i) for i in range(3000)])
+        DeckboxStandIn.body = (tmp_path / "export.csv").read_bytes()
+        DeckboxStandIn.requests_seen = []
+        df = check.fetchTodaysCards("20200101-magic-cards.csv")
+        assert DeckboxStandIn.requests_seen[0][0].startswith("/" + check.DECKBOX_SET_ID + "?format=csv")
+        assert "gzip" in DeckboxStandIn.requests_seen[0][1]["Accept-Encoding"]
+        assert (tmp_path / "20200101-magic-cards.csv").read_bytes() == DeckboxStandIn.body
+        assert not (tmp_path / "20200101-magic-cards.csv.part").exists()
+        assert df.equals(check.readCleanSnapshot("20200101-magic-cards.csv"))
+        assert check.catalogSnapshots() == ["20200101-magic-cards.csv"]
+        check.appendHistory("20200101-magic-cards.csv", df)
+
+        # already there, so no second trip
+        assert check.fetchAndWriteDeckboxLibrary("20200101-magic-cards.csv") is None and len(DeckboxStandIn.requests_seen) == 1
+
+        DeckboxStandIn.body = (tmp_path / "export.csv").read_bytes()[:-25]
+        with pytest.raises(ValueError, match="cut off"):
+            check.fetchAndWriteDeckboxLibrary("20200102-magic-cards.csv")
+        DeckboxStandIn.body = b"".join((tmp_path / "export.csv").read_bytes().splitlines(keepends=True)[:1000])
+        with pytest.raises(ValueError, match="only has 999 rows"):
+            check.fetchAndWriteDeckboxLibrary("20200102-magic-cards.csv")
+        DeckboxStandIn.body = b"<html>please log in</html>\n"
+        with pytest.raises(ValueError, match="doesn't look like a Deckbox export"):
+            check.fetchAndWriteDeckboxLibrary("20200102-magic-cards.csv")
+        assert sorted(os.listdir(tmp_path / "cache")) == ["20200101-magic-cards.csv"]
+        assert not any(name.startswith("20200102") for name in os.listdir(tmp_path))
+
+        DeckboxStandIn.body = b"".join((tmp_path / "export.csv").read_bytes().splitlines(keepends=True)[:1000])
+        assert len(check.fetchAndWriteDeckboxLibrary("20200102-magic-cards.csv", 0.3)) == 999
+    finally:
+        server.shutdown()
+
+
+class FlakyStandIn(http.server.BaseHTTPRequestHandler):
+    """keeps connections open, answers 503 to the next fail_next requests, remembers which client port each request came from"""
+    protocol_version = "HTTP/1.1"
+    fail_next = 0
+    ports_seen = []
+
+    def do_GET(self):
+        FlakyStandIn.ports_seen.append(self.client_address[1])
+        status, body = (503, b"busy") if FlakyStandIn.fail_next > 0 else (200, b"fine " * 100)
+        FlakyStandIn.fail_next -= 1
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_http_client(tmp_path, monkeypatch):
+    """one kept-alive connection, retries with backoff, metrics per endpoint, and a recorded run replays without the real servers"""
+    monkeypatch.setattr(check, "HTTP_RETRY_SECONDS", 0.01)
+    server, url = start_stand_in(FlakyStandIn)
+    try:
+        check.startHttp({})
+        FlakyStandIn.ports_seen = []
+        FlakyStandIn.fail_next = 2
+        with check.httpGet("mtgjson", url) as response:
+            assert response.status_code == 200 and response.content == b"fine " * 100
+        with check.httpGet("mtgjson", url) as response:
+            assert response.status_code == 200
+        assert len(FlakyStandIn.ports_seen) == 4 and len(set(FlakyStandIn.ports_seen)) == 1, "every try should reuse the one connection"
+        FlakyStandIn.fail_next = 5
+        with check.httpGet("mtgjson-checksum", url) as response:
+            assert response.status_code == 503, "out of tries, the caller gets the last answer"
+        dict_report = check.httpReport()
+        assert {key: dict_report["mtgjson"][key] for key in ["requests", "retries", "failures", "bytes"]} == \
+            {"requests": 4, "retries": 2, "failures": 0, "bytes": 1000}
+        assert dict_report["mtgjson-checksum"]["failures"] == 1 and dict_report["mtgjson-checksum"]["requests"] == 2
+    finally:
+        server.shutdown()
+
+    # record a deckbox fetch and a card lib download against the stand-ins, then do both again with the stand-ins gone
+    use_data_dir(tmp_path, monkeypatch)
+    (tmp_path / "cookies.json").write_text(json.dumps({"session": "mine"}))
+    monkeypatch.setattr(check, "COOKIE_FILE_NAME", str(tmp_path / "cookies.json"))
+    deckbox_server, deckbox_url = start_stand_in(DeckboxStandIn)
+    library_server, library_url = start_stand_in(LibraryStandIn)
+    monkeypatch.setattr(check, "DECKBOX_EXPORT_URL", deckbox_url.replace("AllCards.zip", ""))
+    write_export(tmp_path / "export.csv", [(1, "Forest", "Alpha", "", "Near Mint", "", "$1.00"), (2, "Island", "Beta", "", "Near Mint", "", "$2.00")])
+    DeckboxStandIn.body = (tmp_path / "export.csv").read_bytes()
+    LibraryStandIn.body = b"pretend this is a zip " * 5000
+    LibraryStandIn.etag = "\"v1\""
+    try:
+        check.startHttp({"http-mode": "record", "http-cassette-dir": str(tmp_path / "http")})
+        DeckboxStandIn.requests_seen = []
+        check.fetchAndWriteDeckboxLibrary("20200101-magic-cards.csv")
+        assert DeckboxStandIn.requests_seen[0][1]["Cookie"] == "session=mine"
+        check.freshenCardLibrary(tmp_path / "AllCards.zip", 20, library_url)
+    finally:
+        deckbox_server.shutdown()
+        library_server.shutdown()
+    assert len(os.listdir(tmp_path / "http")) == 6, "export, library and its checksum, a body and a json file each"
+
+    try:
+        check.startHttp({"http-mode": "replay", "http-cassette-dir": str(tmp_path / "http")})
+        os.remove(tmp_path / "20200101-magic-cards.csv")
+        df = check.fetchAndWriteDeckboxLibrary("20200101-magic-cards.csv")
+        assert list(df["Name"]) == ["Forest", "Island"]
+        assert (tmp_path / "20200101-magic-cards.csv").read_bytes() == DeckboxStandIn.body
+        check.freshenCardLibrary(tmp_path / "replayed.zip", 20, library_url)
+        assert (tmp_path / "replayed.zip").read_bytes() == LibraryStandIn.body
+        assert check.httpReport()["deckbox"]["requests"] == 1 and check.httpReport()["deckbox"]["bytes"] < len(DeckboxStandIn.body), \
+            "the export should come back gzipped like it was recorded"
+        with check.httpGet("mtgjson", "https://mtgjson.com/never-recorded") as response:
+            assert response.status_code == 404
+    finally:
+        check.startHttp({})
+
+
+def test_daemon(tmp_path, monkeypatch):
+    """the daemon answers over its socket from what it already has parsed, notices new exports, and cleans up after itself"""
+    use_data_dir(tmp_path, monkeypatch)
+    write_export(tmp_path / "20200101-magic-cards.csv", [(1, "Forest", "Alpha", "", "Near Mint", "", "$1.00"),
+                                                         (1, "Island", "Beta", "", "Near Mint", "", "$5.00")])
+    write_export(tmp_path / "20200108-magic-cards.csv", [(2, "Forest", "Alpha", "", "Near Mint", "", "$1.50"),
+                                                         (1, "Island", "Beta", "", "Near Mint", "", "$12.00")])
+    monkeypatch.setattr(check, "freshenCardLibrary", lambda libZip, fTTLHours: libZip)
+    library_loads = []
+    monkeypatch.setattr(check, "buildCardLibrary", lambda fTTLHours: library_loads.append(fTTLHours) or {"Forest": "Land", "Island": "Land"})
+    snapshot_loads = []
+    load_clean_snapshot = check.loadCleanSnapshot
+    monkeypatch.setattr(check, "loadCleanSnapshot", lambda strFileName: snapshot_loads.append(strFileName) or load_clean_snapshot(strFileName))
+
+    socket_file = str(tmp_path / "d.sock")
+    # left behind by a daemon that died, nothing answers on it
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale.bind(socket_file)
+    stale.close()
+    daemon = threading.Thread(target=check.runDaemon, args=({"daemon-socket": socket_file, "daemon-poll-seconds": 0.05},))
+    daemon.start()
+    try:
+        for i in range(200):
+            try:
+                status = check.askDaemon({"command": "status"}, socket_file)
+                break
+            except OSError:
+                time.sleep(0.02)
+        assert status["ok"] and status["snapshots"] == ["20200101-magic-cards.csv", "20200108-magic-cards.csv"]
+        assert sorted(snapshot_loads) == status["snapshots"] and len(library_loads) == 1
+
+        moves = check.askDaemon({"command": "moves", "days": 7}, socket_file)
+        assert moves["old-file"] == "20200101-magic-cards.csv" and moves["new-file"] == "20200108-magic-cards.csv"
+        assert [(move["Name"], move["TotalChange"]) for move in moves["moves"]] == [("Island", 7.0), ("Forest", 2.0)]
+        assert moves["stats"]["net-value-change"] == 9.0
+        assert check.askDaemon({"command": "moves", "days": 7}, socket_file)["moves"] == moves["moves"]
+        assert len(snapshot_loads) == 2 and len(library_loads) == 1, "the second time everything should already be in memory"
+
+        rendered = check.askDaemon({"command": "render", "new-file": "20200108-magic-cards.csv", "old-file": "20200101-magic-cards.csv",
+                                    "html": True}, socket_file)
+        assert "Island" in rendered["html"] and os.path.exists(rendered["report-file"])
+
+        write_export(tmp_path / "20200115-magic-cards.csv", [(3, "Forest", "Alpha", "", "Near Mint", "", "$2.00")])
+        for i in range(200):
+            if "20200115-magic-cards.csv" in check.askDaemon({"command": "status"}, socket_file)["snapshots"]:
+                break
+            time.sleep(0.02)
+        assert "20200115-magic-cards.csv" in check.catalogSnapshots()
+        cards = check.askDaemon({"command": "card", "name": "fore"}, socket_file)
+        assert cards["file"] == "20200115-magic-cards.csv" and [(card["Name"], card["Count"], card["Price"]) for card in cards["cards"]] == \
+            [("Forest", 3, 2.0)]
+
+        # in the middle of a long request status still answers, so a second daemon sees this one and leaves its socket alone
+        with check.daemonRequestLock:
+            assert check.askDaemon({"command": "status"}, socket_file, 2)["busy"]
+            with pytest.raises(RuntimeError, match="already a daemon"):
+                check.runDaemon({"daemon-socket": socket_file})
+        assert os.path.exists(socket_file) and not check.askDaemon({"command": "status"}, socket_file)["busy"]
+
+        nonsense = check.askDaemon({"command": "make coffee"}, socket_file)
+        assert not nonsense["ok"] and "make coffee" in nonsense["error"]
+        assert check.askDaemon({"command": "shutdown"}, socket_file)["ok"]
+    finally:
+        daemon.join(10)
+    assert not daemon.is_alive() and not os.path.exists(socket_file)
+    assert not check.daemonState["resident"] and len(check.daemonState["snapshots"]) == 0
+
+
+def test_bench_small(tmp_path, monkeypatch):
+    """the benchmark should run every stage end to end on a tiny synthetic collection and notice a slowdown against a baseline"""
+    listResults = []
+    bench_check.benchSize(300, listResults)
+    assert [result["stage"] for result in listResults] == ["buildCompareDFs", "buildCompareDFs-cached", "buildMergeDF",
+                                                           "queryForReports", "buildHTMLReport", "readDeckboxExport", "storeSnapshot",
+                                                           "readStoredSnapshot", "loopDataFrame"]
+    assert all(result["seconds"] > 0 and result["size"] == 300 for result in listResults)
+    assert check.DATA_DIR_NAME == "data/"
+
+    listBaseline = [dict(result, seconds=1.0, **{"peak-mb": 100.0}) for result in listResults]
+    assert bench_check.compareToBaseline(listResults, listBaseline) == []
+    listSlower = [dict(result, seconds=2.0) if result["stage"] == "buildMergeDF" else result for result in listBaseline]
+    listRegressions = bench_check.compareToBaseline(listSlower, listBaseline)
+    assert len(listRegressions) == 1 and listRegressions[0].startswith("buildMergeDF @ 300 rows: seconds")
+    assert bench_check.compareToBaseline([dict(listResults[0], size=200)], listBaseline) == ["buildCompareDFs @ 200 rows: not in the baseline"]
+
+    # no baseline fails instead of passing quietly, --save-baseline writes one
+    monkeypatch.setattr(bench_check, "BENCH_OUTPUT_FILE_NAME", str(tmp_path / "bench_output.txt"))
+    monkeypatch.setattr(bench_check, "BENCH_BASELINE_FILE_NAME", str(tmp_path / "bench_baseline.json"))
+    assert bench_check.main(["300"]) == 1
+    assert bench_check.main(["300", "--save-baseline"]) == 0
+    with open(bench_check.BENCH_BASELINE_FILE_NAME) as file:
+        assert [result["stage"] for result in json.load(file)] == [result["stage"] for result in listResults]
+
+
+def test_stage_spans(tmp_path):
+    """nested and repeated spans add up, an inner span's peak memory also counts for the outer one, --profile dumps a file per stage"""
+    check.startStageSpans(bTraceMemory=True, strProfileDir=str(tmp_path) + "/profile/")
+    try:
+        with check.stageSpan("merge") as span:
+            with check.stageSpan("categorize", 10):
+                listBig = [0] * 2000000
+                del listBig
+            span["rows"] = 5
+        with check.stageSpan("merge", 7):
+            pass
+    finally:
+        tracemalloc.stop()
+    dictReport = check.stageSpanReport()
+    assert list(dictReport) == ["categorize", "merge"]
+    assert dictReport["merge"]["calls"] == 2 and dictReport["merge"]["rows"] == 12
+    assert dictReport["categorize"]["rows"] == 10
+    assert dictReport["categorize"]["peak-mb"] > 10 and dictReport["merge"]["peak-mb"] >= dictReport["categorize"]["peak-mb"]
+    assert dictReport["merge"]["wall-seconds"] >= dictReport["categorize"]["wall-seconds"]
+    assert sorted(os.listdir(str(tmp_path) + "/profile/")) == ["categorize.prof", "merge-2.prof", "merge.prof"]
+
+    check.startStageSpans()
+    with check.stageSpan("query", 3):
+        pass
+    assert "peak-mb" not in check.stageSpanReport()["query"] and check.stageSpanReport()["query"]["max-rss-mb"] > 0
+    assert check.listOpenSpans == []
+
+
 def test_write_full_inventory(inventory):
     inventory.to_csv(check.DATA_DIR_NAME + 'full_inventory.csv')
 